@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import asyncio
+import coloredlogs
+import io
+import logging
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import worker_pool
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("aio_server")
+
+# threads that run the (blocking) request handlers; the event loop itself only
+# shuffles bytes
+AIO_WORKERS = worker_pool.POOL_WORKERS
+
+# refuse request heads bigger than this, like http.server's 64k line limit
+MAX_HEAD_BYTES = 65536
+
+
+class AsyncHTTPServer():
+    '''
+        An event-driven stand-in for ThreadedHTTPServer.
+
+        Connections are accepted and read on a single asyncio event loop, so an
+            idle or slow client costs a coroutine instead of an OS thread.
+            Once a whole request (head and Content-Length body) has arrived,
+            it is handed to the ordinary BaseHTTPRequestHandler subclass on a
+            bounded thread pool, which gives the same do_GET/do_POST/
+            do_OPTIONS semantics as the threaded server.
+
+        At most workers + queue_size requests may be running or waiting for a
+            thread; past that, requests are answered with a 503 like
+            worker_pool.PooledMixIn does.
+    '''
+
+    retry_after = worker_pool.RETRY_AFTER
+
+    def __init__(self, server_address, RequestHandlerClass,
+                 bind_and_activate=True, workers=None, queue_size=None):
+        # like socketserver's, except that binding waits for serve_forever;
+        # a listening socket put here (as prefork.adopt does) is used instead
+        self.socket              = None
+        self.server_address      = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.workers             = workers or AIO_WORKERS
+        self.queue_size          = queue_size or worker_pool.POOL_QUEUE
+        self.executor            = ThreadPoolExecutor(
+            max_workers=self.workers
+        )
+        self._server             = None
+        self._loop               = None
+        # every connection's task, so none is left pending
+        self._tasks              = set()
+        # requests handed to the executor and not finished yet, and those not
+        # yet answered either; only touched from the event loop thread
+        self._admitted           = 0
+        self._in_hand            = 0
+        self._closing            = False
+
+    def serve_forever(self):
+        # a loop of its own rather than asyncio.run, which Python 3.6 lacks
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # the process's SIGTERM and SIGINT handlers (server.py's exits) run
+        # as loop callbacks, not inside whichever connection's coroutine
+        # was running, where the exit would be kept as that task's result
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signo in (signal.SIGTERM, signal.SIGINT):
+                handler = signal.getsignal(signo)
+                if callable(handler):
+                    handlers[signo] = handler
+                    loop.add_signal_handler(signo, handler, signo, None)
+        serve = loop.create_task(self._serve(loop))
+        try:
+            loop.run_until_complete(serve)
+        finally:
+            # as asyncio.run does, cancel what's left (idle connections, or
+            # everything after an exit) and let it finish before closing
+            left = [t for t in self._tasks | {serve} if not t.done()]
+            for task in left:
+                task.cancel()
+            if left:
+                loop.run_until_complete(
+                    asyncio.gather(*left, return_exceptions=True)
+                )
+            loop.close()
+            for signo, handler in handlers.items():
+                signal.signal(signo, handler)
+            self.executor.shutdown(wait=False)
+
+    def shutdown(self):
+        '''
+            Effects:    stops accepting; serve_forever returns once the
+                        requests in hand are answered. Safe from any thread.
+        '''
+        if self._server is not None:
+            self._loop.call_soon_threadsafe(self._close)
+
+    def server_close(self):
+        if self.socket is not None:
+            self.socket.close()
+
+    def _close(self):
+        self._closing = True
+        self._server.close()
+        self._stopped.set()
+
+    async def _serve(self, loop):
+        self._loop    = loop
+        self._stopped = asyncio.Event()
+        if self.socket is not None:
+            self._server = await asyncio.start_server(
+                self._accept, sock=self.socket, limit=MAX_HEAD_BYTES
+            )
+        else:
+            host, port = self.server_address
+            self._server = await asyncio.start_server(
+                self._accept, host or None, port, limit=MAX_HEAD_BYTES
+            )
+        # Server.serve_forever and "async with" on a server are 3.7's; the
+        # server accepts as soon as it is started anyway
+        try:
+            await self._stopped.wait()
+        finally:
+            self._server.close()
+        # idle connections are cancelled once this returns; those with a
+        # request being handled get their answer first
+        while self._in_hand:
+            await asyncio.sleep(.05)
+
+    def _accept(self, reader, writer):
+        task = self._loop.create_task(self._connection(reader, writer))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _connection(self, reader, writer):
+        peer   = writer.get_extra_info("peername")
+        loop   = self._loop
+        idle   = getattr(self.RequestHandlerClass, "timeout", None)
+        served = 0
+        try:
+            while True:
+                try:
+                    raw = await asyncio.wait_for(
+                        self._read_request(reader), idle
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if raw is None:
+                    break
+
+                if self._admitted >= self.workers + self.queue_size:
+                    metrics.incr("pool.rejected")
+                    writer.write(
+                        worker_pool.overloaded_response(self.retry_after)
+                    )
+                    await writer.drain()
+                    break
+
+                self._admitted += 1
+                self._in_hand  += 1
+                metrics.gauge("pool.queue_depth",
+                              max(0, self._admitted - self.workers))
+                try:
+                    try:
+                        out, close = await loop.run_in_executor(
+                            self.executor, self._handle, raw, peer, served,
+                            time.perf_counter()
+                        )
+                    finally:
+                        self._admitted -= 1
+                    served += 1
+                    writer.write(out)
+                    await writer.drain()
+                finally:
+                    self._in_hand -= 1
+                if close or self._closing:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ValueError) as e:
+            logger.debug("dropping connection from {}: {!r}".format(peer, e))
+
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        '''
+            Arguments:  reader (an asyncio.StreamReader)
+            Returns:    the bytes of one whole request, or None at EOF
+            Throws:     asyncio.LimitOverrunError for an oversized head,
+                        ValueError for a bad Content-Length
+
+            Read a request head and as much body as Content-Length says.
+        '''
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+
+        length = 0
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                length = int(value.strip())
+                break
+
+        if length < 0:
+            raise ValueError("negative Content-Length")
+
+        body = await reader.readexactly(length) if length else b""
+        return head + body
+
+    def _handle(self, raw, peer, served, queued_at):
+        '''
+            Arguments:  raw (bytes), peer (the remote address), served (an int,
+                        requests already answered on this connection),
+                        queued_at (a time.perf_counter() value)
+            Returns:    the response bytes, and whether to close the connection
+            Throws:     no
+
+            Run the usual request handler against in-memory files.
+        '''
+        metrics.observe("pool.queue_wait", time.perf_counter() - queued_at)
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request        = None
+        handler.client_address = peer
+        handler.server         = self
+        handler.rfile          = io.BytesIO(raw)
+        handler.wfile          = io.BytesIO()
+        handler.close_connection = True
+        handler.requests_served  = served
+        try:
+            handler.handle_one_request()
+        except Exception:
+            logger.exception("request handler crashed")
+            return b"", True
+        return handler.wfile.getvalue(), handler.close_connection
@@ -1,16 +1,30 @@
 #!/usr/bin/env python3
 # from os import path
 # import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
 import gapi_auth
 import json_helper
 import coloredlogs
 import logging
+import dev_vars
+import order_log
+import permissions
 
 API_CLIENT_ID = "502024288218-4h8it97gqlkmc0ttnr9ju3hpke8gcatj" + \
     ".apps.googleusercontent.com"
 
 LOCAL_PORT = 9000
 
+# most orders one view_orders request may ask for
+VIEW_ORDERS_MAX = 100
+
+# most requests one batch may carry, and threads running their read-only
+# verbs side by side
+BATCH_MAX     = 16
+BATCH_WORKERS = 8
+
 ALLOW_FRONTEND_DOMAINS = [
     "http://localhost:" + str(LOCAL_PORT),
     "http://localhost:3000",
@@ -25,22 +39,83 @@ coloredlogs.install(
 logger = logging.getLogger("api_helper")
 
 
-def is_elevated_id(email, hd=None):
-    idn, dom = email.split("@")
-    el_ids, status = json_helper.all_entires("elevated_ids")
-    if status == -1:
-        return False
-
-    return (
-        (
-            idn in el_ids["devs"]
-            and (dom == "gmail.com")
-        ) or (
-            idn in el_ids["sau9"]
-            and (dom == "sau9.org")
-            and hd == "sau9.org"
+# verb name -> VerbSpec, filled in at import time by the @verb decorator below
+VERBS = {}
+
+# func:   the reply_* function
+# csrf:   whether the verb needs a valid anticsrf token (when the server is
+#         configured to require them at all)
+# args:   names of server-side objects passed positionally after data, like
+#         "token_clerk"
+# kwargs: extra keyword arguments for the function
+# schema: a JSON-schema-like fragment describing the verb's data; only
+#         "required" is enforced by the server
+# cache:  the name of the database the verb's reply data is made from alone,
+#         if any; the server then encodes (and compresses) that data once per
+#         version of the database instead of on every request
+# read_only: whether the verb changes nothing, so a batch may run it
+#         alongside other read-only verbs
+VerbSpec = namedtuple("VerbSpec", ["name", "func", "csrf", "args", "kwargs",
+                                   "schema", "cache", "read_only"])
+
+
+def verb(name=None, csrf=True, args=(), kwargs=None, schema=None,
+         cache=None, read_only=False):
+    '''
+        Arguments:  name (a string, defaulting to the function name without
+                    "reply_"), csrf (a bool), args (a tuple<string>), kwargs
+                    (a dict), schema (a dict), cache (a database name),
+                    read_only (a bool)
+        Returns:    a decorator which registers its function in VERBS and
+                    returns it unchanged
+        Throws:     KeyError if a verb with that name is already registered
+
+        Build the verb dispatch table once, at import time, instead of on
+            every request.
+    '''
+    def register(func):
+        vname = name or func.__name__[len("reply_"):]
+        if vname in VERBS:
+            raise KeyError("verb registered twice: {}".format(vname))
+        VERBS[vname] = VerbSpec(
+            name=vname,
+            func=func,
+            csrf=csrf,
+            args=tuple(args),
+            kwargs=dict(kwargs or {}),
+            schema=dict(schema or {}),
+            cache=cache,
+            read_only=read_only
         )
-    )
+        return func
+    return register
+
+
+def missing_keys(spec, data):
+    return [k for k in spec.schema.get("required", ()) if k not in data]
+
+
+def needs_csrf(verbstr, data):
+    '''
+        Arguments:  verbstr (a string), data (the request's data)
+        Returns:    whether the request needs a valid anticsrf token; a batch
+                    needs one if any request in it does, and it is checked
+                    once for the whole batch
+        Throws:     no
+    '''
+    spec = VERBS.get(verbstr)
+    if spec is None:
+        return True
+    if spec.name == "batch" and isinstance(data, list):
+        return any(
+            not isinstance(req, dict) or needs_csrf(req.get("verb"), None)
+            for req in data
+        )
+    return spec.csrf
+
+
+def is_elevated_id(email, hd=None):
+    return permissions.index.has_role(email, permissions.ELEVATED, hd=hd)
 
 
 def verb_reply(s):
@@ -51,69 +126,152 @@ def to_error_json(s):
     return {"error": repr(s)}
 
 
+def identify(data, spoofing=False, bound_to=None):
+    '''
+        Arguments:  data (a request's data, with "gapi_token", a Google ID
+                    token), spoofing (a bool; a dev server takes anyone for
+                    an elevated "dev" account), bound_to (the verb's
+                    csrf_bound_to keyword argument)
+        Returns:    the account's verified claims (with "sub", "email" and
+                    "is_elevated") and True, or an error and a status
+        Throws:     no
+
+        For verbs which act for a user: who that is comes from here, never
+            from what the request says about itself. When the request's
+            anticsrf token was checked, it must have been issued to that same
+            account, so a token got by signing in as one user can't be used
+            with another's sign-in.
+    '''
+    if spoofing:
+        return {"sub": "dev", "email": "dev@localhost", "name": "dev",
+                "is_elevated": True}, True
+    try:
+        who = gapi_auth._validate_gapi_token(data["gapi_token"])
+    except (gapi_auth.client.AccessTokenCredentialsError,
+            gapi_auth.crypt.AppIdentityError,
+            KeyError, TypeError, ValueError) as e:
+        return to_error_json(e), (401, "a valid Google sign-in is required")
+    except OSError as e:
+        # Google's certs couldn't be fetched
+        return to_error_json(e), (503, "can't check Google sign-ins now")
+    if bound_to is not None and not bound_to(who["sub"]):
+        return to_error_json(
+            "the anticsrf token wasn't issued to this account"
+        ), (401, "the anticsrf token belongs to another sign-in")
+    return who, True
+
+
 # following methods take one argument and return an object{} and a
 # status value (True for 200 OK or a tuple like (code, message))
 
 
+@verb(csrf=False, read_only=True)
 def reply_ping(data, *args, **kwargs):
     return {
         "pingback": "ping" in data and data["ping"] == "hello",
     }, True
 
 
+@verb(
+    csrf=False,
+    args=("token_clerk",),
+    kwargs={"SPOOFING": dev_vars.DEV_SPOOFING_GAPI_REQS}
+)
 def reply_gapi_validate(data, *args, **kwargs):
     if kwargs["SPOOFING"]:
         rval = "yeah idc what you sent me i'm a dev server", True
     else:
         rval = gapi_auth.validate_gapi_key(data)
 
+    # the token is bound to whom it was issued to, and verbs acting for a
+    # user check that it is them (see identify)
+    user = rval[0].get("sub") if rval[1] is True and isinstance(
+        rval[0], dict) else None
+
     return [
         {
-            "anticsrf":  args[0].register_new(),
+            "anticsrf":  args[0].register_new(user=user),
             "gapi_info": rval[0]
         },
         rval[1]
     ]
 
 
+@verb(read_only=True)
 def reply_view_orders(data, *args, **kwargs):
-    # map needed keys to default values
-    # only update missing keys
-    data = dict(
-        data.items()
-        | {
-            "age": "new",
-            "count": 10,
-            "from_end": "head"
-        }.items()
+    '''
+        Arguments:  data with any of age ("new" or "old"), limit (or the older
+                    count), from_end ("head" or "tail"), after (a cursor from
+                    a previous page), state (an int or a list of them), since
+                    and until (order times; until is exclusive)
+        Returns:    {"orders": [...], "next": a cursor or null}
+        Throws:     no
+
+        Pass next back as after, with the same age and from_end, for the
+            following page; null means there are no more orders.
+    '''
+    # defaults for missing keys
+    opts = {
+        "age": "new",
+        "limit": data.get("count", 10),
+        "from_end": "head",
+        "after": None,
+        "state": None,
+        "since": None,
+        "until": None
+    }
+    opts.update(data)
+
+    age          = "old" if opts["age"] == "old" else "new"
+    newest_first = opts["from_end"] == "tail"
+    try:
+        # noqa to allow number as string or float or int
+        limit  = min(max(int(float(opts["limit"])), 0), VIEW_ORDERS_MAX)
+        after  = None if opts["after"] is None else \
+            order_log.decode_cursor(opts["after"], age, newest_first)
+        states = opts["state"]
+        if states is not None:
+            states = frozenset(int(x) for x in (
+                states if isinstance(states, list) else [states]
+            ))
+        since, until = [
+            None if opts[k] is None else int(opts[k])
+            for k in ("since", "until")
+        ]
+    except (TypeError, ValueError, OverflowError) as e:
+        # OverflowError: an infinite limit, like "inf" or 1e999
+        return to_error_json(e), (400, "bad view_orders parameters")
+
+    page, status = json_helper.view_orders(
+        age, limit, newest_first, after, states, since, until
     )
+    if status != 200:
+        return to_error_json(page), (500, "couldn't read the orders")
 
-    # returns identity function when "from_end" is "head"
-    # otherwise returns reversed()
-    end_func = (
-        lambda x: x
-        if data["from_end"] == "head"
-        else lambda x: list(reversed(x))
-    )
-    num    = int(float(data["count"]))  # noqa to allow number as string or float or int
-    age    = "cur_orders" if data["age"] == "new" else "old_orders"
-    orders = json_helper.all_entires("orders")
-
-    return end_func(orders[age])[:num], True
+    return {
+        "orders": page["orders"],
+        "next": None if page["next"] is None else
+        order_log.encode_cursor(age, newest_first, page["next"])
+    }, True
 
 
+@verb(cache="menu", read_only=True)
 def reply_view_menu(data, *args, **kwargs):
     return json_helper.all_entires("menu"), True
 
 
+@verb(read_only=True)
 def reply_get_user_limits(data, *args, **kwargs):
-    limits = json_helper.all_entires("limits")
+    # limits = json_helper.all_entires("limits")
     # user   = None
     # find   = data["gapi_info"]
-    for uobj in limits:
-        pass
+    # for uobj in limits:
+    #     pass
+    return to_error_json("get_user_limits is not implemented yet"), \
+        (501, "not implemented")
 
 
+@verb(schema={"required": ["gapi_token", "menu_data"]})
 def reply_edit_menu(data, *args, **kwargs):
     if not all(x in data for x in ["gapi_token", "menu_data"]):
         return to_error_json(
@@ -134,9 +292,105 @@ def reply_edit_menu(data, *args, **kwargs):
     return {"result": "edit registered in queue"}, True
 
 
+@verb(
+    schema={"required": ["items", "gapi_token"]},
+    kwargs={"SPOOFING": dev_vars.DEV_SPOOFING_GAPI_REQS}
+)
 def reply_open_order(data, *args, **kwargs):
-    pass
+    who, ok = identify(data, kwargs["SPOOFING"], kwargs.get("csrf_bound_to"))
+    if ok is not True:
+        return who, ok
+    order = {
+        "items": data["items"],
+        "total_value": data.get("total_value", 0),
+        "gapi_user": {
+            "sub": who["sub"],
+            "email": who.get("email"),
+            "name": who.get("name"),
+        },
+    }
+    res, status = json_helper.register_write("orders", "open_order", order)
+    if status != 200:
+        return to_error_json(res), (status, "the order could not be placed")
+    return res, True
 
 
+@verb(
+    schema={"required": ["sort_id", "gapi_token"]},
+    kwargs={"SPOOFING": dev_vars.DEV_SPOOFING_GAPI_REQS}
+)
 def reply_close_order(data, *args, **kwargs):
-    pass
+    who, ok = identify(data, kwargs["SPOOFING"], kwargs.get("csrf_bound_to"))
+    if ok is not True:
+        return who, ok
+    res, status = json_helper.register_write("orders", "close_order", {
+        "sort_id": data["sort_id"],
+        # an elevated account may close any order, others only their own
+        "owner": None if who["is_elevated"] else who["sub"],
+    })
+    if status == 400:
+        return to_error_json(res), (400, "no such open order")
+    if status == 403:
+        return to_error_json(res), (403, "only the account which placed an"
+                                    " order, or an elevated one, may close"
+                                    " it")
+    if status != 200:
+        return to_error_json(res), (status, "the order could not be closed")
+    return res, True
+
+
+_batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+
+@verb(args=("run_verb",))
+def reply_batch(data, run_verb, **kwargs):
+    '''
+        Arguments:  data (a list of {"verb": ..., "data": ...}), run_verb
+                    (server.run_verb)
+        Returns:    a list of {"response", "status", "data"}, one for each
+                    request and in the same order, and True; or an error
+        Throws:     no
+
+        Runs several requests for one round trip. Each keeps its own status.
+            Consecutive read-only verbs run at the same time; any other verb
+            waits for everything before it and holds up everything after it,
+            so writes still happen in the order they were sent. The reads
+            themselves still go one at a time through json_helper's single
+            reader thread, so only the rest of each verb's work overlaps.
+    '''
+    if not isinstance(data, list) or not data:
+        return to_error_json("batch data must be a non-empty list"), \
+            (400, "bad batch")
+    if len(data) > BATCH_MAX:
+        return to_error_json(
+            "a batch may carry at most {} requests".format(BATCH_MAX)
+        ), (400, "batch too large")
+
+    def run(req):
+        if not isinstance(req, dict) or "verb" not in req:
+            return None, (to_error_json("batched request missing 'verb'"),
+                          400)
+        verbstr = req["verb"]
+        return verbstr, run_verb(verbstr, req.get("data", {}),
+                                 kwargs.get("csrf_bound_to"))
+
+    def is_read(req):
+        spec = isinstance(req, dict) and VERBS.get(req.get("verb"))
+        return bool(spec) and spec.read_only
+
+    results = []
+    reads   = []
+    for req in data + [None]:
+        if req is not None and is_read(req):
+            reads.append(_batch_pool.submit(run, req))
+            continue
+        results += [f.result() for f in reads]
+        reads = []
+        if req is not None:
+            results.append(run(req))
+
+    return [{
+        "response": verb_reply(verbstr) if verbstr else None,
+        "status": status,
+        "data": res,
+    } for verbstr, (res, status) in results], True
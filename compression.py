@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+import struct
+import time
+import zlib
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies shorter than this go out as they are; compressing them saves little
+# and costs a round of CPU for every request
+COMPRESS_MIN = 1024
+
+# zlib level (1-9) for gzip, and brotli quality (0-11); brotli at 11 is far
+# too slow for responses made on the fly
+GZIP_LEVEL     = 6
+BROTLI_QUALITY = 5
+
+_GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+# CPU time of the calling thread, which needs Python 3.7; before that, the
+# whole process's, which overstates it while other threads are busy
+_cpu_time = getattr(time, "thread_time", time.process_time)
+
+_min_size       = COMPRESS_MIN
+_gzip_level     = GZIP_LEVEL
+_brotli_quality = BROTLI_QUALITY
+
+
+def configure(min_size=COMPRESS_MIN, gzip_level=GZIP_LEVEL,
+              brotli_quality=BROTLI_QUALITY):
+    '''
+        Arguments:  min_size (an int; bytes), gzip_level (an int),
+                    brotli_quality (an int)
+        Returns:    None
+        Throws:     no
+        Effects:    sets the threshold and levels used from now on
+    '''
+    global _min_size, _gzip_level, _brotli_quality
+    _min_size       = min_size
+    _gzip_level     = gzip_level
+    _brotli_quality = brotli_quality
+
+
+def min_size():
+    return _min_size
+
+
+def supported():
+    '''
+        Returns:    the content codings this server can produce, best first
+    '''
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept, prefer=None):
+    '''
+        Arguments:  accept (the Accept-Encoding header, or None), prefer (a
+                    tuple of codings, best first, defaulting to supported())
+        Returns:    the coding to use, or None to send the body as it is
+        Throws:     no
+
+        The client's q-values decide first; prefer breaks ties. A coding
+            given q=0, or left out when there's no "*", is never chosen.
+    '''
+    weights = {}
+    for part in (accept or "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name] = weight
+
+    best, best_weight = None, 0.0
+    for coding in (prefer or supported()):
+        if coding not in supported():
+            continue
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def _count(coding, size_in, size_out, cpu):
+    metrics.incr("compression.{}.bytes_in".format(coding), size_in)
+    metrics.incr("compression.{}.bytes_out".format(coding), size_out)
+    metrics.observe("compression.{}.cpu".format(coding), cpu)
+
+
+class Encoder():
+    '''
+        Compresses one response body handed over a piece at a time, and
+            records the bytes in, the bytes out and the CPU time it took.
+    '''
+
+    def __init__(self, coding):
+        self.coding = coding
+        if coding == "gzip":
+            self._obj = zlib.compressobj(
+                _gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS
+            )
+            self._feed, self._end = self._obj.compress, self._obj.flush
+        else:
+            self._obj = brotli.Compressor(quality=_brotli_quality)
+            self._feed, self._end = self._obj.process, self._obj.finish
+        self.bytes_in  = 0
+        self.bytes_out = 0
+        self.cpu       = 0.0
+
+    def compress(self, data):
+        start = _cpu_time()
+        out = self._feed(data)
+        self.cpu       += _cpu_time() - start
+        self.bytes_in  += len(data)
+        self.bytes_out += len(out)
+        return out
+
+    def finish(self):
+        start = _cpu_time()
+        out = self._end()
+        self.cpu       += _cpu_time() - start
+        self.bytes_out += len(out)
+        _count(self.coding, self.bytes_in, self.bytes_out, self.cpu)
+        return out
+
+    def stream(self, chunks):
+        '''
+            Arguments:  chunks (an iterable of bytes)
+            Returns:    a generator of the compressed chunks; pieces the
+                        compressor holds back are not yielded empty
+        '''
+        for chunk in chunks:
+            out = self.compress(chunk)
+            if out:
+                yield out
+        yield self.finish()
+
+
+def compress(data, coding):
+    '''
+        Arguments:  data (bytes), coding ("gzip" or "br")
+        Returns:    data compressed in that coding
+        Throws:     no
+        Effects:    counts it in the compression metrics
+    '''
+    enc = Encoder(coding)
+    return enc.compress(data) + enc.finish()
+
+
+class GzipFragment():
+    '''
+        Part of a gzip body compressed once and spliced into many: raw
+            deflate data ending on a byte boundary, and the CRC-32 and length
+            of the bytes it holds.
+    '''
+
+    def __init__(self, data):
+        obj = zlib.compressobj(_gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.data = data
+        self.body = obj.compress(data) + obj.flush(zlib.Z_SYNC_FLUSH)
+
+
+def gzip_splice(prefix, fragment, suffix):
+    '''
+        Arguments:  prefix (bytes), fragment (a GzipFragment), suffix (bytes)
+        Returns:    a gzip body of prefix + fragment.data + suffix
+        Throws:     no
+        Effects:    counts it in the compression metrics
+
+        Only prefix and suffix are compressed here. Deflate blocks carry
+            their own lengths and the fragment never refers back before its
+            start, so its blocks are valid after any byte-aligned prefix; only
+            the CRC-32 has to be run over the fragment's data again.
+    '''
+    start = _cpu_time()
+    head = zlib.compressobj(_gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    tail = zlib.compressobj(_gzip_level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc  = zlib.crc32(suffix, zlib.crc32(fragment.data, zlib.crc32(prefix)))
+    size = len(prefix) + len(fragment.data) + len(suffix)
+    out  = b"".join([
+        _GZIP_HEADER,
+        head.compress(prefix), head.flush(zlib.Z_SYNC_FLUSH),
+        fragment.body,
+        tail.compress(suffix), tail.flush(),
+        struct.pack("<II", crc, size & 0xffffffff),
+    ])
+    _count("gzip", size, len(out), _cpu_time() - start)
+    return out
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import contextlib
+import fcntl
+import os
+import threading
+from os import path
+
+# a file's lock is an flock on this file next to it, not the file being
+# there, so a lock file left behind by a crash locks nothing; it's apart
+# from the file it guards, so renaming a new version into place keeps it
+LOCK_EXT = ".lock"
+
+TEMP_EXT = ".temp"
+
+
+class FileLock():
+    '''
+        A readers-writer lock shared by every thread and process that uses
+            the same lock file: any number of holders in shared mode, or one
+            in exclusive mode. Waiting blocks in the kernel (or, between
+            threads, on a condition) rather than polling, and a process's
+            locks go away with it, so a crash never leaves one stale.
+
+        flock belongs to an open file, which this process's threads share,
+            and one thread's flock would convert or drop another's; so
+            threads first take turns on an in-process readers-writer lock,
+            and only the first reader in or the writer calls flock. Writers
+            waiting hold back new readers, so they aren't starved.
+    '''
+
+    def __init__(self, lock_path):
+        self.lock_path = lock_path
+        self._fd       = None
+        self._pid      = None
+        self._cond     = threading.Condition()
+        self._readers  = 0
+        self._writer   = False
+        self._writers_waiting = 0
+
+    def _flock(self, op):
+        if self._pid != os.getpid():
+            # a descriptor inherited across a fork shares its lock with the
+            # parent's, so a child needs its own
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd  = os.open(self.lock_path,
+                                os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+            self._pid = os.getpid()
+        fcntl.flock(self._fd, op)
+
+    def acquire(self, exclusive=False):
+        '''
+            Arguments:  exclusive (a bool)
+            Returns:    None, once the lock is held
+            Throws:     OSError if the lock file can't be opened
+        '''
+        with self._cond:
+            if exclusive:
+                self._writers_waiting += 1
+                try:
+                    self._cond.wait_for(
+                        lambda: not self._writer and not self._readers
+                    )
+                finally:
+                    self._writers_waiting -= 1
+                # nobody in this process holds the lock, so only those about
+                # to take it wait while this blocks
+                self._flock(fcntl.LOCK_EX)
+                self._writer = True
+            else:
+                self._cond.wait_for(
+                    lambda: not self._writer and not self._writers_waiting
+                )
+                if not self._readers:
+                    self._flock(fcntl.LOCK_SH)
+                self._readers += 1
+
+    def release(self):
+        with self._cond:
+            if self._writer:
+                self._writer = False
+            else:
+                self._readers -= 1
+            if not self._readers:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def shared(self):
+        self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        self.acquire(exclusive=True)
+        try:
+            yield self
+        finally:
+            self.release()
+
+
+# lock file path -> FileLock, so every user in this process shares one
+_locks      = {}
+_locks_lock = threading.Lock()
+
+
+def lock_for(fpath):
+    '''
+        Arguments:  fpath (the path of the file to guard)
+        Returns:    the FileLock for fpath, whose lock file is fpath plus
+                    LOCK_EXT; the same object every time in this process
+        Throws:     no
+    '''
+    lock_path = fpath + LOCK_EXT
+    with _locks_lock:
+        lock = _locks.get(lock_path)
+        if lock is None:
+            lock = _locks[lock_path] = FileLock(lock_path)
+        return lock
+
+
+def shared(fpath):
+    '''
+        Returns:    a context manager holding fpath's lock in shared mode
+    '''
+    return lock_for(fpath).shared()
+
+
+def exclusive(fpath):
+    '''
+        Returns:    a context manager holding fpath's lock in exclusive mode
+    '''
+    return lock_for(fpath).exclusive()
+
+
+def read(fpath):
+    '''
+        Arguments:  fpath (a path)
+        Returns:    the file's bytes, read under a shared lock
+        Throws:     OSError
+    '''
+    with shared(fpath):
+        with open(fpath, "rb") as f:
+            return f.read()
+
+
+def write_atomic(fpath, data, mode=0o644):
+    '''
+        Arguments:  fpath (a path), data (bytes), mode (the permissions of a
+                    new file)
+        Returns:    None
+        Throws:     OSError
+        Effects:    replaces fpath with data, so readers see either the whole
+                    old file or the whole new one, even after a crash
+
+        The commit is a rename, so it takes no lock; hold exclusive(fpath)
+            around reading, changing and writing a file so that another
+            writer can't come in between.
+    '''
+    temp = "{}.{}.{}{}".format(fpath, os.getpid(), threading.get_ident(),
+                               TEMP_EXT)
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, fpath)
+    except BaseException:
+        if path.exists(temp):
+            os.remove(temp)
+        raise
+    # and the rename itself
+    fd = os.open(path.dirname(fpath) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
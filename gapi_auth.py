@@ -1,13 +1,231 @@
+import base64
+import coloredlogs
+import email.utils
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+
 from oauth2client import client, crypt
 
 from dev_vars import DEV_VARS
 
 from anticsrf import anticsrf
 
+import metrics
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("gapi_auth")
+
+GOOGLE_CERTS_URL = client.ID_TOKEN_VERIFICATION_CERTS
+
+# verified tokens remembered (by hash) until they expire
+TOKEN_CACHE_SIZE = 1024
+
+# the certs are refreshed once this fraction of their Cache-Control max-age
+# has passed, or after CERT_MAX_AGE seconds if the response doesn't say
+CERT_REFRESH_AHEAD = .8
+CERT_MAX_AGE       = 60 * 60
+
+# failed refreshes are retried after CERT_RETRY_MIN seconds, doubling up to
+# CERT_RETRY_MAX; the old certs are used meanwhile
+CERT_RETRY_MIN = 5
+CERT_RETRY_MAX = 5 * 60
+
+# a token signed by a key we don't have forces a refresh, at most this often
+CERT_FORCE_INTERVAL = 60
+
+CERT_FETCH_TIMEOUT = 10
+
+
+def _max_age(headers):
+    cache_control = headers.get("Cache-Control") or ""
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if match:
+        return max(0, int(match.group(1)) - int(headers.get("Age") or 0))
+    try:
+        return max(0, email.utils.parsedate_to_datetime(headers["Expires"])
+                   .timestamp() - time.time())
+    except (KeyError, TypeError, ValueError):
+        return CERT_MAX_AGE
+
+
+def _key_id(token):
+    try:
+        head = token.split(".")[0]
+        head = base64.urlsafe_b64decode(head + "=" * (-len(head) % 4))
+        return json.loads(head.decode("utf-8")).get("kid")
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+class CertStore():
+    '''
+        Google's ID token signing certificates, fetched ahead of need.
+
+        A background thread refreshes them before their Cache-Control max-age
+            runs out, so verifying a token never waits on the network. Until
+            the first fetch lands, after they expire, or when a token names a
+            key that isn't among them (Google has rotated its keys), get()
+            fetches them itself.
+    '''
+
+    def __init__(self, url=GOOGLE_CERTS_URL):
+        self.url         = url
+        self._certs      = None
+        self._max_age    = CERT_MAX_AGE
+        self._expires    = 0
+        self._fetched_at = None
+        self._lock       = threading.Lock()
+        self._stop       = threading.Event()
+        self._thread     = None
+
+    def refresh(self):
+        '''
+            Returns:    the certs, as {key id: PEM certificate}
+            Throws:     OSError or ValueError if they can't be fetched
+            Effects:    fetches them, unless another thread did while this one
+                        waited
+        '''
+        seen = self._fetched_at
+        with self._lock:
+            if self._fetched_at != seen:
+                return self._certs
+            with urllib.request.urlopen(
+                    self.url, timeout=CERT_FETCH_TIMEOUT) as resp:
+                certs   = json.loads(resp.read().decode("utf-8"))
+                max_age = _max_age(resp.headers)
+            now = time.monotonic()
+            self._certs      = certs
+            self._max_age    = max_age
+            self._expires    = now + max_age
+            self._fetched_at = now
+        metrics.incr("gapi.certs.refresh")
+        return certs
+
+    def get(self, kid=None):
+        '''
+            Arguments:  kid (the key id a token was signed with, or None)
+            Returns:    the certs, as {key id: PEM certificate}
+            Throws:     OSError or ValueError if they had to be fetched and
+                        couldn't be
+        '''
+        certs = self._certs
+        now   = time.monotonic()
+        if certs is None or now >= self._expires:
+            return self.refresh()
+        if (kid is not None and kid not in certs
+                and now - self._fetched_at >= CERT_FORCE_INTERVAL):
+            metrics.incr("gapi.certs.unknown_kid")
+            return self.refresh()
+        return certs
+
+    def _refresher(self):
+        delay, retry = 0, CERT_RETRY_MIN
+        while not self._stop.wait(delay):
+            try:
+                self.refresh()
+            except (OSError, ValueError) as e:
+                metrics.incr("gapi.certs.failure")
+                logger.warning("couldn't refresh Google's certs, retrying in"
+                               " {}s: {!r}".format(retry, e))
+                delay, retry = retry, min(retry * 2, CERT_RETRY_MAX)
+                continue
+            retry = CERT_RETRY_MIN
+            delay = max(self._max_age * CERT_REFRESH_AHEAD, CERT_RETRY_MIN)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._refresher,
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class TokenCache():
+    '''
+        Claims of ID tokens which have passed signature verification, keyed
+            by the token's SHA-256 and kept until the token's exp; the least
+            recently used is dropped first once there are more than size.
+    '''
+
+    def __init__(self, size=TOKEN_CACHE_SIZE):
+        self.size     = size
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def get(self, token):
+        '''
+            Returns:    a copy of the token's claims, or None
+        '''
+        key = self._key(token)
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is not None and claims["exp"] <= time.time():
+                del self._entries[key]
+                claims = None
+            if claims is None:
+                metrics.incr("gapi.token_cache.miss")
+                return None
+            self._entries.move_to_end(key)
+        metrics.incr("gapi.token_cache.hit")
+        return dict(claims)
+
+    def put(self, token, claims):
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = dict(claims)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+certs       = CertStore()
+token_cache = TokenCache()
+
+
+def verify_id_token(token, audience, cert_store=None, cache=None):
+    '''
+        Arguments:  token (a string), audience (our client ID), cert_store (a
+                    CertStore, defaulting to certs), cache (a TokenCache,
+                    defaulting to token_cache)
+        Returns:    the token's claims (a fresh dict the caller may change)
+        Throws:     crypt.AppIdentityError for a bad token, and OSError or
+                    ValueError if the certs can't be fetched
+
+        Like client.verify_id_token, but a token seen before skips the RSA
+            check, and the certs come from memory instead of being fetched
+            for every token.
+    '''
+    cert_store = certs if cert_store is None else cert_store
+    cache      = token_cache if cache is None else cache
+
+    claims = cache.get(token)
+    if claims is not None:
+        return claims
+    claims = crypt.verify_signed_jwt_with_certs(
+        token, cert_store.get(_key_id(token)), audience
+    )
+    cache.put(token, claims)
+    return dict(claims)
+
 
 def _validate_gapi_token(token):
     import api_helper
-    idinfo = client.verify_id_token(token, api_helper.API_CLIENT_ID)
+    idinfo = verify_id_token(token, api_helper.API_CLIENT_ID)
     now = anticsrf.microtime()
 
     for key in ["exp", "iat"]:
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+import itertools
+import os
+import threading
+
+import metrics
+
+
+class FrozenDict(dict):
+    '''
+        A dict which refuses to be changed after it is built, so one parsed
+            database can be shared by every reader. It is still a dict, so it
+            serialises to JSON like one.
+    '''
+
+    def _frozen(self, *args, **kwargs):
+        raise TypeError("cached database snapshots are read-only")
+
+    __setitem__ = __delitem__ = __ior__ = _frozen
+    clear = pop = popitem = setdefault = update = _frozen
+
+
+def freeze(obj):
+    '''
+        Arguments:  obj (anything that came out of json.load)
+        Returns:    a read-only copy; dicts become FrozenDicts and lists become
+                    tuples
+        Throws:     no
+    '''
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+class _Entry():
+    def __init__(self, stamp, value, version):
+        self.stamp   = stamp
+        self.value   = value
+        self.version = version
+
+
+class DBCache():
+    '''
+        Parsed JSON databases kept in memory, keyed by database name.
+
+        Every get() stats the file; the cached snapshot is used while the
+            file's (mtime, inode, size) are unchanged, and the file is parsed
+            again (by exactly one thread) when they change. Renaming a new
+            file into place, as util/update_elevated_ids does, changes the
+            inode, so it is always noticed.
+    '''
+
+    def __init__(self, path_of, loader):
+        self._path_of = path_of
+        self._loader  = loader
+        self._entries = {}
+        self._locks   = {}
+        self._lock    = threading.Lock()
+        # versions are never reused, even after invalidate(), so anything
+        # keyed on one can't be mistaken for a later load
+        self._versions = itertools.count(1)
+
+    def _stamp(self, name):
+        st = os.stat(self._path_of(name))
+        return st.st_mtime_ns, st.st_ino, st.st_size
+
+    def _name_lock(self, name):
+        with self._lock:
+            lock = self._locks.get(name)
+            if lock is None:
+                lock = self._locks[name] = threading.Lock()
+            return lock
+
+    def get(self, name):
+        '''
+            Arguments:  name (a string; a database name like "menu")
+            Returns:    the frozen contents of the database
+            Throws:     OSError if the file is missing, and whatever the loader
+                        throws for a bad file
+            Effects:    may read the file; counts a hit, miss or reload
+        '''
+        entry = self._entries.get(name)
+        stamp = self._stamp(name)
+        if entry is not None and entry.stamp == stamp:
+            metrics.incr("json_cache.hit")
+            return entry.value
+
+        with self._name_lock(name):
+            # somebody else may have reloaded it while we waited
+            entry = self._entries.get(name)
+            stamp = self._stamp(name)
+            if entry is not None and entry.stamp == stamp:
+                metrics.incr("json_cache.hit")
+                return entry.value
+
+            metrics.incr("json_cache.miss" if entry is None
+                         else "json_cache.reload")
+            value   = freeze(self._loader(name))
+            self._entries[name] = _Entry(stamp, value, next(self._versions))
+            return value
+
+    def version(self, name):
+        '''
+            Arguments:  name (a string)
+            Returns:    an int which goes up every time the database is
+                        reloaded, or 0 if it isn't loaded
+            Throws:     no
+        '''
+        entry = self._entries.get(name)
+        return 0 if entry is None else entry.version
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
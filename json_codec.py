@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import json
+import os
+from collections import namedtuple
+
+import coloredlogs
+import logging
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("json_codec")
+
+# libraries to try, fastest first; setting JSON_CODEC in the environment to one
+# of these names forces it
+PREFERENCE = ("orjson", "rapidjson", "ujson", "json")
+
+# what every codec's loads throws for bad input, invalid UTF-8 included
+DecodeError = ValueError
+
+# loads: bytes or str -> object
+# dumps: object -> compact UTF-8 bytes; throws TypeError for objects which
+#        aren't JSON-serialisable
+Codec = namedtuple("Codec", ["name", "loads", "dumps"])
+
+
+def _std_loads(raw):
+    # the stdlib only takes bytes from Python 3.6 on
+    if isinstance(raw, (bytes, bytearray)):
+        raw = raw.decode("utf-8")
+    return json.loads(raw)
+
+
+def _std_dumps(obj):
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def _with_fallback(fast_dumps):
+    # the fast libraries refuse a few things the stdlib takes, like integers
+    # over 64 bits or non-string keys, so those go the slow way instead
+    def dumps(obj):
+        try:
+            return fast_dumps(obj)
+        except (TypeError, OverflowError, ValueError):
+            return _std_dumps(obj)
+    return dumps
+
+
+def get(name):
+    '''
+        Arguments:  name (a string from PREFERENCE)
+        Returns:    that library's Codec
+        Throws:     ImportError if the library isn't installed, KeyError for an
+                    unknown name
+    '''
+    if name == "orjson":
+        import orjson
+        return Codec(name, orjson.loads, _with_fallback(orjson.dumps))
+
+    if name == "rapidjson":
+        import rapidjson
+        return Codec(name, rapidjson.loads, _with_fallback(
+            lambda obj: rapidjson.dumps(obj, ensure_ascii=False)
+            .encode("utf-8")
+        ))
+
+    if name == "ujson":
+        import ujson
+        return Codec(name, ujson.loads, _with_fallback(
+            lambda obj: ujson.dumps(obj, ensure_ascii=False,
+                                    escape_forward_slashes=False)
+            .encode("utf-8")
+        ))
+
+    if name == "json":
+        return Codec(name, _std_loads, _std_dumps)
+
+    raise KeyError("unknown JSON codec: {}".format(name))
+
+
+def available():
+    '''
+        Returns:    a Codec for every installed library, fastest first
+    '''
+    out = []
+    for name in PREFERENCE:
+        try:
+            out.append(get(name))
+        except ImportError:
+            pass
+    return out
+
+
+def _pick():
+    forced = os.environ.get("JSON_CODEC")
+    if forced:
+        return get(forced)
+    return available()[0]
+
+
+codec = _pick()
+logger.info("using {} for JSON".format(codec.name))
+
+loads = codec.loads
+dumps = codec.dumps
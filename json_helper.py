@@ -1,12 +1,18 @@
 #!/usr/bin/env python3
 from os import path
 # import jsonschema
-import pickledb
 import coloredlogs
 import logging
+import threading
 import time
 import transactor.transactor as transactor
 
+import file_lock
+import json_cache
+import json_codec
+import order_archive
+import order_log
+
 coloredlogs.install(
     level="NOTSET",
     fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
@@ -26,6 +32,9 @@ JSON_FILES = [
 JSON_DIR = "json"
 JSON_EXT = ".json"
 
+ORDERS_LOG  = path.join(JSON_DIR, "orders.log")
+ARCHIVE_DIR = path.join(JSON_DIR, "archive")
+
 ###############################################################################
 
 
@@ -33,24 +42,88 @@ def _is_stop_iteration(x):
     return x[~read_clerk._field.STOP_ITERATION] == "STOPITER"
 
 
+def db_path(dbname):
+    return path.join(JSON_DIR, dbname) + JSON_EXT
+
+
+def _load_db(dbname):
+    # a tool rewriting the file holds its lock while it reads and changes it
+    return json_codec.loads(file_lock.read(db_path(dbname)))
+
+
+# parsed databases, reloaded only when their files change on disk; readers
+# share the same read-only snapshot
+db_cache = json_cache.DBCache(db_path, _load_db)
+
+# the orders database lives in memory and in order_log's append-only log;
+# orders.json on disk lags behind until the next compaction
+_orders      = None
+_orders_lock = threading.Lock()
+
+# whether other processes use the same databases at once
+_shared = False
+
+
+def configure(shared=False):
+    '''
+        Arguments:  shared (a bool; True when several server processes use
+                    the json/ directory at once)
+        Returns:    None
+        Throws:     no
+        Effects:    sets how the orders database is opened; call before the
+                    first request
+    '''
+    global _shared
+    _shared = shared
+
+
+def orders_db():
+    global _orders
+    with _orders_lock:
+        if _orders is None:
+            _orders = order_log.OrderLog(
+                db_path("orders"), ORDERS_LOG,
+                archive=order_archive.OrderArchive(ARCHIVE_DIR),
+                shared=_shared
+            )
+            _orders.start()
+        return _orders
+
+
 class RF():
     def dgetall(req):
         dbname = req[~read_clerk._field.default_get]
-        db = pickledb.load(path.join(JSON_DIR, dbname) + JSON_EXT, False)
-        db_keys = db.getall()
-        return {key: db.dgetall(key) for key in db_keys}
+        if dbname == "orders":
+            return orders_db().snapshot()
+        return db_cache.get(dbname)
 
+    def view_orders(req):
+        return orders_db().page(**req["data"])
 
+
+# write actions return their result and a function which blocks until the
+# write is durable; register_write calls it from the client's thread
 class WF():
-    pass
+    def open_order(req):
+        return orders_db().open_order(req["data"])
+
+    def close_order(req):
+        return orders_db().close_order(req["data"]["sort_id"],
+                                       owner=req["data"].get("owner"))
 
 
 def read_arbiter(x):
+    global _reading
     req = x[~read_clerk._field.request]
     if _is_stop_iteration(req):
         return "STOPITER", 500
+    _reading = req[~read_clerk._field.uuid]
     fun = RF.__getattribute__(RF, req["action"])
-    res = fun(req)
+    try:
+        res = fun(req)
+    except (KeyError, OSError, ValueError) as e:
+        logger.error("read failed: {!r}".format(e))
+        return repr(e), 500
     return res, 200
 
 
@@ -58,8 +131,20 @@ def write_arbiter(x):
     req = x[~read_clerk._field.request]
     if _is_stop_iteration(req):
         return "STOPITER", 500
-    fun = WF.__getattribute__(WF, req["action"])
-    res = fun(req)
+    _batch_uuids.append(req[~write_clerk._field.uuid])
+    # nothing may take the writer thread down with it, or every later write
+    # would wait forever
+    try:
+        fun = WF.__getattribute__(WF, req["action"])
+        res = fun(req)
+    except PermissionError as e:
+        return repr(e), 403
+    except (KeyError, TypeError, ValueError) as e:
+        return repr(e), 400
+    except Exception as e:
+        # the disk (a full one, say) rather than the request
+        logger.exception("write failed")
+        return repr(e), 500
     return res, 200
 
 ###############################################################################
@@ -68,33 +153,133 @@ def write_arbiter(x):
 read_clerk = transactor.read_clerk()
 write_clerk = transactor.write_clerk()
 
-DB_THREAD_YIELD = .4
+# each clerk has a condition which is notified when a request is registered,
+# waking the server thread; whoever registered it waits on its own Event
+# (_read_events, _write_events), so nobody sleeps or spins waiting on the other
+read_cond  = threading.Condition()
+write_cond = threading.Condition()
+
+# once a write arrives, the writer waits up to WRITE_BATCH_WINDOW seconds for
+# others to join it, then applies at most WRITE_BATCH_MAX writes and persists
+# them all with one fsync; the wait is skipped when the last batch was a lone
+# write, so a single client isn't slowed down for nothing. This is the one
+# group commit orders get (OrderLog has no timer of its own), so these two
+# set how long a write waits to be durable
+WRITE_BATCH_WINDOW = .002
+WRITE_BATCH_MAX    = 128
+
+# writes registered by register_write and not yet served; guarded by
+# write_cond
+_writes_waiting = 0
+
+# uuid -> Event for each write whose caller is waiting; the writer sets them
+# once the batch holding that write is durable, so a finished batch wakes only
+# its own callers
+_write_events = {}
+
+# uuids served in the batch being applied; only touched by the writer thread
+_batch_uuids = []
+
+# time.monotonic() when the batch being applied began, or None between
+# batches; see write_stalled
+_batch_began = None
+
+# seconds register_write waits for the writer before giving up on it; only a
+# stuck writer thread takes anywhere near this long
+WRITE_TIMEOUT = 30
+
+# uuid -> Event for each read whose caller is waiting; the reader sets only
+# that one once the read is served, so callers waiting on other reads sleep
+# on
+_read_events = {}
+
+# the uuid of the read being served; only touched by the reader thread
+_reading = None
+
+
+def notify(cond):
+    with cond:
+        cond.notify_all()
 
 
 # the read server takes an action and gives back some data
 def read_server():
     logger.info("database reader thread init")
     while True:
-        time.sleep(DB_THREAD_YIELD)
+        with read_cond:
+            read_cond.wait_for(lambda: read_clerk.have_waiting()[0])
 
-        res = read_clerk.do_serve_request(spin=False, func=read_arbiter)
+        res  = read_clerk.do_serve_request(spin=False, func=read_arbiter)
+        done = _read_events.pop(_reading, None)
+        if done is not None:
+            done.set()
         if res and "STOPITER" == res[0]: break
-        if not read_clerk.have_waiting()[0]: time.sleep(0)
-        # else: logger.debug("serving another read request")
     logger.critical("goodbye, reader")
 
 
+def _collect_batch(last_batch):
+    with write_cond:
+        write_cond.wait_for(lambda: write_clerk.have_waiting()[0])
+        if last_batch <= 1:
+            return
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while _writes_waiting < WRITE_BATCH_MAX:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            write_cond.wait(left)
+
+
 # the write server takes an action and some data and gives only a status
 def write_server():
+    global _writes_waiting, _batch_began
     logger.info("database writer thread init")
-    while True:
-        time.sleep(DB_THREAD_YIELD)
-        res = write_clerk.do_serve_request(spin=False, func=write_arbiter)
-        if res and "STOPITER" == res[0]: break
-        if not write_clerk.have_waiting()[0]: time.sleep(0)
+    stop   = False
+    served = 0
+    while not stop:
+        _collect_batch(served)
+
+        # apply every waiting write (up to the cap) in one pass, each with its
+        # own status, then make the whole batch durable with one sync
+        served       = 0
+        _batch_began = time.monotonic()
+        try:
+            while served < WRITE_BATCH_MAX and write_clerk.have_waiting()[0]:
+                res = write_clerk.do_serve_request(spin=False,
+                                                   func=write_arbiter)
+                if res and "STOPITER" == res[0]:
+                    stop = True
+                    break
+                served += 1
+
+            if _orders is not None:
+                _orders.sync()
+        except Exception:
+            # each caller finds out from its own durable() or status
+            logger.exception("write batch failed")
+        finally:
+            _batch_began = None
+            with write_cond:
+                _writes_waiting = max(0, _writes_waiting - served)
+            for uuid in _batch_uuids:
+                ev = _write_events.pop(uuid, None)
+                if ev is not None:
+                    ev.set()
+            del _batch_uuids[:]
     logger.critical("goodbye, writer")
 
 
+def write_stalled():
+    '''
+        Returns:    whether the writer has been applying one batch for longer
+                    than WRITE_TIMEOUT, so that every write waiting on it gets
+                    a 503
+        Throws:     no
+    '''
+    began = _batch_began
+    return began is not None and time.monotonic() - began > WRITE_TIMEOUT
+
+
 ###############################################################################
 # json api follows
 
@@ -111,56 +296,144 @@ def kill_all_threads():
         ~read_clerk._field.default_get: "",
         ~read_clerk._field.STOP_ITERATION: "STOPITER"  # noqa
     }
-    for c in [read_clerk, write_clerk]:
-        time.sleep(0)
+    for c, cond in [(read_clerk, read_cond), (write_clerk, write_cond)]:
         c.impl_register_request(req)
+        notify(cond)
+    with _orders_lock:
+        orders = _orders
+    if orders is not None:
+        orders.stop()
     # dead threads tell no tales
 
 # when a file gets too large to ask python to reasonably open,
 # it should be moved to a new file called filename-<DATE_MOVED>.json.old
+# (order_archive does this for closed orders)
 
 
 def test_client():
     import random
     keys = ()
+    done = {}
     for i in range(3):
         keys += transactor.random_key(10),
         nice = random.choice(list(transactor.priority))
+        done[keys[i]] = _read_events[keys[i]] = threading.Event()
         read_clerk.register_read({
             ~read_clerk._field.uuid: keys[i],
             ~read_clerk._field.nice: nice,
             ~read_clerk._field.default_get: "users",
             ~read_clerk._field.STOP_ITERATION: "continue"  # noqa
         })
-        time.sleep(0)
-    time.sleep(.2)
-    # come back later
+        notify(read_cond)
     for key in keys:
+        done[key].wait()
         print(
             str(read_clerk.get_response(key)) + "\t" +
             str(read_clerk.get_status(key))
         )
 
 
-def all_entires(db_name):
+def register_read(db_name, action, data=None):
     uuid = transactor.random_key()
     req = {
         ~transactor.request_clerk._field.uuid: uuid,
         ~transactor.request_clerk._field.nice: transactor.priority.normal,
         ~transactor.request_clerk._field.default_get: db_name,
         ~transactor.request_clerk._field.STOP_ITERATION: "continue",
-        "action": "dgetall"
+        "action": action,
+        "data": data
     }
+    done = _read_events[uuid] = threading.Event()
     read_clerk.register_read(req)
-    time.sleep(0)
-    status = read_clerk.get_status(uuid, keep=True)
-    while status is None:
-        time.sleep(0)
-        status = read_clerk.get_status(uuid, keep=True)
+    notify(read_cond)
+    done.wait()
 
     return read_clerk.get_response(uuid), read_clerk.get_status(uuid)
 
 
+def all_entires(db_name):
+    return register_read(db_name, "dgetall")
+
+
+def db_version(db_name):
+    '''
+        Arguments:  db_name (a string; not "orders")
+        Returns:    the version of the database as it is on disk now, or 0 if
+                    it can't be read
+        Throws:     no
+        Effects:    stats the file, and loads it if it changed
+
+        Lets the server tell whether a cached reply is still current without
+            going through the reader thread.
+    '''
+    try:
+        db_cache.get(db_name)
+    except (OSError, ValueError):
+        return 0
+    return db_cache.version(db_name)
+
+
+def view_orders(age, limit, newest_first, after=None, states=None,
+                since=None, until=None):
+    '''
+        Arguments:  as for order_log.OrderLog.page
+        Returns:    a page of orders ({"orders": [...], "next": key or None}),
+                    and a status
+        Throws:     no
+    '''
+    return register_read("orders", "view_orders", {
+        "age": age, "limit": limit, "newest_first": newest_first,
+        "after": after, "states": states, "since": since, "until": until
+    })
+
+
+def register_write(db_name, action, data):
+    '''
+        Arguments:  db_name (a string), action (the name of a WF function),
+                    data (a dict)
+        Returns:    the action's result and status: 200, or an error
+                    description with 400 for a bad request, 403 if it isn't
+                    the caller's to make, 500 if it
+                    couldn't be written, or 503 if the writer didn't answer
+                    within WRITE_TIMEOUT (the write may yet happen)
+        Throws:     no
+        Effects:    queues the write with write_clerk and blocks until it has
+                    been applied and is on disk
+    '''
+    global _writes_waiting
+    uuid = transactor.random_key()
+    req = {
+        ~transactor.request_clerk._field.uuid: uuid,
+        ~transactor.request_clerk._field.nice: transactor.priority.normal,
+        ~transactor.request_clerk._field.default_get: db_name,
+        ~transactor.request_clerk._field.STOP_ITERATION: "continue",
+        "action": action,
+        "data": data
+    }
+    done = _write_events[uuid] = threading.Event()
+    write_clerk.impl_register_request(req)
+    with write_cond:
+        _writes_waiting += 1
+        write_cond.notify_all()
+    if not done.wait(WRITE_TIMEOUT):
+        _write_events.pop(uuid, None)
+        logger.error("no answer from the writer in {}s".format(WRITE_TIMEOUT))
+        return "the database writer is not answering", 503
+
+    res, status = write_clerk.get_response(uuid), write_clerk.get_status(uuid)
+    if status is None:
+        return "the write was lost", 500
+    if status != 200:
+        return res, status
+    result, durable = res
+    try:
+        durable()
+    except OSError as e:
+        logger.error("write not made durable: {!r}".format(e))
+        return repr(e), 500
+    return result, status
+
+
 def get_elevated_ids():
     return all_entires("elevated_ids")
 
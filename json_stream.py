@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import json
+
+import json_codec
+
+# bytes of JSON gathered before a chunk is handed to the writer
+CHUNK_SIZE = 16 * 1024
+
+# containers this close to the top, or at least this long, are split and
+# streamed a piece at a time; anything smaller is encoded in one go by
+# json_codec, which is much faster than the stdlib's pure-Python iterencode
+SPLIT_DEPTH = 2
+SPLIT_LEN   = 64
+
+_pretty = json.JSONEncoder(indent=2)
+
+
+def _split(obj, depth):
+    if depth < SPLIT_DEPTH:
+        return True
+    try:
+        return len(obj) >= SPLIT_LEN
+    except TypeError:
+        return False
+
+
+def _pieces(obj, depth):
+    if (isinstance(obj, dict) and _split(obj, depth)
+            and all(isinstance(k, str) for k in obj)):
+        yield b"{"
+        sep = b""
+        for k, v in obj.items():
+            yield sep + json_codec.dumps(k) + b":"
+            yield from _pieces(v, depth + 1)
+            sep = b","
+        yield b"}"
+
+    elif isinstance(obj, (list, tuple)) and _split(obj, depth):
+        yield b"["
+        sep = b""
+        for v in obj:
+            if sep:
+                yield sep
+            yield from _pieces(v, depth + 1)
+            sep = b","
+        yield b"]"
+
+    else:
+        yield json_codec.dumps(obj)
+
+
+def iter_json(obj, pretty=False, chunk_size=CHUNK_SIZE):
+    '''
+        Arguments:  obj (JSON-serialisable), pretty (a bool), chunk_size (an
+                    int)
+        Returns:    a generator of bytes, each about chunk_size long, which
+                    together are obj as UTF-8 JSON
+        Throws:     TypeError, from the generator, if obj isn't serialisable
+
+        Output is compact unless pretty is set, in which case it matches
+            json.dumps(obj, indent=2). Only about one chunk of output exists at
+            a time.
+    '''
+    if pretty:
+        pieces = (p.encode("utf-8") for p in _pretty.iterencode(obj))
+    else:
+        pieces = _pieces(obj, 0)
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield b"".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b"".join(buf)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import threading
+
+# name -> int for counters and gauges, or name -> dict for timings
+_lock   = threading.Lock()
+_values = {}
+
+
+def incr(name, n=1):
+    with _lock:
+        _values[name] = _values.get(name, 0) + n
+
+
+def gauge(name, value):
+    with _lock:
+        _values[name] = value
+
+
+def observe(name, value):
+    '''
+        Arguments:  name (a string), value (a number, usually seconds)
+        Returns:    None
+        Throws:     no
+        Effects:    updates the count, total and max kept for name
+
+        Record one sample of something like a latency.
+    '''
+    with _lock:
+        rec = _values.get(name)
+        if rec is None:
+            rec = _values[name] = {"count": 0, "total": 0, "max": 0}
+        rec["count"] += 1
+        rec["total"] += value
+        if value > rec["max"]:
+            rec["max"] = value
+
+
+def get(name, default=0):
+    with _lock:
+        return _values.get(name, default)
+
+
+def snapshot():
+    with _lock:
+        return {
+            k: (dict(v) if isinstance(v, dict) else v)
+            for k, v in _values.items()
+        }
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# latency of json_helper.all_entires("menu"), first with the old reader loop
+# (sleep DB_THREAD_YIELD between polls, caller spins on get_status), then
+# with every caller waiting on read_cond (each served read wakes them all),
+# and then with json_helper's reader, which wakes only the read's own caller;
+# the last two also with CALLERS callers at once
+# run from the project root: python3 misc/bench_all_entires.py
+import sys
+import threading
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import json_helper  # noqa
+import transactor.transactor as transactor  # noqa
+
+from loadtest import percentile  # noqa
+
+N = 25
+CALLERS = 32
+DB_THREAD_YIELD = .4
+read_clerk = json_helper.read_clerk
+read_cond  = json_helper.read_cond
+
+
+def old_read_server():
+    while True:
+        time.sleep(DB_THREAD_YIELD)
+        res = read_clerk.do_serve_request(
+            spin=False, func=json_helper.read_arbiter
+        )
+        if res and "STOPITER" == res[0]: break
+        if not read_clerk.have_waiting()[0]: time.sleep(0)
+
+
+def old_all_entires(db_name):
+    uuid = transactor.random_key()
+    req = {
+        ~transactor.request_clerk._field.uuid: uuid,
+        ~transactor.request_clerk._field.nice: transactor.priority.normal,
+        ~transactor.request_clerk._field.default_get: db_name,
+        ~transactor.request_clerk._field.STOP_ITERATION: "continue",
+        "action": "dgetall"
+    }
+    read_clerk.register_read(req)
+    time.sleep(0)
+    status = read_clerk.get_status(uuid, keep=True)
+    while status is None:
+        time.sleep(0)
+        status = read_clerk.get_status(uuid, keep=True)
+    return read_clerk.get_response(uuid), read_clerk.get_status(uuid)
+
+
+def cond_read_server():
+    while True:
+        with read_cond:
+            read_cond.wait_for(lambda: read_clerk.have_waiting()[0])
+        res = read_clerk.do_serve_request(
+            spin=False, func=json_helper.read_arbiter
+        )
+        json_helper.notify(read_cond)
+        if res and "STOPITER" == res[0]: break
+
+
+def cond_all_entires(db_name):
+    uuid = transactor.random_key()
+    req = {
+        ~transactor.request_clerk._field.uuid: uuid,
+        ~transactor.request_clerk._field.nice: transactor.priority.normal,
+        ~transactor.request_clerk._field.default_get: db_name,
+        ~transactor.request_clerk._field.STOP_ITERATION: "continue",
+        "action": "dgetall"
+    }
+    read_clerk.register_read(req)
+    json_helper.notify(read_cond)
+    with read_cond:
+        read_cond.wait_for(
+            lambda: read_clerk.get_status(uuid, keep=True) is not None
+        )
+    return read_clerk.get_response(uuid), read_clerk.get_status(uuid)
+
+
+def stop_reader(thread):
+    read_clerk.impl_register_request({
+        ~read_clerk._field.uuid: transactor.random_key(10),
+        ~read_clerk._field.nice: transactor.priority.normal,
+        ~read_clerk._field.default_get: "",
+        ~read_clerk._field.STOP_ITERATION: "STOPITER"
+    })
+    json_helper.notify(json_helper.read_cond)
+    thread.join()
+
+
+def measure(name, server, fetch, callers=1):
+    thread = threading.Thread(target=server, daemon=True)
+    thread.start()
+    times = []
+
+    def caller():
+        for _ in range(N):
+            start = time.perf_counter()
+            fetch("menu")
+            times.append(time.perf_counter() - start)
+
+    cpu     = time.process_time()
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    cpu = time.process_time() - cpu
+    stop_reader(thread)
+    print("{:>10} x{:<3}: mean {:8.3f} ms  p99 {:8.3f} ms  cpu {:6.3f} s"
+          .format(name, callers, sum(times) / len(times) * 1e3,
+                  percentile(times, 99) * 1e3, cpu))
+
+
+def main():
+    measure("polling", old_read_server, old_all_entires)
+    for callers in (1, CALLERS):
+        measure("condition", cond_read_server, cond_all_entires, callers)
+        measure("event", json_helper.read_server, json_helper.all_entires,
+                callers)
+
+
+if __name__ == "__main__":
+    main()
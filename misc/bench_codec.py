@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# parse (from bytes) and compact-encode every json/*.json fixture with each
+# JSON library json_codec can find, and report the time per round trip
+# run from the project root: python3 misc/bench_codec.py [--rounds 2000]
+import argparse
+import glob
+import sys
+import time
+from os import path
+
+from loadtest import ROOT
+
+sys.path.insert(0, ROOT)
+
+import json_codec  # noqa
+
+
+def timed(fun, arg, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fun(arg)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    fixtures = sorted(glob.glob(path.join(ROOT, "json", "*.json")))
+    codecs   = json_codec.available()
+    print("{:>18} ".format("") + "".join(
+        "{:>22}".format(c.name) for c in codecs))
+    print("{:>18} ".format("") + "".join(
+        "{:>11}{:>11}".format("loads us", "dumps us") for c in codecs))
+
+    for fpath in fixtures:
+        with open(fpath, "rb") as f:
+            raw = f.read()
+        obj = json_codec.get("json").loads(raw)
+        row = "{:>18} ".format(path.basename(fpath))
+        for c in codecs:
+            row += "{:>11.2f}{:>11.2f}".format(
+                timed(c.loads, raw, args.rounds) * 1e6,
+                timed(c.dumps, obj, args.rounds) * 1e6
+            )
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
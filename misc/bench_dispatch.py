@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# compare the cost of finding a verb's function the old way (reflecting over
+# api_helper on every request) against the VERBS table
+# run from the project root: python3 misc/bench_dispatch.py
+import re
+import sys
+import timeit
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import api_helper  # noqa
+
+N = 20000
+
+
+def old_dispatch(verbstr):
+    attrs       = dir(api_helper)
+    replyfun_re = re.compile(r"^reply_[a-z_0-9]+$")
+    filattrs    = list(filter(
+        lambda s: None is not re.match(replyfun_re, s),
+        attrs
+    ))
+
+    verbnames   = ("_".join( fn.split("_") [1:] )   for fn in filattrs)
+    funcs       = (eval("api_helper.{}".format(fn)) for fn in filattrs)
+
+    return dict(zip(verbnames, funcs)).get(verbstr)
+
+
+def new_dispatch(verbstr):
+    return api_helper.VERBS.get(verbstr)
+
+
+def main():
+    assert old_dispatch("view_menu") is new_dispatch("view_menu").func
+    for name, fun in [("reflection", old_dispatch), ("table", new_dispatch)]:
+        secs = timeit.timeit(lambda: fun("view_menu"), number=N)
+        print("{:>10}: {:8.3f} us/lookup".format(name, secs / N * 1e6))
+
+
+if __name__ == "__main__":
+    main()
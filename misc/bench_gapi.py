@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# time verifying the same Google ID token over and over: the old way
+# (client.verify_id_token, which goes through httplib2's cache for the certs
+# and checks the RSA signature every time) and through gapi_auth's cert store
+# and token cache
+# a throwaway key and self-signed cert made with openssl stand in for
+# Google's, served from a local cert endpoint
+# run from the project root: python3 misc/bench_gapi.py [--rounds 200]
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+
+from loadtest import ROOT, percentile
+
+sys.path.insert(0, ROOT)
+
+import gapi_auth  # noqa
+from oauth2client import client, crypt  # noqa
+
+AUDIENCE = "bench-client-id"
+KEY_ID   = "bench"
+
+
+def make_key():
+    with tempfile.TemporaryDirectory() as tmp:
+        key, cert = path.join(tmp, "key.pem"), path.join(tmp, "cert.pem")
+        subprocess.run([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", cert, "-days", "1", "-subj", "/CN=bench"
+        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with open(key, "rb") as k, open(cert, "rb") as c:
+            return k.read(), c.read().decode("ascii")
+
+
+def serve_certs(cert_pem, fetches):
+    body = json.dumps({KEY_ID: cert_pem}).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            fetches.append(1)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Cache-Control", "public, max-age=3600")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}/certs".format(httpd.server_address[1])
+
+
+def measure(name, fun, token, rounds):
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fun(token)
+        times.append(time.perf_counter() - start)
+    print("{:>8}: first {:8.3f} ms  mean {:8.3f} ms  p99 {:8.3f} ms".format(
+        name, times[0] * 1e3, sum(times) / rounds * 1e3,
+        percentile(times, 99) * 1e3
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    key_pem, cert_pem = make_key()
+    fetches = []
+    url = serve_certs(cert_pem, fetches)
+
+    now   = int(time.time())
+    token = crypt.make_signed_jwt(crypt.Signer.from_string(key_pem), {
+        "iss": "accounts.google.com", "aud": AUDIENCE, "sub": "1",
+        "email": "someone@example.com", "iat": now, "exp": now + 3600,
+    }, key_id=KEY_ID).decode("ascii")
+
+    measure("old", lambda t: client.verify_id_token(t, AUDIENCE,
+                                                    cert_uri=url),
+            token, args.rounds)
+    print("{:>8}  {} cert fetches".format("", len(fetches)))
+    del fetches[:]
+
+    store, cache = gapi_auth.CertStore(url), gapi_auth.TokenCache()
+    measure("cached", lambda t: gapi_auth.verify_id_token(
+        t, AUDIENCE, cert_store=store, cache=cache
+    ), token, args.rounds)
+    print("{:>8}  {} cert fetches".format("", len(fetches)))
+
+
+if __name__ == "__main__":
+    main()
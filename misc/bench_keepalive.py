@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# time CORS preflight + POST pairs, opening a new connection for every request
+# (what "Connection: Close" forced) versus reusing one persistent connection
+# run from the project root: python3 misc/bench_keepalive.py [--mode pooled]
+# (no TLS here, so real-world savings per handshake are larger than this)
+# with --idle N, first leaves N kept-alive connections idle, like open browser
+# tabs, and times the pairs of a new client alongside them; in pooled mode
+# each idle connection holds a worker until worker_pool.KEEPALIVE_IDLE runs
+# out, so with N at or above --workers the new client waits that long
+import argparse
+import http.client
+import os
+import signal
+import subprocess
+import sys
+import time
+
+from loadtest import BODY, HEADERS, ROOT, free_port, percentile, \
+    wait_listening
+
+PREFLIGHT_HEADERS = {
+    "Origin": HEADERS["Origin"],
+    "Access-Control-Request-Method": "POST",
+    "Access-Control-Request-Headers": "content-type",
+}
+
+
+def pair(conn):
+    conn.request("OPTIONS", "/", headers=PREFLIGHT_HEADERS)
+    conn.getresponse().read()
+    conn.request("POST", "/", body=BODY, headers=HEADERS)
+    resp = conn.getresponse()
+    resp.read()
+    return resp
+
+
+def fresh_connections(port, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        for method, kw in [
+            ("OPTIONS", {"headers": PREFLIGHT_HEADERS}),
+            ("POST",    {"body": BODY, "headers": HEADERS}),
+        ]:
+            conn = http.client.HTTPConnection("127.0.0.1", port)
+            hdrs = dict(kw.pop("headers"), Connection="close")
+            conn.request(method, "/", headers=hdrs, **kw)
+            conn.getresponse().read()
+            conn.close()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def one_connection(port, n):
+    times = []
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    for _ in range(n):
+        start = time.perf_counter()
+        pair(conn)
+        times.append(time.perf_counter() - start)
+    conn.close()
+    return times
+
+
+def idle_tabs(port, n):
+    tabs = []
+    for _ in range(n):
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        pair(conn)
+        tabs.append(conn)
+    return tabs
+
+
+def beside_idle(port, n):
+    times, errors = [], 0
+    for _ in range(n):
+        start = time.perf_counter()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        if pair(conn).status != 200:
+            errors += 1
+        conn.close()
+        times.append(time.perf_counter() - start)
+    if errors:
+        print("{} pair(s) failed".format(errors))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="pooled")
+    parser.add_argument("--pairs", type=int, default=90)
+    parser.add_argument("--idle", type=int, default=0,
+                        help="idle kept-alive connections to open first")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    port = free_port()
+    extra = [] if args.workers is None else ["--workers", str(args.workers)]
+    proc = subprocess.Popen(
+        [sys.executable, "server.py", str(port), "--mode", args.mode]
+        + extra,
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_listening(port)
+        runs = [("new conns", fresh_connections),
+                ("keep-alive", one_connection)]
+        if args.idle:
+            tabs = idle_tabs(port, args.idle)
+            runs = [("{} idle".format(args.idle), beside_idle)]
+        for name, fun in runs:
+            times = fun(port, args.pairs)
+            print("{:>10}: mean {:6.3f} ms  p99 {:6.3f} ms per pair".format(
+                name,
+                sum(times) / len(times) * 1e3,
+                percentile(times, 99) * 1e3
+            ))
+    finally:
+        os.kill(proc.pid, signal.SIGTERM)
+        proc.wait()
+
+
+if __name__ == "__main__":
+    main()
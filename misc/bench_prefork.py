@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# ping requests per second against server.py with --processes 1, 2, 4, ...
+# up to the number of cores, from clients spread over as many processes so
+# the client side isn't held to one core by the GIL; the server's throughput
+# should grow with its processes until the cores (shared with the clients)
+# run out
+# run from the project root: python3 misc/bench_prefork.py [--mode pooled]
+import argparse
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from loadtest import ROOT, wait_listening, free_port, client, percentile
+
+
+def client_process(port, threads, count, results):
+    latencies, errors = [], []
+    pool = [
+        threading.Thread(target=client,
+                         args=(port, count, latencies, errors))
+        for _ in range(threads)
+    ]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put((latencies, len(errors)))
+
+
+def run(processes, mode, clients, threads, requests):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "server.py", str(port), "--mode", mode,
+         "--processes", str(processes)],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_listening(port)
+        results = multiprocessing.Queue()
+        count   = max(1, requests // (clients * threads))
+        pool    = [
+            multiprocessing.Process(target=client_process,
+                                    args=(port, threads, count, results))
+            for _ in range(clients)
+        ]
+        start = time.perf_counter()
+        for p in pool:
+            p.start()
+        got = [results.get() for _ in pool]
+        elapsed = time.perf_counter() - start
+        for p in pool:
+            p.join()
+    finally:
+        os.kill(proc.pid, signal.SIGTERM)
+        proc.wait()
+
+    latencies = [lat for lats, _ in got for lat in lats]
+    errors    = sum(e for _, e in got)
+    if not latencies:
+        print("{:>3} processes: every request failed".format(processes))
+        return
+    print("{:>3} processes: {:8.1f} req/s  p50 {:7.2f} ms  p99 {:7.2f} ms"
+          "  errors {}".format(
+              processes, len(latencies) / elapsed,
+              percentile(latencies, 50) * 1e3,
+              percentile(latencies, 99) * 1e3, errors))
+
+
+def main():
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", default="pooled")
+    parser.add_argument("--clients", type=int, default=cores,
+                        help="client processes")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="threads in each client process")
+    parser.add_argument("--requests", type=int, default=8000)
+    args = parser.parse_args()
+
+    counts, n = [], 1
+    while n < cores:
+        counts.append(n)
+        n *= 2
+    counts.append(cores)
+    print("{} cores".format(cores))
+    for processes in counts:
+        run(processes, args.mode, args.clients, args.threads, args.requests)
+
+
+if __name__ == "__main__":
+    main()
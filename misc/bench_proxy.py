@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# SOP Buster's upstream fetches from 1 and 16 threads against a stand-in
+# upstream server in another process: the old way (a new connection per
+# request through requests, or http.client if requests isn't installed, with
+# the whole body read into memory) and through proxy.Proxy's pooled
+# keep-alive connections, streaming the body; then the most memory each way
+# held at once for one large body
+# run from the project root: python3 misc/bench_proxy.py [--size 262144]
+import argparse
+import http.client
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+from socketserver import ThreadingMixIn
+
+from loadtest import ROOT, wait_listening, free_port, percentile
+
+sys.path.insert(0, ROOT)
+
+import proxy  # noqa
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+
+def upstream(port, size):
+    body = b"x" * size
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    # http.server.ThreadingHTTPServer is only in Python 3.7
+    class Upstream(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    Upstream(("127.0.0.1", port), Handler).serve_forever()
+
+
+def old_fetch(url):
+    if requests is not None:
+        return len(requests.get(url).content)
+    parts = url.split("/", 3)
+    conn  = http.client.HTTPConnection(parts[2], timeout=30)
+    conn.request("GET", "/" + parts[3])
+    data = conn.getresponse().read()
+    conn.close()
+    return len(data)
+
+
+def make_pooled_fetch():
+    pool = proxy.Proxy()
+
+    def fetch(url):
+        return sum(len(chunk) for chunk in pool.request("GET", url))
+    return fetch
+
+
+def run(fetch, url, threads, count):
+    latencies = []
+    lock      = threading.Lock()
+
+    def client():
+        for _ in range(count):
+            start = time.perf_counter()
+            fetch(url)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    pool  = [threading.Thread(target=client) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    return len(latencies) / (time.perf_counter() - start), latencies
+
+
+def peak_memory(fetch, url):
+    tracemalloc.start()
+    fetch(url)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256 * 1024)
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--upstream", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.upstream:
+        upstream(int(args.upstream[0]), int(args.upstream[1]))
+        return
+
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, path.abspath(__file__), "--upstream", str(port),
+         str(args.size)],
+        cwd=ROOT
+    )
+    try:
+        wait_listening(port)
+        url  = "http://127.0.0.1:{}/body".format(port)
+        ways = [
+            ("requests" if requests is not None else "new conn", old_fetch),
+            ("pooled", make_pooled_fetch()),
+        ]
+        for threads in [1, 16]:
+            for name, fetch in ways:
+                rate, lat = run(fetch, url, threads, args.count // threads)
+                print("{:>2} threads {:>8}: {:8.1f} req/s  p50 {:7.2f} ms"
+                      "  p99 {:7.2f} ms".format(
+                          threads, name, rate, percentile(lat, 50) * 1e3,
+                          percentile(lat, 99) * 1e3))
+
+        for name, fetch in ways:
+            print("{:>11}: peak {:8.1f} KB held for a {} KB body".format(
+                name, peak_memory(fetch, url) / 1024, args.size // 1024))
+    finally:
+        proc.terminate()
+
+
+if __name__ == "__main__":
+    main()
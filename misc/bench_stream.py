@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# peak RSS and time-to-first-byte of a 50k-order reply, written the old way
+# (json.dumps with indent, str -> bytes, whole body logged) and streamed with
+# Server.write_json; each way runs in its own process so peaks don't mix
+# run from the project root: python3 misc/bench_stream.py [--orders 50000]
+import argparse
+import json
+import logging
+import resource
+import socket
+import subprocess
+import sys
+import time
+from http.server import HTTPServer
+from os import path
+
+from loadtest import ROOT, wait_listening, free_port
+
+sys.path.insert(0, ROOT)
+
+
+def make_orders(n):
+    return [{
+        "sort_id": i,
+        "time": 1500000000000000 + i,
+        "state": i % 5,
+        "gapi_user": {"email": "someone{}@example.com".format(i)},
+        "items": [{
+            "fullname": "Chicken Soup",
+            "price": 1.3,
+            "options": {"add bacon bits": [0.5, bool(i % 2)]}
+        }] * 3,
+        "total_value": 3.9,
+    } for i in range(n)]
+
+
+def rss_kb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def child(how, port, n):
+    import server
+    server.logger = logging.getLogger("server")
+
+    reply = {
+        "response": "reply_view_orders",
+        "data": {"cur_orders": make_orders(n), "old_orders": []},
+        "time": {"conn_init": 1},
+    }
+
+    served = []
+
+    class Handler(server.Server):
+        def do_GET(self):
+            served.append(1)
+            self.set_headers(200)
+            if how == "old":
+                self.write_str(json.dumps(reply, indent=2))
+            else:
+                self.write_json(reply)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(("127.0.0.1", port), Handler)
+    before = rss_kb()
+    # wait_listening's probe connects too, and sends nothing
+    while not served:
+        httpd.handle_request()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"extra_kb": max(0, peak - before)}))
+
+
+def fetch(port):
+    sock  = socket.create_connection(("127.0.0.1", port))
+    start = time.perf_counter()
+    sock.sendall(b"GET / HTTP/1.1\r\nHost: x\r\nOrigin: x\r\n"
+                 b"Connection: close\r\n\r\n")
+    first = None
+    size  = 0
+    while True:
+        data = sock.recv(1 << 16)
+        if not data:
+            break
+        if first is None:
+            first = time.perf_counter() - start
+        size += len(data)
+    sock.close()
+    return first, time.perf_counter() - start, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--orders", type=int, default=50000)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], int(args.child[1]), args.orders)
+        return
+
+    for how in ["old", "streamed"]:
+        port = free_port()
+        proc = subprocess.Popen(
+            [sys.executable, path.abspath(__file__), "--orders",
+             str(args.orders), "--child", how, str(port)],
+            cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        wait_listening(port, timeout=60)
+        ttfb, total, size = fetch(port)
+        extra = json.loads(proc.communicate()[0].decode())["extra_kb"]
+        print("{:>9}: ttfb {:8.1f} ms  total {:8.1f} ms  {:6.1f} MB sent"
+              "  peak RSS +{:6.1f} MB".format(
+                  how, ttfb * 1e3, total * 1e3, size / 2 ** 20, extra / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# anti-CSRF token checks and registrations per second from 1, 8 and 32
+# threads (one registration to every CHECKS_PER_REGISTER checks, as a page
+# signs in once and then posts), against anticsrf.token_clerk, a TokenStore
+# with a single lock and one striped over token_store.STRIPES locks; then the
+# tokens a TokenStore holds over a simulated week at one sign-in a second
+# run from the project root: python3 misc/bench_tokens.py [--seconds 2]
+import argparse
+import sys
+import threading
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import anticsrf.anticsrf as anticsrf  # noqa
+import token_store  # noqa
+
+CHECKS_PER_REGISTER = 20
+
+
+def worker(store, seed, stop, counts):
+    tokens = [store.register_new()["tok"] for _ in range(8)]
+    done   = 0
+    while not stop.is_set():
+        for i in range(CHECKS_PER_REGISTER):
+            store.is_valid(tokens[(seed + i) & 7])
+        tokens[done & 7] = store.register_new()["tok"]
+        done += CHECKS_PER_REGISTER + 1
+    counts.append(done)
+
+
+def throughput(make, threads, seconds):
+    store  = make()
+    stop   = threading.Event()
+    counts = []
+    pool   = [
+        threading.Thread(target=worker, args=(store, n, stop, counts))
+        for n in range(threads)
+    ]
+    for t in pool:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in pool:
+        t.join()
+    return sum(counts) / seconds
+
+
+def week(rate=1):
+    now   = [0]
+    store = token_store.TokenStore(clock=lambda: now[0])
+    held  = []
+    for sec in range(7 * 24 * 60 * 60):
+        now[0] = sec * 10 ** 6
+        for _ in range(rate):
+            store.register_new()
+        if sec % 60 == 0:
+            store.sweep()
+        if sec % (24 * 60 * 60) == 0:
+            held.append(len(store))
+    return held
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=2)
+    args = parser.parse_args()
+
+    stores = [
+        ("token_clerk", lambda: anticsrf.token_clerk(
+            keysize=42, keyfunc=anticsrf.random_key)),
+        ("1 lock", lambda: token_store.TokenStore(stripes=1)),
+        ("{} locks".format(token_store.STRIPES), token_store.TokenStore),
+    ]
+    for threads in [1, 8, 32]:
+        for name, make in stores:
+            ops = throughput(make, threads, args.seconds)
+            print("{:>3} threads {:>11}: {:10.0f} ops/s".format(
+                threads, name, ops))
+
+    print("tokens held at the start of each simulated day:",
+          ", ".join(str(n) for n in week()))
+
+
+if __name__ == "__main__":
+    main()
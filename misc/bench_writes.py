@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# orders placed per second through json_helper.register_write with 1, 10 and
+# 100 concurrent writers, applying one write per pass (the old behaviour) and
+# batching them with one sync per batch
+# run from the project root: python3 misc/bench_writes.py
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import json_helper  # noqa
+import order_log  # noqa
+
+WRITES = 2000
+ORDER = {"items": [{"fullname": "Pizza", "price": 4.5}], "total_value": 4.5}
+
+
+def writer(count):
+    for _ in range(count):
+        res, status = json_helper.register_write(
+            "orders", "open_order", ORDER
+        )
+        assert status == 200, res
+
+
+def measure(writers, batch_max, tmp):
+    json_helper.WRITE_BATCH_MAX = batch_max
+    json_helper._orders = order_log.OrderLog(
+        path.join(tmp, "orders.json"), path.join(tmp, "orders.log"),
+        compact_records=10 ** 9
+    )
+    server = threading.Thread(target=json_helper.write_server, daemon=True)
+    server.start()
+
+    threads = [
+        threading.Thread(target=writer, args=(WRITES // writers,))
+        for _ in range(writers)
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    json_helper.kill_all_threads()
+    server.join()
+    return (WRITES // writers) * writers / elapsed
+
+
+def main():
+    batch_max = json_helper.WRITE_BATCH_MAX
+    # fsync cost is the point, so stay on the same disk as json/
+    tmp = tempfile.mkdtemp(dir=".")
+    try:
+        shutil.copy(path.join("json", "orders.json"), tmp)
+        for writers in [1, 10, 100]:
+            print("{:>4} writers: {:8.1f} writes/s unbatched, {:8.1f} batched"
+                  .format(
+                      writers,
+                      measure(writers, 1, tmp),
+                      measure(writers, batch_max, tmp)
+                  ))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
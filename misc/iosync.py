@@ -1,62 +1,41 @@
-from glob import glob
-from os.path import exists, join
-from time import sleep
+import sys
+from os.path import dirname, abspath, join
 
-from api_helper import microtime
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
 
-DIR_LOCKED = "locked"
-DIR_JSON   = "json"
+import file_lock  # noqa
 
-JSON_FILES = {
-    "elevated_ids": 0,
-    "known_users": 0,
-    "limits": 0,
-    "menu": 0,
-    "orders": 0
-}
+DIR_JSON = "json"
 
-
-def queue_write(name, data):
-    now = microtime()
-    if name not in JSON_FILES:
-        raise OSError("DB does not exist: {}".format(name))
-    fname = join(DIR_LOCKED, str(now) + ".write." + name)
-    with open(fname, "w+") as f:
-        f.write(data)
+JSON_FILES = [
+    "elevated_ids",
+    "known_users",
+    "limits",
+    "menu",
+    "orders",
+]
 
 
-def queue_read(name):
-    # now = microtime()
+def _path(name):
     if name not in JSON_FILES:
         raise OSError("DB does not exist: {}".format(name))
-    wait_writers(name)
-    JSON_FILES[name] += 1
-    data = do_read(name)
-    JSON_FILES[name] -= 1
-    return data
+    return join(DIR_JSON, name + ".json")
 
 
-def has_writers(name):
-    return len(glob(join(DIR_LOCKED, "*.write." + name))) > 0
+def queue_write(name, data):
+    # waits for readers and writers in every process to finish, then swaps
+    # the whole file in
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    with file_lock.exclusive(_path(name)):
+        file_lock.write_atomic(_path(name), data)
 
 
-def has_readers(name):
-    return JSON_FILES[name] > 0
+def queue_read(name):
+    # waits only for a writer
+    return file_lock.read(_path(name))
 
 
 def wait_writers(name):
-    while has_writers(name):
-        sleep(.5)
-    return True
-
-
-def wait_readers(name):
-    pass
-
-
-def do_write(name):
-    pass
-
-
-def do_read(name):
-    pass
+    with file_lock.shared(_path(name)):
+        return True
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# start server.py in each mode on a spare port, hammer it with ping requests
+# from many client threads, and report requests/sec and latency percentiles
+# run from the project root: python3 misc/loadtest.py [--modes threaded ...]
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from os import path
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+
+BODY = json.dumps({
+    "verb": "ping",
+    "data": {"ping": "hello"},
+    "time": {"conn_init": 1}
+}).encode("utf-8")
+
+HEADERS = {
+    "Content-Type": "application/json",
+    "Origin": "http://localhost:3000",
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_listening(port, timeout=15):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(.1)
+    raise RuntimeError("server never started listening on {}".format(port))
+
+
+def client(port, count, latencies, errors):
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            conn.request("POST", "/", body=BODY, headers=HEADERS)
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            if resp.status != 200:
+                errors.append(resp.status)
+                continue
+        except OSError as e:
+            errors.append(repr(e))
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def percentile(data, pct):
+    data = sorted(data)
+    return data[min(len(data) - 1, int(len(data) * pct / 100))]
+
+
+def run_mode(mode, concurrency, requests, extra_args=()):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "server.py", str(port), "--mode", mode]
+        + list(extra_args),
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_listening(port)
+        latencies, errors = [], []
+        per_client = max(1, requests // concurrency)
+        threads = [
+            threading.Thread(target=client,
+                             args=(port, per_client, latencies, errors))
+            for _ in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        os.kill(proc.pid, signal.SIGTERM)
+        proc.wait()
+
+    if not latencies:
+        print("{:>10}: every request failed ({})".format(mode, errors[:3]))
+        return
+    print(
+        "{:>10}: {:8.1f} req/s  p50 {:7.2f} ms  p99 {:7.2f} ms  errors {}"
+        .format(
+            mode,
+            len(latencies) / elapsed,
+            percentile(latencies, 50) * 1e3,
+            percentile(latencies, 99) * 1e3,
+            len(errors)
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+",
+                        default=["threaded", "asyncio"])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        run_mode(mode, args.concurrency, args.requests)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# checks for order_log.OrderLog across restarts; runs under pytest, or alone
+# from the project root: python3 misc/order_log_test.py
+import json
+import shutil
+import sys
+import tempfile
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import order_archive  # noqa
+import order_log  # noqa
+
+ORDER = {"items": [{"fullname": "Pizza", "price": 4.5}], "total_value": 4.5}
+
+
+def _open(tmp, shared=False):
+    return order_log.OrderLog(
+        path.join(tmp, "orders.json"), path.join(tmp, "orders.log"),
+        archive=order_archive.OrderArchive(path.join(tmp, "archive")),
+        shared=shared
+    )
+
+
+def _empty_db():
+    tmp = tempfile.mkdtemp()
+    with open(path.join(tmp, "orders.json"), "w") as f:
+        json.dump({"cur_orders": [], "old_orders": []}, f)
+    return tmp
+
+
+def _place_and_rotate(log):
+    ids = []
+    for _ in range(3):
+        order, durable = log.open_order(ORDER)
+        durable()
+        ids.append(order["sort_id"])
+    for sid in ids:
+        _, durable = log.close_order(sid)
+        durable()
+    log.compact(rotate=True)
+    return ids
+
+
+def test_rotated_sort_ids_not_reused():
+    tmp = _empty_db()
+    try:
+        log = _open(tmp)
+        ids = _place_and_rotate(log)
+        log.stop()
+        # every order has left orders.json for the archive
+        assert not log.snapshot()["old_orders"]
+
+        log = _open(tmp)
+        order, durable = log.open_order(ORDER)
+        durable()
+        log.stop()
+        assert order["sort_id"] > max(ids), order["sort_id"]
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_rotated_sort_ids_not_reused_when_shared():
+    # the other process reloads everything once the log it was reading has
+    # been compacted away
+    tmp = _empty_db()
+    try:
+        one, other = _open(tmp, shared=True), _open(tmp, shared=True)
+        ids = _place_and_rotate(one)
+
+        order, durable = other.open_order(ORDER)
+        durable()
+        one.stop()
+        other.stop()
+        assert order["sort_id"] > max(ids), order["sort_id"]
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    test_rotated_sort_ids_not_reused()
+    test_rotated_sort_ids_not_reused_when_shared()
+    print("ok")
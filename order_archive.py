@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import coloredlogs
+import functools
+import logging
+import os
+import threading
+import time
+from os import path
+
+import file_lock
+import json_codec
+from json_cache import freeze
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("order_archive")
+
+# move closed orders out of orders.json at most this often (seconds)
+ROTATE_INTERVAL = 24 * 60 * 60
+
+INDEX_NAME = "orders.index.json"
+
+# parsed segments kept in memory; segments never change once written
+SEGMENT_CACHE = 8
+
+
+def write_json_atomic(fpath, obj):
+    '''
+        Arguments:  fpath (a string), obj (JSON-serialisable)
+        Returns:    None
+        Throws:     OSError, and TypeError if obj isn't serialisable
+        Effects:    replaces fpath with obj as JSON, so readers see either the
+                    whole old file or the whole new one, even after a crash
+    '''
+    file_lock.write_atomic(fpath, json_codec.dumps(obj))
+
+
+class OrderArchive():
+    '''
+        Closed orders moved out of orders.json into dated segment files, named
+            orders-<DATE_MOVED>.json.old, plus an index of every segment's
+            time range, sort_id range and order count.
+
+        A segment is written and indexed as uncommitted before orders.json
+            drops its orders, and committed afterwards. recover() settles
+            segments left uncommitted by a crash, by checking whether
+            orders.json still holds their orders.
+    '''
+
+    def __init__(self, archive_dir, prefix="orders"):
+        self.archive_dir = archive_dir
+        self.prefix      = prefix
+        self.index_path  = path.join(archive_dir, INDEX_NAME)
+        self._lock       = threading.Lock()
+        os.makedirs(archive_dir, exist_ok=True)
+
+        self._segments = self._read_index()
+
+        self.load = functools.lru_cache(maxsize=SEGMENT_CACHE)(self._load)
+
+    def _read_index(self):
+        if not path.exists(self.index_path):
+            return []
+        with open(self.index_path, "rb") as f:
+            return json_codec.loads(f.read())["segments"]
+
+    def reload(self):
+        '''
+            Effects:    reads the index again, for segments written by
+                        another process
+        '''
+        with self._lock:
+            self._segments = self._read_index()
+
+    def _save_index(self):
+        write_json_atomic(self.index_path, {"segments": self._segments})
+
+    def _seg_path(self, name):
+        return path.join(self.archive_dir, name)
+
+    def _load(self, name):
+        with open(self._seg_path(name), "rb") as f:
+            return freeze(json_codec.loads(f.read())["old_orders"])
+
+    def segments(self):
+        '''
+            Returns:    the committed index entries, oldest first
+        '''
+        with self._lock:
+            return [dict(s) for s in self._segments if s["committed"]]
+
+    def last_rotation(self):
+        with self._lock:
+            moved = [s["moved"] for s in self._segments if s["committed"]]
+        return max(moved) if moved else None
+
+    def write_segment(self, orders):
+        '''
+            Arguments:  orders (a sequence of order dicts, oldest first)
+            Returns:    the new, uncommitted index entry
+            Throws:     OSError
+            Effects:    writes a segment file and the index
+        '''
+        now  = time.time()
+        date = time.strftime("%Y-%m-%d", time.gmtime(now))
+        with self._lock:
+            taken = {s["file"] for s in self._segments}
+            name, n = "{}-{}.json.old".format(self.prefix, date), 1
+            while name in taken:
+                name = "{}-{}.{}.json.old".format(self.prefix, date, n)
+                n += 1
+
+            write_json_atomic(self._seg_path(name), {"old_orders": orders})
+            times = [o["time"] for o in orders]
+            ids   = [o["sort_id"] for o in orders]
+            entry = {
+                "file": name,
+                "moved": now,
+                "first_time": min(times),
+                "last_time": max(times),
+                "first_id": min(ids),
+                "last_id": max(ids),
+                "count": len(orders),
+                "committed": False,
+            }
+            self._segments.append(entry)
+            self._save_index()
+            return entry
+
+    def commit(self, entry):
+        with self._lock:
+            for s in self._segments:
+                if s["file"] == entry["file"]:
+                    s["committed"] = True
+            self._save_index()
+
+    def _drop(self, entry):
+        self._segments = [
+            s for s in self._segments if s["file"] != entry["file"]
+        ]
+        self._save_index()
+        if path.exists(self._seg_path(entry["file"])):
+            os.remove(self._seg_path(entry["file"]))
+
+    def recover(self, old_ids):
+        '''
+            Arguments:  old_ids (a set of the sort_ids of closed orders still
+                        in orders.json)
+            Returns:    True if a segment was committed here, meaning that
+                        orders.json was rewritten after it and any order log
+                        left over from that compaction is already reflected
+                        in orders.json
+            Throws:     OSError
+        '''
+        rewritten = False
+        with self._lock:
+            for entry in [s for s in self._segments if not s["committed"]]:
+                ids = {o["sort_id"] for o in self._load(entry["file"])}
+                if ids & old_ids:
+                    logger.warning("dropping unfinished segment {}"
+                                   .format(entry["file"]))
+                    self._drop(entry)
+                else:
+                    logger.warning("committing unfinished segment {}"
+                                   .format(entry["file"]))
+                    entry["committed"] = True
+                    self._save_index()
+                    rewritten = True
+        return rewritten
@@ -0,0 +1,754 @@
+#!/usr/bin/env python3
+import base64
+import bisect
+import coloredlogs
+import contextlib
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+
+import file_lock
+import json_codec
+from json_cache import FrozenDict, freeze
+from order_archive import ROTATE_INTERVAL, write_json_atomic
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("order_log")
+
+# fold the log into orders.json after this many records, or this many seconds
+# after the first record since the last compaction
+COMPACT_RECORDS  = 1000
+COMPACT_INTERVAL = 60
+
+# seconds before a compaction which failed (a full disk, say) is tried again
+COMPACT_RETRY = 5
+
+COMPACTING_EXT = ".compacting"
+
+
+def _now():
+    return int(time.time() * (10 ** 6))
+
+
+def encode_cursor(age, newest_first, key):
+    '''
+        Arguments:  age ("new" or "old"), newest_first (a bool), key (a next
+                    key from OrderLog.page)
+        Returns:    an opaque, URL-safe string to hand to the client
+    '''
+    raw = json_codec.dumps([age, int(newest_first), key])
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, age, newest_first):
+    '''
+        Arguments:  cursor (a string from encode_cursor), age and newest_first
+                    (as for the page being asked for)
+        Returns:    the key to pass to OrderLog.page as after
+        Throws:     ValueError if cursor is malformed or was made for a
+                    different age or direction
+    '''
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        c_age, c_newest, key = json_codec.loads(raw)
+    except (TypeError, ValueError):
+        raise ValueError("malformed cursor")
+    if c_age != age or bool(c_newest) != newest_first:
+        raise ValueError("cursor is for a different age or direction")
+
+    if age == "new" and isinstance(key, list) and len(key) == 2 \
+            and all(isinstance(k, int) for k in key):
+        return tuple(key)
+    if age == "old" and isinstance(key, int):
+        return key
+    raise ValueError("malformed cursor")
+
+
+class OrderLog():
+    '''
+        The orders database, as the canonical orders.json plus an append-only
+            log of every mutation since it was last written.
+
+        Each mutation is applied to the in-memory orders and appended to the
+            log as one line of JSON, so placing an order costs one small write
+            instead of rewriting every order ever placed. sync() fsyncs every
+            record written so far in one go; json_helper's writer calls it
+            once per batch of writes, so its WRITE_BATCH_WINDOW is what sets
+            how long a write waits to be durable. wait_synced() blocks a
+            caller until its record is durable, syncing the log itself unless
+            a sync which covers the record is already under way.
+
+        A background thread compacts the log: the current log is renamed
+            aside, a fresh one started, and the snapshot written to orders.json
+            with an atomic rename before the old log is deleted. On startup
+            orders.json is loaded and any leftover logs are replayed. Every
+            record can be replayed twice without harm, so a crash at any point
+            of a compaction loses nothing.
+
+        Given an order_archive.OrderArchive, the compactor also moves closed
+            orders out of orders.json into a dated segment every
+            rotate_interval seconds.
+
+        With shared set, several processes may each have an OrderLog on the
+            same files. Every read or write first takes the log's
+            file_lock, and reads whatever other processes have appended
+            since; appends and compactions hold it exclusively, so sort_ids
+            stay unique. A process that finds the log replaced by
+            another's compaction reloads orders.json and the archive index.
+            The lock is held for all of a compaction, which holds up every
+            process's writes meanwhile.
+    '''
+
+    def __init__(self, json_path, log_path,
+                 compact_records=COMPACT_RECORDS,
+                 compact_interval=COMPACT_INTERVAL,
+                 archive=None,
+                 rotate_interval=ROTATE_INTERVAL,
+                 shared=False):
+        self.json_path        = json_path
+        self.log_path         = log_path
+        self.compact_records  = compact_records
+        self.compact_interval = compact_interval
+        self.archive          = archive
+        self.rotate_interval  = rotate_interval
+        self.shared           = shared
+
+        # with no archive segment yet, the first rotation is due
+        # rotate_interval after this rather than straight away
+        self._opened_at = time.time()
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+        # records written / being fsynced / written and fsynced; these count
+        # only this process's own records
+        self._seq         = 0
+        self._syncing_seq = 0
+        self._synced_seq  = 0
+        # the last sync that failed: the seq it was for, and why
+        self._failed_seq = 0
+        self._sync_error = None
+        self._stopping = False
+        self._threads  = []
+
+        # shared: the lock every process takes to use the files, and how far
+        # into the log this process has read
+        self._file_lock = file_lock.lock_for(log_path) if shared else None
+        self._tail      = 0
+
+        self._reset()
+        if not shared:
+            self._recover()
+            self._log = open(self.log_path, "a+b")
+            return
+        with self._file_lock.exclusive():
+            self._recover(fold=False)
+            self._log = open(self.log_path, "a+b")
+            if not self._catch_up(True):
+                raise OSError("{} went away".format(self.log_path))
+
+    def _reset(self):
+        # the in-memory database, empty
+        self._last_rotation = (
+            self.archive and self.archive.last_rotation()
+        ) or self._opened_at
+
+        # open orders by sort_id, in the order they were placed, and closed
+        # orders oldest first
+        self._cur      = {}
+        self._old      = []
+        self._old_ids  = set()
+        self._next_id  = 1
+        self._snapshot = None
+
+        # (time, sort_id) of every open order, sorted; pages of open orders
+        # are cut from this with bisect
+        self._cur_keys = []
+
+        # closed orders on their way into an archive segment, and the
+        # segment's file name once it has been written
+        self._rotating      = ()
+        self._rotating_file = None
+
+        # records in the log since the last compaction
+        self._log_records     = 0
+        self._first_record_at = None
+
+    ###########################################################################
+    # recovery and replay
+
+    def _recover(self, fold=True):
+        # without fold, the log is left for _catch_up to read, unless a
+        # compaction was cut short and left one set aside
+        with open(self.json_path, "rb") as f:
+            doc = json_codec.loads(f.read())
+        for order in doc.get("old_orders", []):
+            self._add_old(freeze(order))
+        for order in doc.get("cur_orders", []):
+            self._add_cur(freeze(order))
+
+        compacting = self.log_path + COMPACTING_EXT
+        if (self.archive is not None and self.archive.recover(self._old_ids)
+                and os.path.exists(compacting)):
+            # orders.json was written after this log was set aside, and it may
+            # open orders which have since been archived
+            logger.info("discarding {}, already in {}"
+                        .format(compacting, self.json_path))
+            os.remove(compacting)
+        if self.archive is not None:
+            # rotated orders have left orders.json, but their sort_ids stay
+            # taken
+            for seg in self.archive.segments():
+                self._next_id = max(self._next_id, seg["last_id"] + 1)
+        if not fold and not os.path.exists(compacting):
+            return
+
+        logs = [
+            lpath for lpath in [compacting, self.log_path]
+            if os.path.exists(lpath)
+        ]
+        replayed = sum(self._replay(lpath) for lpath in logs)
+        if replayed:
+            logger.info("replayed {} order log record(s)".format(replayed))
+            # fold the replayed records in now, so a compaction never finds a
+            # leftover log in its way
+            write_json_atomic(self.json_path, self._snapshot_locked())
+        for lpath in logs:
+            os.remove(lpath)
+
+    def _replay(self, lpath):
+        with open(lpath, "rb") as f:
+            return self._apply_lines(f.read().split(b"\n"), lpath)
+
+    def _apply_lines(self, lines, lpath):
+        count = 0
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+            try:
+                rec = json_codec.loads(line)
+            except json_codec.DecodeError:
+                if i == len(lines) - 1:
+                    logger.warning("dropping torn last record in {}"
+                                   .format(lpath))
+                else:
+                    logger.error("skipping bad record {} in {}"
+                                 .format(i + 1, lpath))
+                continue
+            self._apply(rec)
+            count += 1
+        return count
+
+    def _catch_up(self, exclusive):
+        '''
+            Arguments:  exclusive (whether the file lock is held exclusively)
+            Returns:    False if the log has been replaced since this process
+                        last read it, so everything has to be reloaded
+            Throws:     OSError
+            Effects:    applies the records other processes have appended;
+                        must hold self._lock and the file lock
+        '''
+        fd = self._log.fileno()
+        st = os.fstat(fd)
+        try:
+            if os.stat(self.log_path).st_ino != st.st_ino:
+                return False
+        except FileNotFoundError:
+            return False
+        if st.st_size <= self._tail:
+            return True
+
+        data = os.pread(fd, st.st_size - self._tail, self._tail)
+        end  = data.rfind(b"\n") + 1
+        read = self._apply_lines(data[:end].split(b"\n"), self.log_path)
+        self._tail += end
+        if read:
+            self._log_records += read
+            if self._first_record_at is None:
+                self._first_record_at = time.monotonic()
+        if end < len(data) and exclusive:
+            # nobody appends while we hold the lock, so this is what's left
+            # of a record whose writer died; end it, so the next record
+            # starts a line of its own
+            logger.warning("dropping torn last record in {}"
+                           .format(self.log_path))
+            self._log.write(b"\n")
+            self._log.flush()
+            self._tail = st.st_size + 1
+        return True
+
+    def _reload(self):
+        # must hold self._lock and the file lock exclusively
+        self._log.close()
+        if self.archive is not None:
+            self.archive.reload()
+        self._reset()
+        self._recover(fold=False)
+        self._log  = open(self.log_path, "a+b")
+        self._tail = 0
+        self._catch_up(True)
+        logger.info("reloaded orders after another process compacted them")
+
+    @contextlib.contextmanager
+    def _disk(self, exclusive=False):
+        '''
+            Arguments:  exclusive (a bool; True to append or compact)
+            Throws:     OSError
+            Effects:    in shared mode, holds the file lock (exclusively if
+                        asked) for the duration, having first brought the
+                        orders in memory up to date with the files; must not
+                        hold self._lock
+        '''
+        if not self.shared:
+            yield
+            return
+        lock = self._file_lock
+        lock.acquire(exclusive)
+        held = True
+        try:
+            with self._lock:
+                current = self._catch_up(exclusive)
+            if not current and not exclusive:
+                # reloading can mean finishing a compaction which was cut
+                # short, and that writes
+                lock.release()
+                held = False
+                lock.acquire(exclusive=True)
+                held = True
+                with self._lock:
+                    current = self._catch_up(True)
+            if not current:
+                with self._lock:
+                    self._reload()
+            yield
+        finally:
+            if held:
+                lock.release()
+
+    ###########################################################################
+    # mutations
+
+    def _add_old(self, order):
+        self._old.append(order)
+        self._old_ids.add(order["sort_id"])
+        self._next_id = max(self._next_id, order["sort_id"] + 1)
+
+    def _add_cur(self, order):
+        sid = order["sort_id"]
+        self._cur[sid] = order
+        self._next_id  = max(self._next_id, sid + 1)
+        bisect.insort(self._cur_keys, (order["time"], sid))
+
+    def _apply(self, rec):
+        op = rec["op"]
+        if op == "open":
+            order = freeze(rec["order"])
+            sid   = order["sort_id"]
+            if sid in self._cur or sid in self._old_ids:
+                return
+            self._add_cur(order)
+
+        elif op == "close":
+            order = self._cur.pop(rec["sort_id"], None)
+            if order is not None:
+                key = (order["time"], order["sort_id"])
+                del self._cur_keys[bisect.bisect_left(self._cur_keys, key)]
+                self._add_old(order)
+
+        elif op == "state":
+            order = self._cur.get(rec["sort_id"])
+            if order is not None:
+                order = dict(order)
+                order["state"] = rec["state"]
+                self._cur[rec["sort_id"]] = freeze(order)
+
+        else:
+            raise ValueError("unknown order log op: {}".format(op))
+
+        self._snapshot = None
+
+    def _append(self, rec):
+        '''
+            Arguments:  rec (a dict)
+            Returns:    a function which blocks until rec is on disk
+            Throws:     no
+            Effects:    applies and logs rec; must hold self._lock
+        '''
+        self._apply(rec)
+        line = json_codec.dumps(rec) + b"\n"
+        self._log.write(line)
+        if self.shared:
+            # other processes read it as soon as the lock is let go
+            self._log.flush()
+            self._tail += len(line)
+        self._seq += 1
+        self._log_records += 1
+        if self._first_record_at is None:
+            self._first_record_at = time.monotonic()
+        self._cond.notify_all()
+        return functools.partial(self.wait_synced, self._seq)
+
+    def open_order(self, order):
+        '''
+            Arguments:  order (a dict)
+            Returns:    the stored order (with sort_id, time and state filled
+                        in), and a function which blocks until it is durable
+            Throws:     OSError in shared mode
+        '''
+        with self._disk(exclusive=True), self._lock:
+            order = dict(order)
+            order["sort_id"] = self._next_id
+            order.setdefault("time", _now())
+            order.setdefault("state", 0)
+            durable = self._append({"op": "open", "order": order})
+            return self._cur[order["sort_id"]], durable
+
+    def close_order(self, sort_id, owner=None):
+        '''
+            Arguments:  sort_id (an int), owner (the "sub" of the account
+                        closing it, or None if it may close any order)
+            Returns:    the closed order, and a function which blocks until
+                        the change is durable
+            Throws:     KeyError if no open order has that sort_id,
+                        PermissionError if owner didn't place it, and OSError
+                        in shared mode
+        '''
+        with self._disk(exclusive=True), self._lock:
+            order = self._cur[sort_id]
+            user  = order.get("gapi_user")
+            if owner is not None and (
+                    not isinstance(user, dict) or user.get("sub") != owner):
+                raise PermissionError(
+                    "order {} was placed by another account".format(sort_id)
+                )
+            durable = self._append({"op": "close", "sort_id": sort_id})
+            return order, durable
+
+    def set_state(self, sort_id, state):
+        with self._disk(exclusive=True), self._lock:
+            if sort_id not in self._cur:
+                raise KeyError(sort_id)
+            durable = self._append(
+                {"op": "state", "sort_id": sort_id, "state": state}
+            )
+            return self._cur[sort_id], durable
+
+    ###########################################################################
+    # reading
+
+    def _snapshot_locked(self):
+        if self._snapshot is None:
+            self._snapshot = FrozenDict(
+                cur_orders=tuple(self._cur.values()),
+                old_orders=tuple(self._old)
+            )
+        return self._snapshot
+
+    def snapshot(self):
+        '''
+            Returns:    the database as a read-only
+                        {"cur_orders": (...), "old_orders": (...)}, where
+                        old_orders holds only closed orders not yet archived
+            Throws:     OSError in shared mode
+        '''
+        with self._disk(), self._lock:
+            return self._snapshot_locked()
+
+    def page(self, age, limit, newest_first=False, after=None, states=None,
+             since=None, until=None):
+        '''
+            Arguments:  age ("new" for open orders, "old" for closed ones),
+                        limit (an int), newest_first (a bool), after (the
+                        next key of the previous page), states (a collection
+                        of order states to keep), since and until (order
+                        times; since is inclusive, until exclusive)
+            Returns:    {"orders": [...], "next": key or None}, with next set
+                        only if there are more matching orders
+            Throws:     OSError if an archive segment can't be read
+
+            Open orders come in (time, sort_id) order, cut from an index with
+                bisect, so a page costs O(log n + limit) unless states skips
+                some. Closed orders come in the order they were closed, keyed
+                by their position in that history; archive segments outside
+                the time range or before after are never opened.
+        '''
+        if age == "new":
+            # open orders change under us, so the page is cut under the lock;
+            # the orders themselves are read-only and safe to hand out
+            with self._disk(), self._lock:
+                return self._cut_page(
+                    self._match_cur(newest_first, after, since, until),
+                    limit, states
+                )
+        with self._disk():
+            return self._cut_page(
+                self._match_old(newest_first, after, since, until), limit,
+                states
+            )
+
+    @staticmethod
+    def _cut_page(found, limit, states):
+        if states is not None:
+            found = ((k, o) for k, o in found if o["state"] in states)
+        page = list(itertools.islice(found, limit + 1))
+        more = len(page) > limit
+        page = page[:limit]
+        return {
+            "orders": [o for _, o in page],
+            "next": page[-1][0] if more and page else None
+        }
+
+    def _match_cur(self, newest_first, after, since, until):
+        # must hold self._lock
+        keys = self._cur_keys
+        lo   = 0 if since is None else bisect.bisect_left(keys, (since,))
+        hi   = (len(keys) if until is None
+                else bisect.bisect_left(keys, (until,)))
+        if after is not None and newest_first:
+            hi = min(hi, bisect.bisect_left(keys, after))
+        elif after is not None:
+            lo = max(lo, bisect.bisect_right(keys, after))
+        for i in (range(hi - 1, lo - 1, -1) if newest_first
+                  else range(lo, hi)):
+            yield keys[i], self._cur[keys[i][1]]
+
+    def _old_chunks(self):
+        '''
+            Returns:    (position, count, first_time, last_time, orders) for
+                        each archive segment and then the closed orders in
+                        memory, where position counts every order closed
+                        before the chunk and orders is a function returning
+                        them
+        '''
+        with self._lock:
+            segs   = self.archive.segments() if self.archive else []
+            recent = tuple(self._old)
+            files  = {s["file"] for s in segs}
+            if self._rotating and self._rotating_file not in files:
+                recent = self._rotating + recent
+
+        chunks, pos = [], 0
+        for s in segs:
+            chunks.append((pos, s["count"], s["first_time"], s["last_time"],
+                           functools.partial(self.archive.load, s["file"])))
+            pos += s["count"]
+        chunks.append((pos, len(recent), None, None, lambda: recent))
+        return chunks
+
+    def _match_old(self, newest_first, after, since, until):
+        chunks = self._old_chunks()
+        if newest_first:
+            chunks.reverse()
+        for pos, count, first, last, orders in chunks:
+            if after is not None and (pos >= after if newest_first
+                                      else pos + count <= after + 1):
+                continue
+            if first is not None and (
+                    (since is not None and last < since) or
+                    (until is not None and first >= until)):
+                continue
+
+            if newest_first:
+                top  = count if after is None else min(count, after - pos)
+                span = range(top - 1, -1, -1)
+            else:
+                start = 0 if after is None else max(0, after - pos + 1)
+                span  = range(start, count)
+            loaded = orders()
+            for i in span:
+                order = loaded[i]
+                if since is not None and order["time"] < since:
+                    continue
+                if until is not None and order["time"] >= until:
+                    continue
+                yield pos + i, order
+
+    ###########################################################################
+    # durability
+
+    def _sync_failed(self, seq, error):
+        # must hold self._lock; whoever waits on a record up to seq gives up
+        self._failed_seq = max(self._failed_seq, seq)
+        self._sync_error = error
+        self._cond.notify_all()
+
+    def sync(self):
+        '''
+            Throws:     OSError if the log can't be written out, which is
+                        also raised to everyone waiting on a record written
+                        before the flush
+            Effects:    flushes the log and fsyncs it, then wakes everyone
+                        waiting on a record written before the flush
+        '''
+        with self._lock:
+            if self._synced_seq == self._seq:
+                return
+            seq = self._seq
+            try:
+                self._log.flush()
+                # a compaction may close the log meanwhile; keep our own
+                # handle
+                fd = os.dup(self._log.fileno())
+            except OSError as e:
+                self._sync_failed(seq, e)
+                raise
+            self._syncing_seq = max(self._syncing_seq, seq)
+        # appends can carry on while the disk catches up
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            with self._lock:
+                self._sync_failed(seq, e)
+            raise
+        finally:
+            os.close(fd)
+        with self._lock:
+            self._synced_seq = max(self._synced_seq, seq)
+            self._cond.notify_all()
+
+    def wait_synced(self, seq):
+        '''
+            Arguments:  seq (as bound by the function _append returns)
+            Throws:     OSError if the sync which was to cover seq failed
+            Effects:    waits for a sync under way which covers seq, or else
+                        syncs the log
+        '''
+        with self._lock:
+            self._cond.wait_for(
+                lambda: seq <= self._synced_seq or seq <= self._failed_seq
+                or seq > self._syncing_seq
+            )
+            if seq <= self._synced_seq:
+                return
+            if seq <= self._failed_seq:
+                raise self._sync_error
+        self.sync()
+
+    ###########################################################################
+    # compaction
+
+    def compact(self, rotate=False):
+        '''
+            Arguments:  rotate (a bool)
+            Effects:    writes every order to orders.json and empties the log;
+                        with rotate, first moves every closed order into a new
+                        archive segment
+
+            Only the log swap happens under the lock; the slow full write of
+                orders.json does not hold up new orders (except in shared
+                mode, where the file lock is held throughout).
+        '''
+        with self._disk(exclusive=True):
+            self._compact(rotate)
+
+    def _compact(self, rotate):
+        with self._lock:
+            swapped = self._log_records > 0
+            if not (swapped or rotate):
+                return
+            if swapped:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log.close()
+                os.replace(self.log_path, self.log_path + COMPACTING_EXT)
+                self._log  = open(self.log_path, "a+b")
+                self._tail = 0
+                self._synced_seq = self._seq
+                self._log_records     = 0
+                self._first_record_at = None
+                self._cond.notify_all()
+
+            archived = ()
+            if rotate and self._old:
+                archived       = tuple(self._old)
+                self._old      = []
+                self._old_ids  = set()
+                self._snapshot = None
+                # pages of closed orders still see these until the segment
+                # holding them is committed
+                self._rotating = archived
+            snap = self._snapshot_locked()
+
+        # segment first, then orders.json, then commit the segment; see
+        # OrderArchive.recover for what a crash in between leaves behind
+        entry = self.archive.write_segment(archived) if archived else None
+        if entry is not None:
+            with self._lock:
+                self._rotating_file = entry["file"]
+        write_json_atomic(self.json_path, snap)
+        if swapped:
+            os.remove(self.log_path + COMPACTING_EXT)
+        if entry is not None:
+            self.archive.commit(entry)
+            with self._lock:
+                self._rotating      = ()
+                self._rotating_file = None
+            self._last_rotation = entry["moved"]
+            logger.info("archived {} closed order(s) into {}"
+                        .format(entry["count"], entry["file"]))
+        logger.debug("compacted orders into {}".format(self.json_path))
+
+    def _rotation_due(self):
+        return (self.archive is not None and self._old
+                and time.time() >= self._last_rotation + self.rotate_interval)
+
+    def _compactor(self):
+        while True:
+            rotate = False
+            with self._lock:
+                while not self._stopping:
+                    if self._rotation_due():
+                        rotate = True
+                        break
+
+                    left = None
+                    if self._first_record_at is not None:
+                        if self._log_records >= self.compact_records:
+                            break
+                        left = (self._first_record_at + self.compact_interval
+                                - time.monotonic())
+                        if left <= 0:
+                            break
+                    if self.archive is not None and self._old:
+                        until = (self._last_rotation + self.rotate_interval
+                                 - time.time())
+                        left = until if left is None else min(left, until)
+                    self._cond.wait(left)
+
+                if self._stopping:
+                    break
+            try:
+                self.compact(rotate=rotate)
+            except OSError as e:
+                # the log keeps every record meanwhile
+                logger.error("can't compact {}: {!r}".format(self.log_path, e))
+                with self._lock:
+                    self._cond.wait_for(lambda: self._stopping, COMPACT_RETRY)
+
+    ###########################################################################
+    # lifecycle
+
+    def start(self):
+        t = threading.Thread(target=self._compactor, daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def stop(self):
+        '''
+            Effects:    stops the background threads, then makes everything
+                        durable and compacts the log one last time
+        '''
+        with self._lock:
+            self._stopping = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self.sync()
+        self.compact()
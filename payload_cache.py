@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import hashlib
+import threading
+
+import compression
+import json_codec
+import metrics
+
+
+def digest(body):
+    '''
+        Arguments:  body (bytes)
+        Returns:    a 24 hex digit hash of body, for ETags
+    '''
+    # blake2b is Python 3.6's; before that a cut-down sha256 does as well
+    if hasattr(hashlib, "blake2b"):
+        return hashlib.blake2b(body, digest_size=12).hexdigest()
+    return hashlib.sha256(body).hexdigest()[:24]
+
+
+class Payload():
+    '''
+        The "data" of one verb's reply for one version of its database: the
+            encoded JSON, its ETag (a hash of the JSON, so it survives
+            restarts and reloads that change nothing), and a gzip fragment of
+            it made on first use.
+    '''
+
+    def __init__(self, body):
+        self.body  = body
+        self.etag  = '"{}"'.format(digest(body))
+        self._gzip = None
+        self._lock = threading.Lock()
+
+    def gzip(self):
+        if self._gzip is None:
+            with self._lock:
+                if self._gzip is None:
+                    self._gzip = compression.GzipFragment(self.body)
+        return self._gzip
+
+
+# verb name -> (database version, Payload); one version per verb is kept,
+# since an older one is never asked for again
+_payloads = {}
+_lock     = threading.Lock()
+
+
+def etag_matches(if_none_match, etag):
+    '''
+        Arguments:  if_none_match (an If-None-Match header value, or None),
+                    etag (a quoted entity tag)
+        Returns:    whether the client already has that entity
+        Throws:     no
+
+        Weak comparison, as If-None-Match calls for: a W/ prefix is ignored.
+    '''
+    if not isinstance(if_none_match, str):
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def peek(verb, version):
+    '''
+        Arguments:  verb (a string), version (an int)
+        Returns:    the cached Payload for that verb and version, or None
+        Throws:     no
+    '''
+    cached = _payloads.get(verb)
+    if cached is not None and cached[0] == version:
+        metrics.incr("payload_cache.hit")
+        return cached[1]
+    return None
+
+
+def get(verb, version, data):
+    '''
+        Arguments:  verb (a string), version (an int from
+                    json_cache.DBCache.version), data (the verb's reply data
+                    for that version)
+        Returns:    the Payload for that verb and version, encoding data only
+                    if it isn't cached yet
+        Throws:     TypeError if data isn't JSON-serialisable
+        Effects:    counts a hit or a miss
+    '''
+    cached = peek(verb, version)
+    if cached is not None:
+        return cached
+
+    metrics.incr("payload_cache.miss")
+    payload = Payload(json_codec.dumps(data))
+    with _lock:
+        current = _payloads.get(verb)
+        if current is None or current[0] < version:
+            _payloads[verb] = (version, payload)
+    return payload
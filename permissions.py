@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+import coloredlogs
+import logging
+import threading
+
+import json_helper
+import metrics
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("permissions")
+
+# the role every account in elevated_ids.json's "devs" and "sau9" lists has;
+# it is what lets an account edit the menu
+ELEVATED = "elevated"
+
+# the old top-level lists in elevated_ids.json, and the domain their bare IDs
+# belong to
+LEGACY_GROUPS = {
+    "devs": "gmail.com",
+    "sau9": "sau9.org",
+}
+
+# domains whose accounts carry no hosted domain ("hd") claim; an account on
+# any other domain only matches if its token's hd is that domain too, so an
+# address on someone else's domain can't be claimed by a consumer account
+CONSUMER_DOMAINS = ("gmail.com", "googlemail.com")
+
+# how often, in seconds, the file is checked for changes
+RELOAD_INTERVAL = 1
+
+
+def _required_hd(domain):
+    return None if domain in CONSUMER_DOMAINS else domain
+
+
+def build(el_ids):
+    '''
+        Arguments:  el_ids (the contents of elevated_ids.json)
+        Returns:    a dict of (domain, id) -> (required hd, frozenset of
+                    roles), with IDs and domains lowercased
+        Throws:     ValueError if an entry isn't a string or, under "roles",
+                    isn't a full address
+
+        Besides the legacy lists, the file may have a "roles" object mapping
+            a role's name to a list of addresses, like
+            {"roles": {"menu_editor": ["someone@sau9.org"]}}.
+    '''
+    grants = {}
+
+    def grant(domain, idn, role):
+        if not isinstance(idn, str) or not idn:
+            raise ValueError("bad ID in elevated_ids: {!r}".format(idn))
+        grants.setdefault((domain.lower(), idn.lower()), set()).add(role)
+
+    for group, domain in LEGACY_GROUPS.items():
+        for idn in el_ids.get(group, ()):
+            grant(domain, idn, ELEVATED)
+
+    for role, emails in el_ids.get("roles", {}).items():
+        for email in emails:
+            idn, at, domain = str(email).rpartition("@")
+            if not at or not domain:
+                raise ValueError(
+                    "role '{}' needs full addresses, not {!r}"
+                    .format(role, email)
+                )
+            grant(domain, idn, role)
+
+    return {
+        key: (_required_hd(key[0]), frozenset(roles))
+        for key, roles in grants.items()
+    }
+
+
+class PermissionIndex():
+    '''
+        The roles of every account named in elevated_ids.json, held as a dict
+            so a check is one lookup. It is built on first use and rebuilt by
+            a background thread whenever json_helper's cache sees the file
+            change, as it does when util/update_elevated_ids renames a new one
+            into place; a file which can't be read or parsed leaves the last
+            good index in use.
+    '''
+
+    def __init__(self, dbname="elevated_ids"):
+        self.dbname   = dbname
+        self._index   = None
+        self._version = None
+        self._error   = None
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def reload(self):
+        '''
+            Returns:    whether the index changed
+            Throws:     no
+            Effects:    reads the file if it changed since the last build
+        '''
+        with self._lock:
+            try:
+                el_ids  = json_helper.db_cache.get(self.dbname)
+                version = json_helper.db_cache.version(self.dbname)
+                if version == self._version:
+                    return False
+                index = build(el_ids)
+            except (OSError, ValueError, AttributeError, TypeError) as e:
+                metrics.incr("permissions.reload_failure")
+                # the watcher retries every second; say so once per problem
+                if repr(e) != self._error:
+                    self._error = repr(e)
+                    logger.error("can't load {}: {!r}".format(self.dbname, e))
+                if self._index is None:
+                    self._index = {}
+                return False
+            self._index, self._version = index, version
+            self._error = None
+        metrics.incr("permissions.reload")
+        logger.info("{} accounts with roles".format(len(index)))
+        return True
+
+    def roles(self, email, hd=None):
+        '''
+            Arguments:  email (a string), hd (the token's hosted domain, or
+                        None)
+            Returns:    a frozenset of the account's roles; empty for an
+                        unknown account or a mismatched hd
+            Throws:     no
+        '''
+        index = self._index
+        if index is None:
+            self.reload()
+            index = self._index
+
+        idn, _, domain = email.lower().rpartition("@")
+        found = index.get((domain, idn))
+        if found is None or found[0] != hd:
+            return frozenset()
+        return found[1]
+
+    def has_role(self, email, role, hd=None):
+        return role in self.roles(email, hd=hd)
+
+    def _watcher(self):
+        while not self._stop.wait(RELOAD_INTERVAL):
+            self.reload()
+
+    def start(self):
+        '''
+            Effects:    builds the index now and starts the thread which
+                        rebuilds it when the file changes
+        '''
+        self.reload()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watcher, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+index = PermissionIndex()
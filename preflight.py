@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import api_helper
+import metrics
+
+# seconds a browser may reuse a preflight result; Chromium caps this at 7200
+PREFLIGHT_MAX_AGE = 7200
+
+ALLOW_HEADERS = (
+    "Content-Type, Access-Control-Allow-Headers, Origin, " +
+    "Content-Length, Date, X-Unix-Epoch, Host, Connection, If-None-Match"
+)
+
+# origin -> the serialized preflight headers for it; None holds the block
+# for origins which aren't allowed, which carries no ACAO header
+_blocks = {}
+
+
+def _block(origin, max_age):
+    hdrs = []
+    if origin is not None:
+        hdrs += [
+            ("Access-Control-Allow-Origin", origin),
+            ("Access-Control-Max-Age", str(max_age)),
+        ]
+    hdrs += [
+        ("Vary", "Origin"),
+        ("Access-Control-Allow-Methods", "HEAD,GET,POST,OPTIONS"),
+        ("Access-Control-Allow-Headers", ALLOW_HEADERS),
+        ("Accept", "application/json"),
+        ("Strict-Transport-Security", "max-age=31536000"),
+        ("Content-Length", "0"),
+    ]
+    return "".join(
+        "{}: {}\r\n".format(k, v) for k, v in hdrs
+    ).encode("latin-1")
+
+
+def build(origins=None, max_age=PREFLIGHT_MAX_AGE):
+    '''
+        Arguments:  origins (a list<string>, defaulting to
+                    api_helper.ALLOW_FRONTEND_DOMAINS), max_age (an int)
+        Returns:    None
+        Throws:     no
+        Effects:    replaces the cached header blocks
+
+        Serialize the preflight reply headers for every allowed origin once,
+            so answering OPTIONS is a dict lookup and a write.
+    '''
+    global _blocks
+    if origins is None:
+        origins = api_helper.ALLOW_FRONTEND_DOMAINS
+    blocks = {origin: _block(origin, max_age) for origin in origins}
+    blocks[None] = _block(None, max_age)
+    _blocks = blocks
+
+
+def header_block(origin):
+    '''
+        Arguments:  origin (a string or None)
+        Returns:    the bytes of the cached header lines for that origin
+        Throws:     no
+        Effects:    counts a hit for an allowed origin, a miss for any other,
+                    and no_origin for a request without one (not a CORS
+                    preflight at all)
+
+        The block has no status line, Date or Connection header, and no
+            terminating blank line; those depend on the request.
+    '''
+    if origin is None:
+        metrics.incr("preflight.no_origin")
+        return _blocks[None]
+    block = _blocks.get(origin)
+    if block is None:
+        metrics.incr("preflight.miss")
+        return _blocks[None]
+    metrics.incr("preflight.hit")
+    return block
+
+
+build()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+import coloredlogs
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("prefork")
+
+# worker processes to fork when asked for one per core
+PROCESSES = os.cpu_count() or 1
+
+# connections the kernel queues on the shared socket for whichever worker
+# accepts first
+BACKLOG = 128
+
+# a worker which dies within CRASH_WINDOW seconds of starting is restarted
+# only after a delay, doubling from RESTART_DELAY up to RESTART_DELAY_MAX, so
+# one that can't start doesn't fork over and over
+CRASH_WINDOW      = 10
+RESTART_DELAY     = 1
+RESTART_DELAY_MAX = 30
+
+# seconds workers get to finish the requests in hand after SIGTERM, before
+# they are killed
+SHUTDOWN_TIMEOUT = 20
+
+
+def listen(server_address, backlog=BACKLOG):
+    '''
+        Arguments:  server_address (a (host, port) tuple), backlog (an int)
+        Returns:    a listening socket for the workers to share
+        Throws:     OSError
+    '''
+    # what socket.create_server does, which is only in Python 3.8
+    family = socket.AF_INET6 if ":" in server_address[0] else socket.AF_INET
+    sock   = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(server_address)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    # every worker is woken for each new connection but only one gets it;
+    # the rest must not block in accept() waiting for the next
+    sock.setblocking(False)
+    return sock
+
+
+def adopt(server_class, handler_class, sock, **opts):
+    '''
+        Arguments:  server_class (a socketserver-like class taking
+                    bind_and_activate), handler_class, sock (from listen),
+                    and keyword arguments for server_class
+        Returns:    a server_class which accepts on sock instead of a socket
+                    of its own
+        Throws:     OSError
+    '''
+    httpd = server_class(sock.getsockname(), handler_class,
+                         bind_and_activate=False, **opts)
+    if httpd.socket is not None:
+        httpd.socket.close()
+    httpd.socket = sock
+    host, port = sock.getsockname()[:2]
+    httpd.server_name = socket.getfqdn(host)
+    httpd.server_port = port
+    return httpd
+
+
+class Supervisor():
+    '''
+        Forks processes workers, each of which calls target(slot) with its
+            slot number (0 to processes - 1) and exits when it returns.
+
+        A worker that exits while the supervisor is running is forked again
+            in the same slot. SIGTERM or SIGINT to the supervisor passes
+            SIGTERM on to every worker, which should then stop accepting,
+            finish what it has in hand and return; any still running after
+            shutdown_timeout seconds are killed. Workers ignore SIGINT, so a
+            ^C at a terminal stops them through the supervisor too.
+
+        Nothing that starts threads may run in the supervisor before
+            run(), since threads don't survive a fork.
+    '''
+
+    def __init__(self, target, processes=PROCESSES,
+                 shutdown_timeout=SHUTDOWN_TIMEOUT):
+        self.target           = target
+        self.processes        = processes
+        self.shutdown_timeout = shutdown_timeout
+        # pid -> (slot, time.monotonic() when it was forked)
+        self._workers  = {}
+        # slot -> seconds to wait before forking it again after a crash
+        self._delays   = {}
+        self._stopping = threading.Event()
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self._workers[pid] = (slot, time.monotonic())
+            logger.info("worker {} is process {}".format(slot, pid))
+            return
+
+        code = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+            self.target(slot)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception("worker {} crashed".format(slot))
+        finally:
+            logging.shutdown()
+            # never back into the supervisor's loop, or its finally blocks
+            os._exit(code)
+
+    def _stop(self, signo, stack_frame):
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        logger.info("stopping {} worker(s)".format(len(self._workers)))
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        signal.alarm(self.shutdown_timeout)
+
+    def _kill(self, signo, stack_frame):
+        for pid, (slot, _) in self._workers.items():
+            logger.warning("killing worker {} (process {}), still running"
+                           " {}s after SIGTERM"
+                           .format(slot, pid, self.shutdown_timeout))
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        '''
+            Returns:    once every worker has exited after a SIGTERM or
+                        SIGINT
+            Throws:     OSError if a worker can't be forked at first
+            Effects:    forks the workers and restarts them as they die
+        '''
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGALRM, self._kill)
+        for slot in range(self.processes):
+            self._spawn(slot)
+
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self._workers:
+                continue
+            slot, started = self._workers.pop(pid)
+            # what os.waitstatus_to_exitcode does, which is only in 3.9
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) \
+                else -os.WTERMSIG(status)
+            if self._stopping.is_set():
+                logger.info("worker {} exited ({})".format(slot, code))
+                continue
+
+            if time.monotonic() - started < CRASH_WINDOW:
+                delay = self._delays.get(slot, RESTART_DELAY)
+                self._delays[slot] = min(delay * 2, RESTART_DELAY_MAX)
+            else:
+                delay = 0
+                self._delays.pop(slot, None)
+            logger.error("worker {} (process {}) exited ({}); restarting it"
+                         " in {}s".format(slot, pid, code, delay))
+            # a SIGTERM meanwhile cuts the wait short
+            if self._stopping.wait(delay):
+                continue
+            try:
+                self._spawn(slot)
+            except OSError as e:
+                logger.error("can't fork worker {}: {!r}".format(slot, e))
+        signal.alarm(0)
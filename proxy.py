@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+import collections
+import http.client
+import re
+import select
+import socket
+import threading
+import time
+import urllib.parse
+
+import metrics
+
+# seconds to wait for a connection to an upstream server, and then for each
+# read from it
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT    = 30
+
+# requests in flight to one upstream host, and to all of them; a request
+# which can't get a slot within ACQUIRE_TIMEOUT seconds is refused
+MAX_PER_HOST    = 8
+MAX_TOTAL       = 64
+ACQUIRE_TIMEOUT = 5
+
+# idle keep-alive connections kept per host, and seconds one may sit idle
+# before it is assumed the upstream server has dropped it
+IDLE_PER_HOST = 4
+IDLE_TIMEOUT  = 30
+
+# bytes read from upstream at a time and passed on to the client
+CHUNK_SIZE = 16 * 1024
+
+MAX_REDIRECTS = 5
+
+METHODS = ("DELETE", "GET", "HEAD", "PATCH", "POST", "PUT")
+
+# methods which may be sent again when a reused connection turns out to
+# have been closed under us
+IDEMPOTENT = ("DELETE", "GET", "HEAD", "PUT")
+
+USER_AGENT = "sop-buster"
+
+_HAS_SCHEME = re.compile(r"^https?://", re.IGNORECASE)
+
+# what a connection the upstream server closed while it sat idle looks like
+# when it is used again
+_STALE = (http.client.RemoteDisconnected, ConnectionResetError,
+          BrokenPipeError)
+
+
+class ProxyError(Exception):
+    '''
+        A request that couldn't be proxied; status is the HTTP status to
+            answer the client with (502, 503 or 504).
+    '''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _dropped(conn):
+    # an idle connection has nothing to read unless the server has closed it
+    # (or broken protocol), so a readable one isn't worth sending on
+    if conn.sock is None:
+        return True
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
+
+
+class HostPool():
+    '''
+        Keep-alive connections to one upstream (scheme, host, port), and the
+            semaphore limiting the requests in flight to it.
+    '''
+
+    def __init__(self, scheme, host, port, limit, idle, timeouts):
+        self.scheme   = scheme
+        self.host     = host
+        self.port     = port
+        self.idle     = idle
+        self.timeouts = timeouts
+        self._slots   = threading.BoundedSemaphore(limit)
+        self._idle    = collections.deque()
+        self._lock    = threading.Lock()
+
+    def acquire(self):
+        '''
+            Returns:    (a connection, whether it was used before)
+            Throws:     ProxyError(503) if no slot frees up in time
+        '''
+        if not self._slots.acquire(timeout=ACQUIRE_TIMEOUT):
+            metrics.incr("proxy.busy")
+            raise ProxyError(503, "too many requests to {}".format(self.host))
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, since = self._idle.pop()
+                if now - since < IDLE_TIMEOUT and not _dropped(conn):
+                    metrics.incr("proxy.reused")
+                    return conn, True
+                conn.close()
+        metrics.incr("proxy.connects")
+        cls = (http.client.HTTPSConnection if self.scheme == "https"
+               else http.client.HTTPConnection)
+        return cls(self.host, self.port, timeout=self.timeouts[0]), False
+
+    def release(self, conn, reusable):
+        '''
+            Effects:    keeps the connection for the next request if it is
+                        reusable and there is room, and frees the slot
+        '''
+        try:
+            if reusable:
+                with self._lock:
+                    if len(self._idle) < self.idle:
+                        self._idle.append((conn, time.monotonic()))
+                        conn = None
+            if conn is not None:
+                conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+class Upstream():
+    '''
+        An upstream response whose head has arrived: status, reason, headers
+            (an http.client.HTTPMessage) and url (after redirects). Its body
+            is read by iterating over it, as it arrives and at most
+            CHUNK_SIZE at a time; the connection goes back to its pool once
+            the body has been read to the end, or is closed if it's
+            abandoned first. Either way the request's slot in slots (if any)
+            is freed then.
+    '''
+
+    def __init__(self, pool, conn, resp, url, slots=None):
+        self.status  = resp.status
+        self.reason  = resp.reason
+        self.headers = resp.headers
+        self.url     = url
+        self._pool   = pool
+        self._conn   = conn
+        self._resp   = resp
+        self._slots  = slots
+
+    def __iter__(self):
+        done = False
+        try:
+            while True:
+                data = self._resp.read1(CHUNK_SIZE)
+                if not data:
+                    # read1 may stop at the end of a Content-Length body
+                    # without marking the response finished; read() does,
+                    # which lets the connection be used again
+                    self._resp.read()
+                    done = True
+                    return
+                metrics.incr("proxy.bytes", len(data))
+                yield data
+        except (OSError, http.client.HTTPException) as e:
+            metrics.incr("proxy.errors")
+            raise ProxyError(502, "upstream body cut off: {!r}".format(e))
+        finally:
+            self.close(done)
+
+    def close(self, done=False):
+        '''
+            Effects:    hands the connection back, to be used again only if
+                        done says the body was read to the end
+        '''
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            try:
+                pool.release(self._conn, done and not self._resp.will_close)
+            finally:
+                if self._slots is not None:
+                    self._slots.release()
+
+
+class Proxy():
+    '''
+        Makes requests to upstream servers over pooled keep-alive
+            connections, one HostPool per (scheme, host, port), with at most
+            max_total requests in flight at once.
+    '''
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_per_host=MAX_PER_HOST,
+                 max_total=MAX_TOTAL, idle_per_host=IDLE_PER_HOST):
+        self.timeouts     = (connect_timeout, read_timeout)
+        self.max_per_host = max_per_host
+        self.idle         = idle_per_host
+        self._slots       = threading.BoundedSemaphore(max_total)
+        self._pools       = {}
+        self._lock        = threading.Lock()
+
+    def _pool(self, scheme, host, port):
+        key = (scheme, host, port)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = HostPool(
+                        scheme, host, port, self.max_per_host, self.idle,
+                        self.timeouts
+                    )
+        return pool
+
+    def _send(self, method, parts, body, headers):
+        pool = self._pool(parts.scheme, parts.hostname, parts.port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+
+        for attempt in range(2):
+            conn, reused = pool.acquire()
+            try:
+                conn.timeout = self.timeouts[0]
+                conn.request(method, target, body=body, headers=headers)
+                # the connect timeout has done its job; reads get longer
+                if conn.sock is not None:
+                    conn.sock.settimeout(self.timeouts[1])
+                return pool, conn, conn.getresponse()
+            except _STALE as e:
+                pool.release(conn, False)
+                if reused and attempt == 0 and method in IDEMPOTENT:
+                    metrics.incr("proxy.stale")
+                    continue
+                raise ProxyError(502, "upstream closed the connection: {!r}"
+                                 .format(e))
+            except socket.timeout:
+                pool.release(conn, False)
+                raise ProxyError(504, "upstream timed out")
+            except (OSError, http.client.HTTPException) as e:
+                pool.release(conn, False)
+                raise ProxyError(502, "can't reach upstream: {!r}".format(e))
+
+    def request(self, method, url, body=b"", headers=None):
+        '''
+            Arguments:  method (a string from METHODS), url (a string; http://
+                        is assumed without a scheme), body (bytes), headers
+                        (a dict, or None)
+            Returns:    an Upstream, which must be iterated over or closed
+            Throws:     ProxyError, and ValueError for a bad method or URL
+            Effects:    follows up to MAX_REDIRECTS redirects, like requests
+                        does
+
+            The body is not read here, so the client can be sent it as it
+                arrives.
+        '''
+        method = method.upper()
+        if method not in METHODS:
+            raise ValueError("can't proxy method {}".format(method))
+        if not _HAS_SCHEME.match(url):
+            url = "http://" + url
+
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", USER_AGENT)
+
+        if not self._slots.acquire(timeout=ACQUIRE_TIMEOUT):
+            metrics.incr("proxy.busy")
+            raise ProxyError(503, "too many proxied requests")
+        # the slot is the Upstream's to free once it has been returned
+        slots = self._slots
+        try:
+            start = time.perf_counter()
+            for _ in range(MAX_REDIRECTS + 1):
+                parts = urllib.parse.urlsplit(url)
+                if parts.scheme.lower() not in ("http", "https") \
+                        or not parts.hostname:
+                    raise ValueError("can't proxy URL {}".format(url))
+                parts = parts._replace(scheme=parts.scheme.lower())
+                metrics.incr("proxy.requests")
+                pool, conn, resp = self._send(
+                    method, parts,
+                    body if body or method in ("PATCH", "POST", "PUT")
+                    else None,
+                    headers
+                )
+                location = resp.getheader("Location")
+                if resp.status not in (301, 302, 303, 307, 308) \
+                        or not location:
+                    metrics.observe("proxy.ttfb",
+                                    time.perf_counter() - start)
+                    upstream, slots = Upstream(pool, conn, resp, url,
+                                               slots), None
+                    return upstream
+
+                # a redirect's own body is thrown away; reading it lets the
+                # connection be used again
+                Upstream(pool, conn, resp, url).close(_drain(resp))
+                url = urllib.parse.urljoin(url, location)
+                if resp.status == 303 or (
+                        resp.status in (301, 302) and method == "POST"):
+                    method = "HEAD" if method == "HEAD" else "GET"
+                    body   = b""
+            raise ProxyError(502, "more than {} redirects"
+                             .format(MAX_REDIRECTS))
+        finally:
+            if slots is not None:
+                slots.release()
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+
+
+def _drain(resp, limit=CHUNK_SIZE * 4):
+    try:
+        left = limit
+        while left > 0:
+            data = resp.read(min(left, CHUNK_SIZE))
+            if not data:
+                return True
+            left -= len(data)
+    except (OSError, http.client.HTTPException):
+        pass
+    return False
+
+
+proxy = Proxy()
+
+
+def configure(connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+              max_per_host=MAX_PER_HOST, max_total=MAX_TOTAL):
+    '''
+        Effects:    replaces the module's Proxy with one made with these
+                    settings, dropping the old one's idle connections
+    '''
+    global proxy
+    old, proxy = proxy, Proxy(
+        connect_timeout=connect_timeout, read_timeout=read_timeout,
+        max_per_host=max_per_host, max_total=max_total
+    )
+    old.close()
@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+import collections
+import email.utils
+import hashlib
+import http.client
+import os
+import threading
+import time
+from os import path
+
+import coloredlogs
+import logging
+
+import json_codec
+import metrics
+import proxy
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("proxy_cache")
+
+# bytes of responses kept in memory, and the largest one kept at all;
+# bigger bodies are streamed through uncached
+CACHE_BYTES = 32 * 2 ** 20
+ENTRY_MAX   = 2 ** 20
+
+# bytes of responses kept on disk when a cache directory is given
+DISK_BYTES = 256 * 2 ** 20
+
+# with neither max-age nor Expires, a response with a Last-Modified is
+# fresh for this fraction of its age when fetched, up to HEURISTIC_MAX
+# seconds, as RFC 9111 section 4.2.2 suggests
+HEURISTIC_FRACTION = .1
+HEURISTIC_MAX      = 24 * 60 * 60
+
+CACHEABLE_METHODS = ("GET", "HEAD")
+
+# statuses which may be cached without explicit freshness (RFC 9110 section
+# 15.1); anything else is always fetched
+CACHEABLE_STATUS = (200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501)
+
+# seconds a request waits on an identical one already going upstream before
+# giving up and making its own
+COALESCE_TIMEOUT = proxy.CONNECT_TIMEOUT + proxy.READ_TIMEOUT
+
+
+def _directives(value):
+    out = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.partition("=")
+        name = name.strip().lower()
+        if name:
+            out[name] = arg.strip().strip('"') or True
+    return out
+
+
+def _date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def freshness(status, headers, now):
+    '''
+        Arguments:  status (an int), headers (an http.client.HTTPMessage),
+                    now (a time.time())
+        Returns:    (seconds the response is fresh for, when it was made) if
+                    it may be stored, else None
+        Throws:     no
+
+        A shared cache's reading of RFC 9111: no-store, private, Vary: *
+            and Set-Cookie mean it isn't stored; no-cache means it is, but
+            checked with upstream before every use. A response with no
+            freshness of its own is kept only if it has a validator to
+            check it with.
+    '''
+    cc = _directives(headers.get("Cache-Control"))
+    if (status not in CACHEABLE_STATUS or "no-store" in cc
+            or "private" in cc or headers.get("Set-Cookie")
+            or "*" in (headers.get("Vary") or "")):
+        return None
+
+    lifetime = None
+    for name in ("s-maxage", "max-age"):
+        if name in cc:
+            try:
+                lifetime = max(0, int(cc[name]))
+                break
+            except (TypeError, ValueError):
+                lifetime = 0
+    date = _date(headers.get("Date")) or now
+    if lifetime is None and headers.get("Expires"):
+        expires  = _date(headers["Expires"])
+        lifetime = 0 if expires is None else max(0, expires - date)
+    if lifetime is None:
+        modified = _date(headers.get("Last-Modified"))
+        lifetime = 0 if modified is None else min(
+            HEURISTIC_MAX, max(0, date - modified) * HEURISTIC_FRACTION
+        )
+    if "no-cache" in cc:
+        lifetime = 0
+
+    if not lifetime and not (headers.get("ETag")
+                             or headers.get("Last-Modified")):
+        return None
+    try:
+        age = max(0, int(headers.get("Age") or 0))
+    except ValueError:
+        age = 0
+    return lifetime, now - age
+
+
+class Response():
+    '''
+        What the server writes back for a proxied request, from upstream or
+            from the cache: status, reason, headers, url, and cache (HIT,
+            MISS, REVALIDATED or BYPASS). Iterating over it gives the body;
+            it must be iterated to the end or closed.
+    '''
+
+    def __init__(self, status, reason, headers, url, chunks, cache,
+                 close=None):
+        self.status  = status
+        self.reason  = reason
+        self.headers = headers
+        self.url     = url
+        self.cache   = cache
+        self._chunks = chunks
+        self._close  = close
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+
+
+class Entry():
+    '''
+        One stored response; headers is a list of (name, value) pairs.
+    '''
+
+    def __init__(self, status, reason, headers, url, body, lifetime, born):
+        self.status   = status
+        self.reason   = reason
+        self.headers  = headers
+        self.url      = url
+        self.body     = body
+        self.lifetime = lifetime
+        self.born     = born
+        self.size     = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+    def fresh(self, now):
+        return now - self.born < self.lifetime
+
+    def header(self, name):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def message(self, now):
+        msg = http.client.HTTPMessage()
+        for key, value in self.headers:
+            if key.lower() != "age":
+                msg[key] = value
+        msg["Age"] = str(int(max(0, now - self.born)))
+        return msg
+
+    def response(self, now, cache):
+        return Response(self.status, self.reason, self.message(now),
+                        self.url, (self.body,), cache)
+
+    def revalidated(self, headers, now):
+        '''
+            Arguments:  headers (the 304's HTTPMessage), now
+            Returns:    a new Entry with this body and the 304's headers laid
+                        over these, or None if they say not to store it
+        '''
+        names   = {key.lower() for key in headers.keys()}
+        merged  = [(k, v) for k, v in self.headers if k.lower() not in names]
+        merged += list(headers.items())
+        msg = http.client.HTTPMessage()
+        for key, value in merged:
+            msg[key] = value
+        fresh = freshness(self.status, msg, now)
+        if fresh is None:
+            return None
+        return Entry(self.status, self.reason, merged, self.url, self.body,
+                     *fresh)
+
+    def dump(self):
+        return json_codec.dumps({
+            "status": self.status, "reason": self.reason, "url": self.url,
+            "headers": self.headers, "lifetime": self.lifetime,
+            "born": self.born,
+        }) + b"\n" + self.body
+
+    @classmethod
+    def load(cls, data):
+        meta, _, body = data.partition(b"\n")
+        meta = json_codec.loads(meta)
+        return cls(meta["status"], meta["reason"],
+                   [tuple(h) for h in meta["headers"]], meta["url"], body,
+                   meta["lifetime"], meta["born"])
+
+
+class DiskStore():
+    '''
+        Entries as files named by their key in one directory, oldest
+            (by mtime, which a read refreshes) deleted first once there are
+            more than max_bytes of them.
+    '''
+
+    def __init__(self, directory, max_bytes=DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock     = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._bytes = sum(
+            entry.stat().st_size for entry in os.scandir(directory)
+            if entry.is_file()
+        )
+
+    def _path(self, key):
+        return path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                entry = Entry.load(f.read())
+            os.utime(self._path(key))
+            return entry
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def put(self, key, entry):
+        data = entry.dump()
+        temp = "{}.{}.{}.temp".format(
+            self._path(key), os.getpid(), threading.get_ident()
+        )
+        try:
+            with open(temp, "wb") as f:
+                f.write(data)
+            try:
+                old = os.stat(self._path(key)).st_size
+            except OSError:
+                old = 0
+            os.rename(temp, self._path(key))
+        except OSError as e:
+            logger.error("can't write cache entry: {!r}".format(e))
+            return
+        with self._lock:
+            self._bytes += len(data) - old
+            if self._bytes > self.max_bytes:
+                self._prune()
+
+    def _prune(self):
+        files = sorted(
+            (entry for entry in os.scandir(self.directory)
+             if entry.is_file() and not entry.name.endswith(".temp")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        # down to nine tenths, so this doesn't run again on the next put
+        for entry in files:
+            if self._bytes <= self.max_bytes * .9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._bytes -= size
+            except OSError:
+                pass
+
+
+class _Flight():
+    def __init__(self):
+        self.done  = threading.Event()
+        self.entry = None
+
+
+class ProxyCache():
+    '''
+        A bounded LRU of proxied responses, keyed by method, URL, body and
+            the Accept-Encoding sent upstream, in front of proxy.proxy.
+
+        Fresh entries are served without going upstream; stale ones with an
+            ETag or Last-Modified are revalidated with a conditional request.
+            Identical requests arriving while one is upstream wait for it
+            rather than going upstream too. With a directory, entries also
+            go to a DiskStore, which outlives restarts.
+    '''
+
+    def __init__(self, max_bytes=CACHE_BYTES, entry_max=ENTRY_MAX,
+                 directory=None, clock=time.time):
+        self.max_bytes = max_bytes
+        self.entry_max = min(entry_max, max_bytes)
+        self.disk      = None if directory is None else DiskStore(directory)
+        self._clock    = clock
+        self._entries  = collections.OrderedDict()
+        self._bytes    = 0
+        self._flights  = {}
+        self._lock     = threading.Lock()
+
+    @staticmethod
+    def key(method, url, body, accept):
+        h = hashlib.sha256()
+        for part in (method, url, accept or ""):
+            h.update(part.encode("utf-8") + b"\0")
+        h.update(body or b"")
+        return h.hexdigest()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        if self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self._put(key, entry, disk=False)
+        return entry
+
+    def _put(self, key, entry, disk=True):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[key] = entry
+            self._bytes += entry.size
+            while self._bytes > self.max_bytes:
+                self._bytes -= self._entries.popitem(last=False)[1].size
+                metrics.incr("proxy_cache.evict")
+            metrics.gauge("proxy_cache.bytes", self._bytes)
+            metrics.gauge("proxy_cache.entries", len(self._entries))
+        if disk and self.disk is not None:
+            self.disk.put(key, entry)
+
+    def _count(self, outcome):
+        metrics.incr("proxy_cache." + outcome)
+        hits   = metrics.get("proxy_cache.hit") \
+            + metrics.get("proxy_cache.coalesced") \
+            + metrics.get("proxy_cache.revalidated")
+        misses = metrics.get("proxy_cache.miss")
+        metrics.gauge("proxy_cache.hit_rate",
+                      round(hits / max(1, hits + misses), 4))
+
+    @staticmethod
+    def _pass(upstream, cache):
+        return Response(upstream.status, upstream.reason, upstream.headers,
+                        upstream.url, upstream, cache, upstream.close)
+
+    def fetch(self, method, url, body=b"", headers=None):
+        '''
+            Arguments:  as for proxy.Proxy.request
+            Returns:    a Response
+            Throws:     as proxy.Proxy.request does
+            Effects:    may go upstream, and store what comes back
+        '''
+        method  = method.upper()
+        headers = dict(headers or {})
+        if method not in CACHEABLE_METHODS:
+            self._count("bypass")
+            return self._pass(
+                proxy.proxy.request(method, url, body=body, headers=headers),
+                "BYPASS"
+            )
+
+        key   = self.key(method, url, body, headers.get("Accept-Encoding"))
+        now   = self._clock()
+        entry = self._get(key)
+        if entry is not None and entry.fresh(now):
+            self._count("hit")
+            return entry.response(now, "HIT")
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait(COALESCE_TIMEOUT)
+            if flight.entry is not None:
+                self._count("coalesced")
+                return flight.entry.response(self._clock(), "HIT")
+            # the leader's response couldn't be stored; fetch it anew
+            self._count("miss")
+            return self._pass(
+                proxy.proxy.request(method, url, body=body, headers=headers),
+                "MISS"
+            )
+
+        try:
+            response, flight.entry = self._fill(
+                key, method, url, body, headers, entry
+            )
+            return response
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _fill(self, key, method, url, body, headers, entry):
+        # returns (a Response, the Entry stored for it or None)
+        if entry is not None:
+            if entry.header("ETag"):
+                headers["If-None-Match"] = entry.header("ETag")
+            if entry.header("Last-Modified"):
+                headers["If-Modified-Since"] = entry.header("Last-Modified")
+
+        upstream = proxy.proxy.request(method, url, body=body,
+                                       headers=headers)
+        now = self._clock()
+
+        if upstream.status == 304 and entry is not None:
+            for _ in upstream:
+                pass
+            fresh = entry.revalidated(upstream.headers, now)
+            if fresh is None:
+                self._count("revalidated")
+                return entry.response(now, "REVALIDATED"), None
+            self._put(key, fresh)
+            self._count("revalidated")
+            return fresh.response(now, "REVALIDATED"), fresh
+
+        self._count("miss")
+        fresh = freshness(upstream.status, upstream.headers, now)
+        if fresh is None:
+            return self._pass(upstream, "MISS"), None
+
+        # read as much as may be stored; if the body is bigger, what has
+        # been read goes out ahead of the rest, unstored
+        chunks, size = [], 0
+        parts = iter(upstream)
+        try:
+            for chunk in parts:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > self.entry_max:
+                    return Response(
+                        upstream.status, upstream.reason, upstream.headers,
+                        upstream.url, _chain(chunks, parts), "MISS",
+                        upstream.close
+                    ), None
+        except BaseException:
+            upstream.close()
+            raise
+
+        stored = Entry(upstream.status, upstream.reason,
+                       list(upstream.headers.items()), upstream.url,
+                       b"".join(chunks), *fresh)
+        self._put(key, stored)
+        metrics.incr("proxy_cache.store")
+        return stored.response(now, "MISS"), stored
+
+
+def _chain(first, rest):
+    yield from first
+    yield from rest
+
+
+cache = ProxyCache()
+
+
+def configure(max_bytes=CACHE_BYTES, directory=None):
+    '''
+        Effects:    replaces the module's ProxyCache with an empty one made
+                    with these settings
+    '''
+    global cache
+    cache = ProxyCache(max_bytes=max_bytes, directory=directory)
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 # adapted from https://gist.github.com/nitaku/10d0662536f37a087e1b
 import coloredlogs
+import functools
+import itertools
 import logging
-import json
 import signal
+import socket
 import sys
 import time
 import threading
@@ -12,23 +14,120 @@ import urllib
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
+import aio_server
 import anticsrf.anticsrf as anticsrf
 import api_helper
+import compression
 import json_helper
 import dev_vars
+import gapi_auth
+import json_codec
+import json_stream
+import metrics
+import payload_cache
+import permissions
+import prefork
+import preflight
+import proxy
+import proxy_cache
+import signed_tokens
+import static_assets
+import token_store
+import worker_pool
 
 import httplib2shim
 httplib2shim.patch()
 
-token_clerk = anticsrf.token_clerk(
-    # preset_tokens=( ("ab", 3874563875463487), ),
+token_clerk = token_store.TokenStore(
     keysize=42,
     keyfunc=anticsrf.random_key,
     expire_after= (3278465347856738456834754
                    if dev_vars.DEV_DISABLE_TIMESTAMP_CHECKS
-                   else (10 ** 6) * (60 ** 2))
+                   else token_store.EXPIRE_AFTER)
 )
 
+# seconds a persistent connection may sit idle between requests; the pooled
+# mode, where an idle connection holds a thread, uses its own shorter
+# worker_pool.KEEPALIVE_IDLE
+KEEPALIVE_TIMEOUT = 15
+
+# requests served on one connection before the server asks to close it
+KEEPALIVE_MAX_REQUESTS = 100
+
+# most of a request or response body that goes into the debug log
+LOG_BODY_MAX = 512
+
+# clients allowed to read GET /stats
+LOCAL_ADDRS = ("127.0.0.1", "::1", "::ffff:127.0.0.1")
+
+# how often, in seconds, a worker process checks that its database threads
+# are alive and the writer isn't stuck; if not, it exits to be restarted
+WATCHDOG_INTERVAL = 5
+
+
+def run_verb(verbstr, data, csrf_bound_to=None):
+    '''
+        Arguments:  verbstr (a string), data (the request's data) and
+                    csrf_bound_to (the batch's, from Server.exc_verb)
+        Returns:    the reply data and an HTTP status code (an int)
+        Throws:     no
+        Effects:    side effects of the verb's function
+
+        Run one request from inside a batch. Unlike Server.exc_verb nothing
+            is written to the client; errors come back as a status code with
+            the error as the data.
+    '''
+    spec = api_helper.VERBS.get(verbstr)
+    if spec is None or spec.name == "batch":
+        return api_helper.to_error_json(
+            "bad verb in batch: {}".format(verbstr)
+        ), 400
+    if not isinstance(data, dict):
+        return api_helper.to_error_json(
+            "batched request's data must be an object"
+        ), 400
+
+    missing = api_helper.missing_keys(spec, data)
+    if missing:
+        return api_helper.to_error_json(
+            "verb '{}' requires missing data key(s): {}"
+            .format(verbstr, ", ".join(missing))
+        ), 400
+
+    args = tuple(VERB_ARGS[a] for a in spec.args) or (None,)
+    try:
+        res, ok = spec.func(data, *args, csrf_bound_to=csrf_bound_to,
+                            **spec.kwargs)
+    except Exception:
+        logger.error("batched verb {} failed: {}"
+                     .format(verbstr, traceback.format_exc()))
+        return api_helper.to_error_json("internal error"), 500
+    return res, (200 if ok is True else ok[0])
+
+
+# server-side objects a verb can ask for by name in its VerbSpec.args
+VERB_ARGS = {
+    "token_clerk": token_clerk,
+    "run_verb": run_verb,
+}
+
+
+class _Snippet():
+    '''
+        The start of a body, formatted for the log only if the record is
+            actually emitted, and cut off after LOG_BODY_MAX characters.
+    '''
+
+    def __init__(self, body):
+        self.body = body
+
+    def __str__(self):
+        head = self.body[:LOG_BODY_MAX]
+        if isinstance(head, bytes):
+            head = head.decode("utf-8", "replace")
+        more = len(self.body) - LOG_BODY_MAX
+        return head + ("... ({} more)".format(more) if more > 0 else "")
+
 
 # def dprint(*args, **kwargs):
 #     return
@@ -43,6 +142,84 @@ class Server(BaseHTTPRequestHandler):
 
     protocol_version = "HTTP/1.1"
 
+    # idle timeout for persistent connections; StreamRequestHandler applies it
+    # to the socket, and handle_one_request closes the connection when it
+    # expires
+    timeout = KEEPALIVE_TIMEOUT
+
+    # headers and body go out in separate writes; without TCP_NODELAY a
+    # reused connection waits on the peer's delayed ACK for the second one
+    disable_nagle_algorithm = True
+
+    # whether the socket has the idle timeout on, waiting for the next
+    # request; asyncio mode makes handlers without setup() and never sets it
+    _idle = False
+
+    def setup(self):
+        super().setup()
+        self.requests_served = 0
+
+    def idle_timeout(self):
+        '''
+            Returns:    seconds this connection may wait for its next request
+            Throws:     no
+        '''
+        return getattr(self.server, "keepalive_idle", KEEPALIVE_TIMEOUT)
+
+    def handle_one_request(self):
+        '''
+            Arguments:  none
+            Returns:    None
+            Throws:     inherited
+            Effects:    inherited, and finishes the headers of a response that
+                        never wrote a body
+
+            Handle one request on a (possibly persistent) connection.
+        '''
+        self._headers_open = False
+        # between requests the wait may be shorter than within one; asyncio
+        # mode has no socket here and times idle connections out itself
+        if (self.requests_served and self.request is not None
+                and self.idle_timeout() != self.timeout):
+            self.connection.settimeout(self.idle_timeout())
+            self._idle = True
+        super().handle_one_request()
+        if self._headers_open:
+            self.write_bytes(b"")
+            self.wfile.flush()
+        self.requests_served += 1
+
+    def parse_request(self):
+        if self._idle:
+            # the request line is in, so the rest gets the usual timeout
+            self.connection.settimeout(self.timeout)
+            self._idle = False
+        return super().parse_request()
+
+    def keep_alive(self):
+        '''
+            Arguments:  none
+            Returns:    a bool
+            Throws:     no
+            Effects:    none
+
+            Whether the connection should stay open after this response, going
+                by the client's Connection header, its HTTP version, how many
+                requests this connection has already carried, and whether the
+                server's worker pool has connections waiting.
+        '''
+        if self.requests_served + 1 >= KEEPALIVE_MAX_REQUESTS:
+            return False
+        saturated = getattr(self.server, "saturated", None)
+        if saturated is not None and saturated():
+            return False
+        conn = (self.headers.get("Connection") or "").lower()
+        if "close" in conn:
+            return False
+        if self.request_version == "HTTP/1.0":
+            return "keep-alive" in conn
+        return True
+
     def enable_dynamic_cors(self):
         '''
             Arguments:  none
@@ -66,6 +243,111 @@ class Server(BaseHTTPRequestHandler):
         if http_origin in api_helper.ALLOW_FRONTEND_DOMAINS:
             self.send_header("Access-Control-Allow-Origin", http_origin)
 
+    def write_bytes(self, data):
+        '''
+            Arguments:  data (bytes)
+            Returns:    None
+            Throws:     inherited
+            Effects:    Modifies self.wfile by writing bytes there.
+
+            Write the whole response body. If set_headers left the headers
+                open, Content-Length is sent and the headers are ended first,
+                so the body must be written in one call.
+        '''
+        if self._headers_open:
+            self._headers_open = False
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+        self.wfile.write(data)
+        metrics.incr("response.bytes", len(data))
+
+    def choose_coding(self, size, prefer=None):
+        '''
+            Arguments:  size (an int; the body's length, or None if it isn't
+                        known yet), prefer (as for compression.negotiate)
+            Returns:    the content coding to use, or None
+            Throws:     no
+            Effects:    if the headers are still open, sends Vary and the
+                        Content-Encoding chosen
+
+            Negotiate compression for a body about to be written, going by
+                Accept-Encoding and compression.min_size().
+        '''
+        if not self._headers_open:
+            return None
+        self.send_header("Vary", "Accept-Encoding")
+        if size is not None and size < compression.min_size():
+            return None
+        coding = compression.negotiate(
+            self.headers.get("Accept-Encoding"), prefer
+        )
+        if coding is not None:
+            self.send_header("Content-Encoding", coding)
+        return coding
+
+    def write_body(self, data):
+        '''
+            Arguments:  data (bytes)
+            Returns:    None
+            Throws:     inherited
+            Effects:    Modifies self.wfile by writing bytes there.
+
+            Like write_bytes, but compressed when the client accepts it and
+                the body is big enough to be worth it.
+        '''
+        coding = self.choose_coding(len(data))
+        if coding is not None:
+            data = compression.compress(data, coding)
+        self.write_bytes(data)
+
+    def write_chunks(self, chunks, compress=True):
+        '''
+            Arguments:  chunks (an iterable of bytes), compress (False for a
+                        body which already has a Content-Encoding)
+            Returns:    None
+            Throws:     inherited, and anything thrown while iterating chunks
+            Effects:    Modifies self.wfile by writing bytes there.
+
+            Write a response body as it is produced. A body which ends within
+                its first chunk goes out like write_body, with a
+                Content-Length; a longer one is compressed as it goes if the
+                client accepts that, and sent with chunked transfer-encoding,
+                so it never has to be held in memory whole. HTTP/1.0 clients
+                can't take chunks, and get the body joined.
+        '''
+        chunks = iter(chunks)
+        first  = next(chunks, b"")
+        logger.debug("Response: %s", _Snippet(first))
+        second = next(chunks, None)
+        if second is None:
+            (self.write_body if compress else self.write_bytes)(first)
+            return
+
+        chunks = itertools.chain((first, second), chunks)
+        coding = self.choose_coding(None) if compress else None
+        if coding is not None:
+            chunks = compression.Encoder(coding).stream(chunks)
+        if self.request_version == "HTTP/1.0" or not self._headers_open:
+            self.write_bytes(b"".join(chunks))
+            return
+
+        self._headers_open = False
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        sent = 0
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                    sent += len(chunk)
+        except Exception:
+            # the status line has gone out; all we can do is cut the body off
+            self.close_connection = True
+            raise
+        finally:
+            metrics.incr("response.bytes", sent)
+        self.wfile.write(b"0\r\n\r\n")
+
     def write_str(self, data):
         '''
             Arguments:  data (a string or other string-like that can be cast to
@@ -77,23 +359,157 @@ class Server(BaseHTTPRequestHandler):
 
             Shorthand for writing a string back to the remote end.
         '''
-        logger.debug("Response: " + str(data))
-        self.wfile.write(bytes(data, "utf-8"))
+        logger.debug("Response: %s", _Snippet(data))
+        self.write_body(bytes(data, "utf-8"))
 
-    def write_json(self, obj):
+    def write_json(self, obj, pretty=False):
         '''
-            Arguments:  obj (a dict)
+            Arguments:  obj (a dict), pretty (a bool)
             Returns:    None
-            Throws:     json.dumps throws TypeError if the provided argument
-                        is not serialisable to JSON, and anything thrown by
-                        self.write_str
+            Throws:     TypeError if the provided argument is not serialisable
+                        to JSON, and anything thrown by self.write_chunks
             Effects:    inherited
 
             Take (probably) a Python dictionary and write it to the remote end
-                as JSON.
+                as JSON, compact unless pretty is set, streaming it with
+                json_stream so a large reply is never serialised all at once.
 
         '''
-        self.write_str(json.dumps(obj, indent=2))
+        self.write_chunks(json_stream.iter_json(obj, pretty))
+
+    def write_payload(self, reply, payload):
+        '''
+            Arguments:  reply (a dict like write_json's, without "data"),
+                        payload (a payload_cache.Payload)
+            Returns:    None
+            Throws:     inherited
+            Effects:    inherited
+
+            Write reply as compact JSON with the payload as its "data",
+                reusing the payload's encoding and, for gzip, its compressed
+                form, so only the small envelope is built per request.
+        '''
+        reply  = dict(reply)
+        prefix = (b'{"response":' + json_codec.dumps(reply.pop("response"))
+                  + b',"data":')
+        suffix = b"".join(
+            b"," + json_codec.dumps(k) + b":" + json_codec.dumps(v)
+            for k, v in reply.items()
+        ) + b"}"
+
+        size   = len(prefix) + len(payload.body) + len(suffix)
+        coding = self.choose_coding(size, prefer=("gzip", "br"))
+        if coding == "gzip":
+            self.write_bytes(
+                compression.gzip_splice(prefix, payload.gzip(), suffix)
+            )
+        elif coding is not None:
+            self.write_bytes(compression.compress(
+                prefix + payload.body + suffix, coding
+            ))
+        else:
+            self.write_bytes(prefix + payload.body + suffix)
+
+    def write_not_modified(self, etag, headers=(), csop=False):
+        '''
+            Arguments:  etag (a quoted entity tag), headers (more headers, as
+                        for set_headers), csop (as for set_headers)
+            Returns:    None
+            Throws:     inherited
+            Effects:    sends a complete 304 response, which has no body
+
+            Tell the client that the copy it holds, tagged etag, is current.
+        '''
+        metrics.incr("response.not_modified")
+        self.set_headers(304, headers=(
+            ("ETag", etag),
+            ("Access-Control-Expose-Headers", "ETag"),
+        ) + tuple(headers), csop=csop)
+        self._headers_open = False
+        self.end_headers()
+
+    def write_file(self, filename, size):
+        '''
+            Arguments:  filename (a path), size (an int; bytes to send)
+            Returns:    None
+            Throws:     inherited, and OSError if the file can't be read
+            Effects:    Modifies self.wfile by writing bytes there.
+
+            Write the first size bytes of a file as the whole response body,
+                with sendfile when the client's socket is at hand, so the
+                bytes never pass through Python; otherwise (as under
+                aio_server) a chunk at a time.
+        '''
+        with open(filename, "rb") as f:
+            if self._headers_open:
+                self._headers_open = False
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+            sent = 0
+            try:
+                if isinstance(self.request, socket.socket):
+                    self.wfile.flush()
+                    sent = self.request.sendfile(f, 0, size)
+                else:
+                    while sent < size:
+                        data = f.read(min(size - sent,
+                                          static_assets.CHUNK_SIZE))
+                        if not data:
+                            break
+                        self.wfile.write(data)
+                        sent += len(data)
+            finally:
+                metrics.incr("response.bytes", sent)
+            if sent < size:
+                # the file shrank under us, and Content-Length is a promise
+                # only closing the connection can take back
+                self.close_connection = True
+
+    def write_asset(self, asset):
+        '''
+            Arguments:  asset (a static_assets.Asset)
+            Returns:    None
+            Throws:     inherited
+            Effects:    inherited
+
+            Answer a request for a static asset with its preloaded bytes, in
+                the compressed form the client takes if there is one, or
+                with 304 if the client's copy is current.
+        '''
+        try:
+            version = asset.current()
+        except OSError:
+            self.set_headers(404)
+            self.write_json_error("not found")
+            return
+
+        codings = version.codings()
+        coding  = compression.negotiate(
+            self.headers.get("Accept-Encoding"), codings
+        ) if codings else None
+        variant = version.variants[coding]
+
+        headers = [
+            ("Cache-Control", "public, max-age={}".format(asset.max_age)),
+            ("Last-Modified", version.last_modified),
+        ]
+        if codings:
+            headers.append(("Vary", "Accept-Encoding"))
+        if payload_cache.etag_matches(self.headers.get("If-None-Match"),
+                                      variant.etag):
+            self.write_not_modified(variant.etag, headers, csop=asset.csop)
+            return
+
+        headers = [("Content-Type", asset.content_type),
+                   ("ETag", variant.etag)] + headers
+        if coding is not None:
+            headers.append(("Content-Encoding", coding))
+        metrics.incr("static.requests")
+        self.set_headers(200, headers=headers, csop=asset.csop)
+        if variant.body is not None:
+            self.write_bytes(variant.body)
+        else:
+            self.write_file(asset.filename, variant.size)
 
     def write_json_error(self, err, expl=""):
         '''
@@ -109,7 +525,7 @@ class Server(BaseHTTPRequestHandler):
 
         self.write_json( {"error": err, "explanation": expl} )
 
-    def set_headers(self, resp, headers=(), msg=None, close=True, csop=False):
+    def set_headers(self, resp, headers=(), msg=None, close=None, csop=False):
         '''
             Arguments:  resp (an int), headers (a tuple<tuple<string,
                         string>>), msg (a string), close (a bool), csop
@@ -117,9 +533,9 @@ class Server(BaseHTTPRequestHandler):
             Returns:    None
             Throws:     inherited
                         its own exceptions)
-            Effects:    Sends headers to the remote end, and calls
-                        self.end_headers, meaning that no more headers can be
-                        sent.
+            Effects:    Buffers headers to be sent to the remote end; they are
+                        ended (with Content-Length) by the first write_bytes,
+                        or at the end of the request if no body follows.
 
             Sends the appropriate headers given an HTTP response code.
             Also sends any headers specified in the headers argument.
@@ -128,9 +544,12 @@ class Server(BaseHTTPRequestHandler):
                 present in `headers`.
             An alternate message can be specified, so that instead of "200 OK",
                 "200 Hello" could be sent instead.
-            If close is True, its default value, the header "Connection: Close"
-                is sent. Otherwise, if close evaluates to False, "Connection:
-                keep-alive" is sent. This is not recommended.
+            If close is None, its default value, the connection is kept alive
+                unless the client asked to close it, spoke HTTP/1.0 without
+                asking for keep-alive, has used up KEEPALIVE_MAX_REQUESTS, or
+                the worker pool has other connections waiting.
+                close=True forces "Connection: close", which is needed when
+                the request body was not read.
             If csop is True, Access-Control-Allow-Origin is set to *, allowing
                 requests from anywhere.
 
@@ -142,9 +561,12 @@ class Server(BaseHTTPRequestHandler):
             Date: Fri, 19 May 2017 12:14:12 GMT
             Content-Type: application/json
             Access-Control-Allow-Origin: <client origin or omitted>
+            Connection: keep-alive
+            Keep-Alive: timeout=15, max=99
             Access-Control-Allow-Methods: HEAD,GET,POST,OPTIONS
             Accept: application/json
-            Connection: Close
+            Strict-Transport-Security: max-age=31536000
+            Content-Length: <length of the body>
         '''
         self.send_response(resp, message=msg)
 
@@ -160,7 +582,19 @@ class Server(BaseHTTPRequestHandler):
         else:
             self.enable_dynamic_cors()
 
-        self.send_header("Connection", ["keep-alive", "Close"][close] )
+        if close is None:
+            close = not self.keep_alive()
+        if close:
+            self.send_header("Connection", "close")
+        else:
+            self.send_header("Connection", "keep-alive")
+            self.send_header(
+                "Keep-Alive",
+                "timeout={}, max={}".format(
+                    self.idle_timeout(),
+                    KEEPALIVE_MAX_REQUESTS - self.requests_served - 1
+                )
+            )
 
         self.send_header(
             "Access-Control-Allow-Methods",
@@ -171,7 +605,7 @@ class Server(BaseHTTPRequestHandler):
         # force HSTS
         self.send_header("Strict-Transport-Security", "max-age=31536000")
 
-        self.end_headers()
+        self._headers_open = True
 
     def do_HEAD(self):
         '''
@@ -194,6 +628,9 @@ class Server(BaseHTTPRequestHandler):
 
             Reply to an HTTP GET request, probably with 404 or 405.
 
+            GET /stats returns the server's metrics as JSON (indented with
+                ?pretty=1), but only to clients connecting from this machine.
+
             As yet undocumented: SOP Buster is a workaround for the Same Origin
                 Policy
         '''
@@ -202,65 +639,93 @@ class Server(BaseHTTPRequestHandler):
         qs      = urllib.parse.parse_qs(pathobj.query)
         is_csop = "url" in qs and qs["url"] and qs["url"][0]
 
-        if cpath == "favicon.ico":
-            self.set_headers(200, headers=(["Content-Type", "image/x-icon"],))
-            with open(cpath, "rb") as icon:
-                self.wfile.write(icon.read())
+        asset = static_assets.lookup(cpath)
+        if asset is not None:
+            self.write_asset(asset)
 
-        elif cpath.split(".")[0] in ["sop-buster", "sop_buster", "sopbuster"]:
-            from os.path import join
-            self.set_headers(200, csop=True)
-            with open(join("util", "sopbuster.js"), "rb") as js:
-                self.wfile.write(js.read())
+        elif cpath == "stats" and self.client_address[0] in LOCAL_ADDRS:
+            self.set_headers(200)
+            self.write_json(metrics.snapshot(), pretty="pretty" in qs)
 
         elif pathobj.path in ["", "/"] and is_csop:
-            import requests, re  # noqa
-
-            # request URL
-            url   = qs["url"][0]
-            hasprotocol = re.compile(r"^https?:\/\/.+")
-            if not re.match(hasprotocol, url):
-                url = "http://" + url
-
-            # request method (defaults to GET)
-            # ok methods: delete, get, head, patch, post, put
-            # sanitise input to disallow code injection
-            okmtd = re.compile(r"^(delete|get|head|patch|post|put)$")
-            mtd   = re.match(okmtd, qs.get("method", ["get"])[0])
-            if mtd:
-                mtd = mtd.string
-            else:
-                mtd = "get"
-            request_mtd = eval("requests." + mtd)
-
-            # request headers
-            # hdrs    = qs.get("header", [])  # get all the uses of the field
-            hdr_obj = {}  # api_helper.parse_encoded_headers(*hdrs)  # decode
-
-            # request body
-            body = qs.get("body", [""])[0]  # only first use
-
-            # perform the request
-            resp = request_mtd(url, headers=hdr_obj, data=body)
-
-            self.set_headers(
-                200,
-                csop=True,
-                headers=(
-                    ("Content-Type",    resp.headers["content-type"]),
-                    ("X-Response-Data",
-                        urllib.parse.urlencode(
-                            {"url": resp.url, "headers": dict(resp.headers)})
-                    ), # noqa leave this
-                )
-            )
-
-            self.wfile.write(resp.content)
+            self.proxy_request(qs)
 
         else:
             self.set_headers(405)
             self.write_json_error("HTTP/1.1 GET NotImplemented")
 
+    def proxy_request(self, qs):
+        '''
+            Arguments:  qs (the parsed query string, with url and optionally
+                        method and body)
+            Returns:    None
+            Throws:     inherited
+            Effects:    makes the request upstream through proxy_cache and
+                        writes the response back
+
+            SOP Buster: the upstream body is passed on as it arrives, still in
+                whatever Content-Encoding the upstream server chose from the
+                client's Accept-Encoding. The status is always 200; the
+                upstream status, final URL and headers are in the
+                X-Response-Data header. GETs and HEADs may be answered from
+                proxy_cache, as the upstream Cache-Control allows; X-Cache
+                says whether this one was (HIT or REVALIDATED) or not (MISS
+                or BYPASS).
+        '''
+        method = qs.get("method", ["get"])[0].upper()
+        if method not in proxy.METHODS:
+            method = "GET"
+        body    = qs.get("body", [""])[0].encode("utf-8")
+        headers = {}
+        if self.headers.get("Accept-Encoding"):
+            headers["Accept-Encoding"] = self.headers["Accept-Encoding"]
+
+        try:
+            upstream = proxy_cache.cache.fetch(method, qs["url"][0],
+                                               body=body, headers=headers)
+        except ValueError as e:
+            self.set_headers(400, csop=True)
+            self.write_json_error(str(e))
+            return
+        except proxy.ProxyError as e:
+            self.set_headers(e.status, csop=True)
+            self.write_json_error(str(e))
+            return
+
+        try:
+            # wait for the first of the body before answering, so an
+            # upstream which fails straight away still gets an error status
+            chunks = iter(upstream)
+            try:
+                first = next(chunks, b"")
+            except proxy.ProxyError as e:
+                self.set_headers(e.status, csop=True)
+                self.write_json_error(str(e))
+                return
+
+            encoding = upstream.headers.get("Content-Encoding")
+            head     = [
+                ("Content-Type", upstream.headers.get(
+                    "Content-Type", "application/octet-stream")),
+                ("X-Response-Data", urllib.parse.urlencode({
+                    "url": upstream.url, "status": upstream.status,
+                    "headers": dict(upstream.headers)
+                })),
+                ("X-Cache", upstream.cache),
+            ]
+            if encoding:
+                head += [("Content-Encoding", encoding),
+                         ("Vary", "Accept-Encoding")]
+            self.set_headers(200, csop=True, headers=head)
+            self.write_chunks(itertools.chain((first,), chunks),
+                              compress=not encoding)
+        except proxy.ProxyError as e:
+            # too late for an error status; write_chunks has cut it off
+            logger.error("proxied body from {} failed: {}"
+                         .format(upstream.url, e))
+        finally:
+            upstream.close()
+
     # handle POST based on JSON content
     def do_POST(self):
         '''
@@ -275,11 +740,31 @@ class Server(BaseHTTPRequestHandler):
             Interprets the headers, and request body as UTF-8, and expects the
                 body to be parsable as JSON.
 
+            The "batch" verb takes a list of {"verb", "data"} requests as its
+                data and replies with a list of {"response", "status",
+                "data"}, each request keeping its own status; an anticsrf
+                token is needed (once) if any request in it needs one.
+
+            Replies of verbs whose data comes from one database (like
+                view_menu) carry an ETag, as a header and as "etag" in the
+                reply. Sending it back in an If-None-Match header gets a 304
+                with no body; sending it as "if_none_match" in "data" gets
+                {"unchanged": true} as the reply's data. Either way the verb
+                isn't run and nothing is read or encoded again.
+
+            The reply is compact JSON unless the request has "pretty": true,
+                and a large one is sent with chunked transfer-encoding. Replies
+                of at least compression.min_size() bytes are compressed with
+                gzip or brotli if Accept-Encoding allows it.
+
             The following HTTP status codes may be returned:
 
             - 200 (OK): the server understood your request and has processed
                 it without errors. The response as JSON follows the headers.
 
+            - 304 (Not Modified): the If-None-Match header names the current
+                ETag of the reply; there is no body.
+
             - 400 (Bad Request): the server cannot process your request because
                 - the Content-Type header does not have the value
                     "application/json",
@@ -297,7 +782,13 @@ class Server(BaseHTTPRequestHandler):
                     since being issued (either expliictly, or because an hour
                     elapsed), or
                 - the account specified by "gapi_info" does not have permission
-                    to perform the requested "verb".
+                    to perform the requested "verb", or
+                - the verb acts for a user and "gapi_token" in "data" is not a
+                    valid Google ID token.
+
+            - 403 (Forbidden): the signed-in account may not do this, like
+                closing an order another account placed without being
+                elevated.
 
             - 406 (Not Acceptable): the server has processed your request but
                 found that the "time" top-level key is from the future (that
@@ -322,26 +813,26 @@ class Server(BaseHTTPRequestHandler):
         self.lock = threading.Lock()
         # refuse to receive non-json content
         if self.headers["content-type"] != "application/json":
-            self.set_headers(400)
+            # the body is never read, so it can't share the connection
+            self.set_headers(400, close=True)
             self.write_json_error(
                 "server doesn't process non-JSON in POST requests")
             return
 
         if "content-length" not in self.headers:
-            self.send_response_only(411)
+            self.set_headers(411, close=True)
             return
 
         length = int(self.headers["content-length"])
 
         msg_bytes = self.rfile.read(length)
+        logger.debug("Message: %s", _Snippet(msg_bytes))
 
-        msg_str = str(msg_bytes, "utf-8")
-        logger.debug("Message: " + str(msg_str))
-
-        # read the message and convert it into a python dictionary
+        # read the message and convert it into a python dictionary, straight
+        # from the bytes
         try:
-            message = json.loads(msg_str)
-        except json.JSONDecodeError as ex:
+            message = json_codec.loads(msg_bytes)
+        except json_codec.DecodeError as ex:
             self.set_headers(400)
             self.write_json_error(
                 "can't process HTTP/1.1 POST body as JSON",
@@ -372,28 +863,61 @@ class Server(BaseHTTPRequestHandler):
             )
             return
 
-        logger.debug("Request: " + str(message))
+        logger.debug("Request: verb %s", verb)
 
+        spec      = api_helper.VERBS.get(verb)
         csrf_reqd = (dev_vars.DEV_REQUIRE_ANTICSRF_POST
-                        and message["verb"] not in ["ping", "gapi_validate"])
+                        and api_helper.needs_csrf(verb, data))
+        csrf_bound_to = None
         if csrf_reqd:
             csrf_result = self.csrf_validate(message)
             if not csrf_result:
                 return
-
-        reply = dict()
-        code  = 200
-        ok    = True
-
-        with self.lock:
-            # should exc_verb throw exceptions?
-            try:
-                data, ok = self.exc_verb(verb, data)
-            except Exception as e:
-                self.set_headers(
-                    500,
-                    msg=", ".join(traceback.format_exc().split("\n"))
-                )
+            csrf_bound_to = functools.partial(token_clerk.bound_to,
+                                              csrf_result)
+
+        reply    = dict()
+        code     = 200
+        ok       = True
+        pretty   = message.get("pretty") is True
+        req_data = data
+
+        # a cacheable verb's data is the same for as long as its database's
+        # version is, so once it has been encoded for this version the verb
+        # needn't run at all; pretty replies aren't worth caching
+        cache_db = spec is not None and not pretty and spec.cache
+        payload  = None
+        if cache_db:
+            version = json_helper.db_version(cache_db)
+            payload = payload_cache.peek(verb, version)
+
+        if payload is None:
+            with self.lock:
+                # should exc_verb throw exceptions?
+                try:
+                    data, ok = self.exc_verb(verb, data, csrf_bound_to)
+                except Exception as e:
+                    data, ok = self.internal_error(
+                        ", ".join(traceback.format_exc().split("\n"))
+                    )
+
+            # only if no reload happened while the verb ran is its data
+            # known to be that version's
+            if (cache_db and ok is True and version
+                    and version == json_helper.db_cache.version(cache_db)):
+                payload = payload_cache.get(verb, version, data)
+
+        etag = None
+        if payload is not None:
+            etag = payload.etag
+            if payload_cache.etag_matches(self.headers.get("If-None-Match"),
+                                          etag):
+                self.write_not_modified(etag)
+                return
+            if (isinstance(req_data, dict) and payload_cache.etag_matches(
+                    req_data.get("if_none_match"), etag)):
+                # the client has this data already, so say just that
+                data, payload = {"unchanged": True}, None
 
         reply = {
             "response": api_helper.verb_reply(verb),
@@ -404,16 +928,29 @@ class Server(BaseHTTPRequestHandler):
         if csrf_reqd and csrf_result:
             reply["anticsrf"] = message["anticsrf"]
 
+        if etag is not None:
+            reply["etag"] = etag
+
         if ok == -1:
             # the headers were (hopefully) already sent
             return
+        elif etag is not None:
+            self.set_headers(code, headers=(
+                ("Content-Type", "application/json"),
+                ("ETag", etag),
+                ("Access-Control-Expose-Headers", "ETag"),
+            ))
         elif ok is True:
             self.set_headers(code)
         else:
             self.set_headers(ok[0], msg=ok[1])
 
         reply["time"]["conn_server"] = anticsrf.microtime()
-        self.write_json(reply)
+        if payload is not None:
+            del reply["data"]
+            self.write_payload(reply, payload)
+        else:
+            self.write_json(reply, pretty=pretty)
 
     def do_OPTIONS(self):
         '''
@@ -428,51 +965,57 @@ class Server(BaseHTTPRequestHandler):
             XMLHttpRequest POST calls, to determine which headers are sent and
             to tell whether making such a request would violate the same-origin
             policy.
-        '''
-        self.set_headers(
-            200,
-            headers=(
-                (
-                    "Access-Control-Allow-Headers",
-                    "Content-Type, Access-Control-Allow-Headers, Origin, " +
-                    "Content-Length, Date, X-Unix-Epoch, Host, Connection"
-                ),
-            )
-        )
 
-    def exc_verb(self, verbstr, data):
+        The reply headers are serialized ahead of time per allowed origin by
+            the preflight module, and carry Access-Control-Max-Age so that
+            browsers stop preflighting every POST.
+        '''
+        keep = self.keep_alive()
+        self.close_connection = not keep
+        self.log_request(200)
+        self.wfile.write(b"".join([
+            b"HTTP/1.1 200 OK\r\nDate: ",
+            self.date_time_string().encode("latin-1"),
+            b"\r\nConnection: ",
+            b"keep-alive" if keep else b"close",
+            b"\r\n",
+            preflight.header_block(self.headers["origin"]),
+            b"\r\n",
+        ]))
+
+    def exc_verb(self, verbstr, data, csrf_bound_to=None):
         '''
-            Arguments:  verbstr (a string) and data (a dict)
+            Arguments:  verbstr (a string), data (a dict) and csrf_bound_to
+                        (None, or for a request with a valid anticsrf token a
+                        function of a user's "sub" telling whether the token
+                        was issued to them; passed to the verb)
             Returns:    a dict, and a status code (True for 200 OK, or the HTTP
                         error for an error)
             Throws:     no
-            Effects:    side effects of functions beginning with "reply_" in
-                        api_helper
+            Effects:    side effects of the verb's function in
+                        api_helper.VERBS, or sends a 400 if the verb's schema
+                        requires a data key that is missing
 
+            Look up the verb in the dispatch table built when api_helper was
+                imported, and call it with the extra arguments it asked for.
         '''
-        import re
-        attrs       = dir(api_helper)
-        replyfun_re = re.compile(r"^reply_[a-z_0-9]+$")
-        filattrs    = list(filter(
-            lambda s: None is not re.match(replyfun_re, s),
-            attrs
-        ))
-
-        verbnames   = ("_".join( fn.split("_") [1:] )   for fn in filattrs)
-        funcs       = (eval("api_helper.{}".format(fn)) for fn in filattrs)
+        spec = api_helper.VERBS.get(verbstr)
+        if spec is None:
+            return self.internal_error("API error: bad verb: {}"
+                                       .format(verbstr))
 
-        verb_func_dict = dict(zip(verbnames, funcs))
-
-        args, kwargs = (None,), {}
-        if verbstr == "gapi_validate":  # special case
-            args   = (token_clerk,)
-            kwargs = {"SPOOFING": dev_vars.DEV_SPOOFING_GAPI_REQS}
+        missing = api_helper.missing_keys(spec, data)
+        if missing:
+            self.set_headers(400)
+            self.write_json_error(
+                "verb '{}' requires missing data key(s): {}"
+                .format(verbstr, ", ".join(missing))
+            )
+            return {}, -1
 
-        return verb_func_dict.get(
-            verbstr,
-            lambda v:
-                self.internal_error("API error: bad verb: {}".format(verbstr))
-        )(data, *args, **kwargs)
+        args = tuple(VERB_ARGS[a] for a in spec.args) or (None,)
+        return spec.func(data, *args, csrf_bound_to=csrf_bound_to,
+                         **spec.kwargs)
 
     def internal_error(self, ctx):
         '''
@@ -491,7 +1034,8 @@ class Server(BaseHTTPRequestHandler):
         '''
             Arguments:  msg (a dict<string, object>)
             Returns:    False for a junk token or some information about the
-                        token for good tokens
+                        token for good tokens, including whom it was issued
+                        to; pass it to token_clerk.bound_to
             Throws:     no
             Effects:    inherited
 
@@ -543,29 +1087,218 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     """Handle requests in a separate thread."""
 
 
+class PooledHTTPServer(worker_pool.PooledMixIn, HTTPServer):
+    """Handle requests on a fixed pool of threads, shedding load with 503."""
+
+
+SERVER_MODES = {
+    "pooled":   PooledHTTPServer,
+    "threaded": ThreadedHTTPServer,
+    "asyncio":  aio_server.AsyncHTTPServer,
+}
+
+
 def run(
-    server_class=ThreadedHTTPServer,
+    server_class=None,
     handler_class=Server,
-    port=api_helper.LOCAL_PORT
+    port=api_helper.LOCAL_PORT,
+    mode="pooled",
+    workers=worker_pool.POOL_WORKERS,
+    queue_size=worker_pool.POOL_QUEUE,
+    preflight_max_age=preflight.PREFLIGHT_MAX_AGE,
+    compress_min=compression.COMPRESS_MIN,
+    gzip_level=compression.GZIP_LEVEL,
+    brotli_quality=compression.BROTLI_QUALITY,
+    csrf_tokens=None,
+    processes=1,
+    proxy_timeout=proxy.READ_TIMEOUT,
+    proxy_per_host=proxy.MAX_PER_HOST,
+    proxy_max=proxy.MAX_TOTAL,
+    proxy_cache_mb=proxy_cache.CACHE_BYTES // 2 ** 20,
+    proxy_cache_dir=None
   ):
+    preflight.build(max_age=preflight_max_age)
+    compression.configure(min_size=compress_min, gzip_level=gzip_level,
+                          brotli_quality=brotli_quality)
+    proxy.configure(read_timeout=proxy_timeout, max_per_host=proxy_per_host,
+                    max_total=proxy_max)
+    proxy_cache.configure(max_bytes=proxy_cache_mb * 2 ** 20,
+                          directory=proxy_cache_dir)
+
+    if server_class is None:
+        server_class = SERVER_MODES[mode]
     server_address = ("", port)
-    httpd = server_class(server_address, handler_class)
 
+    # ThreadingMixIn has no notion of a pool or a queue
+    opts = {} if server_class is ThreadedHTTPServer else {
+        "workers": workers, "queue_size": queue_size
+    }
+
+    # anti-CSRF tokens kept in memory are known only to the process which
+    # issued them, so with several processes they have to be signed
+    if csrf_tokens is None:
+        csrf_tokens = "signed" if processes > 1 else "memory"
+    elif csrf_tokens == "memory" and processes > 1:
+        logger.warning("anti-CSRF tokens kept in memory are only valid in the"
+                       " process that issued them; most requests will be"
+                       " refused (use --csrf-tokens signed)")
+
+    if processes <= 1:
+        httpd = server_class(server_address, handler_class, **opts)
+        start_services(csrf_tokens)
+        logger.info("Starting HTTP ({}) on port {}...".format(mode, port))
+        httpd.serve_forever()
+        return
+
+    # each worker starts its own threads after the fork, and follows the
+    # others' writes to the orders database
+    json_helper.configure(shared=True)
+    sock = prefork.listen(server_address)
+
+    def worker(slot):
+        httpd    = prefork.adopt(server_class, handler_class, sock, **opts)
+        stopping = threading.Event()
+        failed   = []
+
+        # stop accepting, answer what's in hand, then stop the database
+        # threads; shutdown() waits for serve_forever, so not from here
+        def stop(signo, stack_frame):
+            stopping.set()
+            threading.Thread(target=httpd.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, stop)
+
+        # a worker whose database threads died or hang can't answer another
+        # request which needs them, so it exits and the supervisor starts a
+        # fresh one
+        def watchdog(threads):
+            while not stopping.wait(WATCHDOG_INTERVAL):
+                dead = [t.name for t in threads if not t.is_alive()]
+                if dead or json_helper.write_stalled():
+                    why = "{} died".format(", ".join(dead)) if dead else \
+                        "the database writer is stuck"
+                    logger.critical("worker {}: {}; exiting to be restarted"
+                                    .format(slot, why))
+                    failed.append(True)
+                    stop(None, None)
+
+        threads = start_services(csrf_tokens)
+        threading.Thread(target=watchdog, args=(threads,),
+                         daemon=True).start()
+        try:
+            httpd.serve_forever()
+        finally:
+            stopping.set()
+            httpd.server_close()
+            json_helper.kill_all_threads()
+        if failed:
+            sys.exit(1)
+
+    logger.info("Starting HTTP ({}) on port {} in {} processes...".format(
+        mode, port, processes))
+    try:
+        prefork.Supervisor(worker, processes).run()
+    finally:
+        sock.close()
+
+
+def start_services(csrf_tokens="memory"):
+    '''
+        Arguments:  csrf_tokens ("memory" or "signed")
+        Returns:    the database threads requests are served by
+        Throws:     OSError if signed tokens have no key file and can't make
+                    one
+        Effects:    starts this process's background threads, and the
+                    database threads
+    '''
+    global token_clerk
+
+    # fetch Google's token signing certs before the first sign-in needs them
+    if not dev_vars.DEV_SPOOFING_GAPI_REQS:
+        gapi_auth.certs.start()
+
+    # who may edit the menu, kept in memory and rebuilt when the file changes
+    permissions.index.start()
+
+    # favicon.ico and SOP Buster's script, read and compressed ahead of time
+    static_assets.preload()
+
+    # signed tokens need nothing shared between processes but the key file;
+    # in memory, a sweeper drops tokens once they are long expired
+    if csrf_tokens == "signed":
+        token_clerk = signed_tokens.SignedTokenStore(
+            expire_after=token_clerk.expire_after
+        )
+        VERB_ARGS["token_clerk"] = token_clerk
+    token_clerk.start()
+
+    threads = []
     for f in [
         json_helper.read_server,
         json_helper.write_server,
         # json_helper.test_client
     ]:
         time.sleep(0)
-        threading.Thread(target=f).start()
-
-    logger.info("Starting HTTP on port {}...".format(port))
-
-    httpd.serve_forever()
+        t = threading.Thread(target=f, name=f.__name__)
+        t.start()
+        threads.append(t)
+    return threads
 
 
 def main():
-    from sys import argv
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("port", nargs="?", type=int,
+                        default=api_helper.LOCAL_PORT)
+    parser.add_argument("--mode", choices=sorted(SERVER_MODES),
+                        default="pooled",
+                        help="a fixed thread pool, one thread per connection,"
+                        " or one event loop")
+    parser.add_argument("--workers", type=int,
+                        default=worker_pool.POOL_WORKERS,
+                        help="request handling threads (pooled, asyncio)")
+    parser.add_argument("--queue", type=int, default=worker_pool.POOL_QUEUE,
+                        help="requests allowed to wait for a thread before"
+                        " the server answers 503 (pooled, asyncio)")
+    parser.add_argument("--preflight-max-age", type=int,
+                        default=preflight.PREFLIGHT_MAX_AGE,
+                        help="seconds browsers may cache CORS preflights")
+    parser.add_argument("--compress-min", type=int,
+                        default=compression.COMPRESS_MIN,
+                        help="smallest response body (bytes) to compress")
+    parser.add_argument("--gzip-level", type=int,
+                        default=compression.GZIP_LEVEL, choices=range(1, 10),
+                        metavar="1-9")
+    parser.add_argument("--brotli-quality", type=int,
+                        default=compression.BROTLI_QUALITY,
+                        choices=range(0, 12), metavar="0-11",
+                        help="used only if the brotli module is installed")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes sharing the port, each with"
+                        " its own threads, restarted if they die; 0 for one"
+                        " per core. /stats shows one worker's metrics")
+    parser.add_argument("--csrf-tokens", choices=["memory", "signed"],
+                        default=None,
+                        help="keep anti-CSRF tokens in this process, or sign"
+                        " them with the keys in {} so any process can check"
+                        " them (the default with --processes)"
+                        .format(signed_tokens.KEY_FILE))
+    parser.add_argument("--proxy-timeout", type=float,
+                        default=proxy.READ_TIMEOUT,
+                        help="seconds SOP Buster waits on each read from"
+                        " upstream")
+    parser.add_argument("--proxy-per-host", type=int,
+                        default=proxy.MAX_PER_HOST,
+                        help="SOP Buster requests in flight to one host")
+    parser.add_argument("--proxy-max", type=int, default=proxy.MAX_TOTAL,
+                        help="SOP Buster requests in flight in all")
+    parser.add_argument("--proxy-cache-mb", type=int,
+                        default=proxy_cache.CACHE_BYTES // 2 ** 20,
+                        help="memory for SOP Buster's response cache")
+    parser.add_argument("--proxy-cache-dir", default=None,
+                        help="also keep SOP Buster's cached responses in"
+                        " this directory, across restarts")
+    args = parser.parse_args()
 
     logger.info("=== STARTING ===")
 
@@ -577,10 +1310,14 @@ def main():
         ("DynamiCORS on ({}) " + num_frontends * "{} ")
         .format(num_frontends, *api_helper.ALLOW_FRONTEND_DOMAINS)
     )
-    if len(argv) == 2:
-        run(port=int(argv[1]))
-    else:
-        run()
+    run(port=args.port, mode=args.mode, workers=args.workers,
+        queue_size=args.queue, preflight_max_age=args.preflight_max_age,
+        compress_min=args.compress_min, gzip_level=args.gzip_level,
+        brotli_quality=args.brotli_quality, csrf_tokens=args.csrf_tokens,
+        processes=args.processes or prefork.PROCESSES,
+        proxy_timeout=args.proxy_timeout, proxy_per_host=args.proxy_per_host,
+        proxy_max=args.proxy_max, proxy_cache_mb=args.proxy_cache_mb,
+        proxy_cache_dir=args.proxy_cache_dir)
 
 
 def sigterm_handler(signo, stack_frame):
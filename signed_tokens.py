@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+import base64
+import binascii
+import coloredlogs
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from os import path
+
+import anticsrf.anticsrf as anticsrf
+
+import file_lock
+import json_codec
+import metrics
+import token_store
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("signed_tokens")
+
+# the signing keys every server process and node shares; keep it out of git
+# and copy it to every node (util/rotate_csrf_key makes and rotates it)
+KEY_FILE = path.join("json", "csrf_keys.json")
+
+# bytes of randomness in a key, and in each token so no two are alike
+KEY_BYTES   = 32
+NONCE_BYTES = 9
+
+# bytes of the keyed hash which stands for the user in a token
+USER_TAG_BYTES = 12
+
+# a key replaced by a newer one still verifies tokens for this long, in
+# seconds, so every token it signed can run out its life
+ROTATION_OVERLAP = token_store.EXPIRE_AFTER // 10 ** 6
+
+# util/rotate_csrf_key publishes a new key this many seconds before it is
+# used for signing, so every node has it before tokens signed with it arrive
+PUBLISH_AHEAD = 5 * 60
+
+# how often, in seconds, the key file is checked for changes
+KEY_RELOAD_INTERVAL = 5
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _read_keys(key_file):
+    with open(key_file, "rb") as f:
+        return json_codec.loads(f.read())["keys"]
+
+
+def _write_keys(key_file, keys, replace=True):
+    # readers see the old file or the new one; without replace, an existing
+    # file wins and False is returned
+    data = json_codec.dumps({"keys": keys})
+    if replace:
+        file_lock.write_atomic(key_file, data, mode=0o600)
+        return True
+    # linking a finished file into place fails if there is one already,
+    # which a rename wouldn't
+    temp = "{}.{}{}".format(key_file, os.getpid(), file_lock.TEMP_EXT)
+    fd   = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.link(temp, key_file)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        if path.exists(temp):
+            os.remove(temp)
+
+
+def retire_times(keys):
+    '''
+        Arguments:  keys (a list of {"id", "secret", "not_before"})
+        Returns:    a dict of key id -> the time (seconds) after which it no
+                    longer verifies tokens, or None if it isn't superseded
+        Throws:     KeyError for a key missing a field
+    '''
+    ordered = sorted(keys, key=lambda k: k["not_before"])
+    return {
+        key["id"]: (ordered[i + 1]["not_before"] + ROTATION_OVERLAP
+                    if i + 1 < len(ordered) else None)
+        for i, key in enumerate(ordered)
+    }
+
+
+def add_key(key_file=KEY_FILE, ahead=PUBLISH_AHEAD, replace=True):
+    '''
+        Arguments:  key_file (a path), ahead (seconds until the new key is
+                    used for signing), replace (False to leave an existing
+                    file alone)
+        Returns:    the new key's id, or None if replace was False and the
+                    file already existed
+        Throws:     OSError, and ValueError or KeyError for a bad key file
+        Effects:    writes the key file with the new key added and keys
+                    retired for good dropped
+    '''
+    # under the file's lock, so two rotations at once can't drop each
+    # other's key
+    with file_lock.exclusive(key_file):
+        now  = time.time()
+        keys = []
+        if replace and path.exists(key_file):
+            keys   = _read_keys(key_file)
+            retire = retire_times(keys)
+            keys   = [k for k in keys if (retire[k["id"]] or now) >= now]
+        new = {
+            "id":         _b64(os.urandom(6)),
+            "secret":     _b64(os.urandom(KEY_BYTES)),
+            "not_before": int(now + ahead),
+        }
+        if not _write_keys(key_file, keys + [new], replace=replace):
+            return None
+        return new["id"]
+
+
+class KeyRing():
+    '''
+        The keys in KEY_FILE: the newest one whose not_before has passed
+            signs, and every one not yet retired verifies. The file is read
+            again by a background thread when its (mtime, inode, size)
+            change; a bad file leaves the last good keys in use.
+    '''
+
+    def __init__(self, key_file=KEY_FILE, clock=time.time):
+        self.key_file = key_file
+        self._clock   = clock
+        self._stamp   = None
+        # (keys by not_before, key id -> secret, key id -> retire time),
+        # replaced whole so readers need no lock
+        self._ring    = None
+        self._lock    = threading.Lock()
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def reload(self):
+        '''
+            Returns:    whether the keys changed
+            Throws:     OSError if there is no key file and none was loaded
+                        before
+        '''
+        with self._lock:
+            try:
+                st    = os.stat(self.key_file)
+                stamp = st.st_mtime_ns, st.st_ino, st.st_size
+                if stamp == self._stamp:
+                    return False
+                keys   = _read_keys(self.key_file)
+                if not keys:
+                    raise ValueError("the key file has no keys")
+                by_id  = {k["id"]: _unb64(k["secret"]) for k in keys}
+                retire = retire_times(keys)
+            except (OSError, ValueError, KeyError, TypeError,
+                    binascii.Error) as e:
+                metrics.incr("csrf.keys.reload_failure")
+                logger.error("can't load {}: {!r}".format(self.key_file, e))
+                if self._ring is None:
+                    raise OSError("no anti-CSRF signing keys") from e
+                return False
+            self._ring  = (sorted(keys, key=lambda k: k["not_before"]),
+                           by_id, retire)
+            self._stamp = stamp
+        logger.info("{} anti-CSRF signing keys".format(len(keys)))
+        return True
+
+    def signing_key(self):
+        '''
+            Returns:    (key id, secret) to sign with now
+            Throws:     OSError if no keys could ever be loaded
+        '''
+        if self._ring is None:
+            self.reload()
+        keys, by_id, _ = self._ring
+        now = self._clock()
+        # if every key is still to come, as in a file just made by
+        # util/rotate_csrf_key, the first of them signs
+        chosen = keys[0]
+        for key in keys:
+            if key["not_before"] <= now:
+                chosen = key
+        return chosen["id"], by_id[chosen["id"]]
+
+    def verify_key(self, kid):
+        '''
+            Returns:    the secret of key kid, or None if there is no such
+                        key or it has retired
+            Throws:     no
+        '''
+        if self._ring is None:
+            return None
+        _, by_id, retire_at = self._ring
+        secret = by_id.get(kid)
+        retire = retire_at.get(kid)
+        if secret is None or (retire is not None and retire <= self._clock()):
+            return None
+        return secret
+
+    def _watcher(self):
+        while not self._stop.wait(KEY_RELOAD_INTERVAL):
+            try:
+                self.reload()
+            except OSError:
+                pass
+
+    def start(self):
+        '''
+            Effects:    makes the key file if there is none, loads it, and
+                        starts the thread which reloads it when it changes
+        '''
+        if not path.exists(self.key_file):
+            # another process may beat us to it, in which case its key is
+            # the one everybody uses
+            if add_key(self.key_file, ahead=0, replace=False):
+                logger.warning("made a new anti-CSRF key file {}"
+                               .format(self.key_file))
+        self.reload()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watcher, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+class SignedTokenStore():
+    '''
+        Anti-CSRF tokens which need no server-side state, with the same
+            interface as token_store.TokenStore.
+
+        A token is "key id.expiry.user.nonce.MAC": its expiry (microseconds)
+            and a keyed hash of the user it was issued to are in the token
+            itself, and the HMAC-SHA256 over them under a shared key is what
+            makes it valid. The hash tells nobody without the key who the
+            user is; bound_to checks it against the account a request is
+            signed in as.
+            Any process or node with the key file can check any token, and
+            a restart invalidates nothing. Nothing is held, so a token can't
+            be revoked before it expires.
+    '''
+
+    def __init__(self, keysize=None, keyfunc=None,
+                 expire_after=token_store.EXPIRE_AFTER, keyring=None,
+                 clock=anticsrf.microtime):
+        # keysize and keyfunc are TokenStore's, taken so either store can be
+        # made from the same arguments
+        self.expire_after = expire_after
+        self.keyring      = KeyRing() if keyring is None else keyring
+        self._clock       = clock
+
+    @staticmethod
+    def _mac(secret, body):
+        return _b64(hmac.new(secret, body.encode("ascii"),
+                             hashlib.sha256).digest())
+
+    @staticmethod
+    def _user_tag(secret, user):
+        return _b64(hmac.new(secret, b"user:" + user.encode("utf-8"),
+                             hashlib.sha256).digest()[:USER_TAG_BYTES])
+
+    def register_new(self, user=None):
+        '''
+            Arguments:  user (a string naming whom the token is for, like
+                        the Google account's "sub", or None)
+            Returns:    {"tok": a new token, "iat": now, "exp": when it
+                        expires}, times in microseconds
+            Throws:     no
+        '''
+        now  = self._clock()
+        exp  = now + self.expire_after
+        kid, secret = self.keyring.signing_key()
+        body = ".".join([
+            kid, str(exp), self._user_tag(secret, user) if user else "",
+            _b64(os.urandom(NONCE_BYTES)),
+        ])
+        return {"tok": body + "." + self._mac(secret, body),
+                "iat": now, "exp": exp}
+
+    def is_valid(self, token):
+        '''
+            Arguments:  token (a string)
+            Returns:    {"reg": whether it is genuine and current,
+                         "old": whether it is genuine but has expired,
+                         "exp": its expiry time, or 0 if it isn't genuine,
+                         "user": the tag of whom it was issued to, or None,
+                         "kid": the key it was signed with}; pass it to
+                        bound_to
+            Throws:     no
+        '''
+        bad = {"reg": False, "old": False, "exp": 0, "user": None,
+               "kid": None}
+        if not isinstance(token, str):
+            return bad
+        body, _, mac = token.rpartition(".")
+        parts = body.split(".")
+        if len(parts) != 4:
+            return bad
+        secret = self.keyring.verify_key(parts[0])
+        if secret is None or not hmac.compare_digest(
+                self._mac(secret, body), mac):
+            metrics.incr("csrf.bad_signature")
+            return bad
+        try:
+            exp = int(parts[1])
+        except ValueError:
+            return bad
+        current = exp > self._clock()
+        return {"reg": current, "old": not current, "exp": exp,
+                "user": parts[2] or None, "kid": parts[0]}
+
+    def bound_to(self, info, user):
+        '''
+            Arguments:  info (from is_valid), user (an account's "sub")
+            Returns:    whether the token was issued to user
+            Throws:     no
+        '''
+        secret = self.keyring.verify_key(info.get("kid"))
+        if secret is None or not info.get("user") or not user:
+            return False
+        return hmac.compare_digest(self._user_tag(secret, user),
+                                   info["user"])
+
+    def unregister(self, *tokens):
+        pass
+
+    @property
+    def current_tokens(self):
+        return {}
+
+    def __len__(self):
+        return 0
+
+    def start(self):
+        self.keyring.start()
+
+    def stop(self):
+        self.keyring.stop()
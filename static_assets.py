@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import coloredlogs
+import email.utils
+import gzip
+import io
+import logging
+import os
+import threading
+import time
+from os import path
+
+import compression
+import metrics
+import payload_cache
+
+coloredlogs.install(
+    level="NOTSET",
+    fmt="%(name)s[%(process)d] %(levelname)s %(message)s"
+)
+logger = logging.getLogger("static_assets")
+
+# seconds clients and caches may keep an asset without asking again; after
+# that, If-None-Match makes asking cheap
+MAX_AGE = 60 * 60
+
+# files up to this many bytes are held in memory, with their compressed
+# forms; bigger ones are sent from disk with sendfile as they are
+PRELOAD_MAX = 1 * 2 ** 20
+
+# an asset's file is checked for changes at most this often, in seconds
+STAT_INTERVAL = 1
+
+# compressed forms are made once per change to the file, so they can use the
+# slowest, smallest settings
+GZIP_LEVEL     = 9
+BROTLI_QUALITY = 11
+
+# bytes read from disk at a time when sendfile can't be used
+CHUNK_SIZE = 64 * 1024
+
+
+class Variant():
+    '''
+        One form of an asset's content: coding (None, "gzip" or "br"), size
+            (bytes), etag (a quoted entity tag, different for each coding),
+            and body (bytes, or None if it is to be read from the file).
+    '''
+
+    def __init__(self, coding, size, etag, body=None):
+        self.coding = coding
+        self.size   = size
+        self.etag   = etag
+        self.body   = body
+
+
+class Version():
+    '''
+        An asset as it was when its file was last read: stamp ((mtime,
+            inode, size) of the file), last_modified (an HTTP date), and
+            variants (coding -> Variant, None being the file as it is).
+    '''
+
+    def __init__(self, stamp, last_modified, variants):
+        self.stamp         = stamp
+        self.last_modified = last_modified
+        self.variants      = variants
+
+    def codings(self):
+        '''
+            Returns:    the compressed codings on offer, best first
+        '''
+        return tuple(c for c in compression.supported() if c in self.variants)
+
+
+def _compress(data, coding):
+    if coding == "gzip":
+        # mtime=0 keeps the bytes, and so the ETag, the same across restarts;
+        # gzip.compress only takes it from Python 3.8
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=GZIP_LEVEL,
+                           mtime=0) as f:
+            f.write(data)
+        return buf.getvalue()
+    return compression.brotli.compress(data, quality=BROTLI_QUALITY)
+
+
+def load(filename, stamp):
+    '''
+        Arguments:  filename (a path), stamp (its (mtime, inode, size))
+        Returns:    a Version of the file
+        Throws:     OSError
+    '''
+    last_modified = email.utils.formatdate(stamp[0] / 1e9, usegmt=True)
+    if stamp[2] > PRELOAD_MAX:
+        # too big to keep; tagged by its stamp, as hashing it would mean
+        # reading it all
+        etag = '"{:x}-{:x}-{:x}"'.format(*stamp)
+        return Version(stamp, last_modified,
+                       {None: Variant(None, stamp[2], etag)})
+
+    with open(filename, "rb") as f:
+        body = f.read()
+    digest   = payload_cache.digest(body)
+    variants = {None: Variant(None, len(body), '"{}"'.format(digest), body)}
+    for coding in compression.supported():
+        packed = _compress(body, coding)
+        # a form no smaller than the file isn't worth a Vary
+        if len(packed) < len(body):
+            variants[coding] = Variant(
+                coding, len(packed), '"{}-{}"'.format(digest, coding), packed
+            )
+    return Version(stamp, last_modified, variants)
+
+
+class Asset():
+    '''
+        A file served as it is at a fixed path, with its content type, and
+            csop (whether any origin may fetch it). The file is read, and
+            compressed, when first asked for and again whenever its (mtime,
+            inode, size) change; that is checked at most every
+            STAT_INTERVAL seconds, so most requests touch neither the disk
+            nor the CPU.
+    '''
+
+    def __init__(self, filename, content_type, csop=False, max_age=MAX_AGE):
+        self.filename     = filename
+        self.content_type = content_type
+        self.csop         = csop
+        self.max_age      = max_age
+        self._version     = None
+        self._checked     = 0
+        self._error       = None
+        self._lock        = threading.Lock()
+
+    def current(self):
+        '''
+            Returns:    the asset's current Version
+            Throws:     OSError if the file can't be read and never was
+        '''
+        version = self._version
+        if version is not None \
+                and time.monotonic() - self._checked < STAT_INTERVAL:
+            return version
+        with self._lock:
+            if self._version is not None \
+                    and time.monotonic() - self._checked < STAT_INTERVAL:
+                return self._version
+            try:
+                st    = os.stat(self.filename)
+                stamp = st.st_mtime_ns, st.st_ino, st.st_size
+                if self._version is None or stamp != self._version.stamp:
+                    self._version = load(self.filename, stamp)
+                    metrics.incr("static.loads")
+                    logger.info("loaded {} ({} bytes)".format(
+                        self.filename, st.st_size))
+            except OSError as e:
+                if self._version is None:
+                    raise
+                # keep serving what we had; it's back as soon as the file is
+                if repr(e) != self._error:
+                    logger.error("can't reload {}: {!r}".format(
+                        self.filename, e))
+                self._error = repr(e)
+            else:
+                self._error = None
+            self._checked = time.monotonic()
+            return self._version
+
+
+# request path -> Asset
+ASSETS = {
+    "favicon.ico": Asset("favicon.ico", "image/x-icon"),
+    "sopbuster.js": Asset(path.join("misc", "sopbuster.js"),
+                          "application/javascript; charset=utf-8",
+                          csop=True),
+}
+
+# request paths (up to the first ".") which are other names for an asset
+ALIASES = {
+    "sop-buster": "sopbuster.js",
+    "sop_buster": "sopbuster.js",
+    "sopbuster":  "sopbuster.js",
+}
+
+
+def lookup(cpath):
+    '''
+        Arguments:  cpath (a request path, without the leading "/")
+        Returns:    the Asset served there, or None
+        Throws:     no
+    '''
+    asset = ASSETS.get(cpath)
+    if asset is None:
+        asset = ASSETS.get(ALIASES.get(cpath.split(".")[0]))
+    return asset
+
+
+def preload():
+    '''
+        Effects:    reads every asset now, so the first requests for them
+                    don't have to; a missing file is logged and left to
+                    answer 404
+    '''
+    for asset in ASSETS.values():
+        try:
+            asset.current()
+        except OSError as e:
+            logger.error("can't load {}: {!r}".format(asset.filename, e))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+import threading
+
+import anticsrf.anticsrf as anticsrf
+
+import metrics
+
+# independent locks the tokens are spread over by hash; a power of two
+STRIPES = 16
+
+# tokens live this long, in microseconds
+EXPIRE_AFTER = (10 ** 6) * (60 ** 2)
+
+# an expired token is still recognised as once valid (so the client is told
+# it expired rather than that it was never registered) for this long after,
+# in microseconds, and then forgotten
+EXPIRED_GRACE = (10 ** 6) * (60 ** 2)
+
+# the timing wheel's resolution, in microseconds; tokens are dropped at most
+# this long after their grace runs out
+TICK = 10 ** 6
+
+# the wheel has WHEEL_LEVELS levels of 2 ** WHEEL_BITS slots each; level n's
+# slots each span 2 ** (WHEEL_BITS * n) ticks, so four levels of 64 reach
+# about 194 days ahead, and anything later waits in the last slot
+WHEEL_BITS   = 6
+WHEEL_LEVELS = 4
+
+
+class TimingWheel():
+    '''
+        A hierarchical timing wheel of keys due at a tick: adding a key and
+            advancing a tick are O(1), and a key due far ahead is cascaded
+            down a level at most WHEEL_LEVELS - 1 times; empty stretches are
+            skipped a level at a time. Not thread-safe; a Stripe holds its
+            lock around it.
+    '''
+
+    def __init__(self, tick):
+        self._size  = 1 << WHEEL_BITS
+        self._mask  = self._size - 1
+        self._reach = 1 << (WHEEL_BITS * WHEEL_LEVELS)
+        self._slots = [
+            [[] for _ in range(self._size)] for _ in range(WHEEL_LEVELS)
+        ]
+        # how many keys each level holds
+        self._levels = [0] * WHEEL_LEVELS
+        self._tick   = tick
+
+    def __len__(self):
+        return sum(self._levels)
+
+    def _place(self, key, due):
+        delta = min(due - self._tick, self._reach - 1)
+        at    = self._tick + delta
+        for level in range(WHEEL_LEVELS):
+            if delta < 1 << (WHEEL_BITS * (level + 1)):
+                break
+        slot = (at >> (WHEEL_BITS * level)) & self._mask
+        self._slots[level][slot].append((key, due))
+        self._levels[level] += 1
+
+    def add(self, key, due):
+        '''
+            Arguments:  key (anything), due (a tick; one already past is due
+                        at the next)
+        '''
+        self._place(key, max(due, self._tick + 1))
+
+    def _skip(self, tick):
+        # with the lowest n levels empty nothing can fire or cascade before
+        # the next multiple of 2 ** (WHEEL_BITS * n) ticks, so jump to just
+        # short of it; this keeps a long gap between calls cheap
+        for level, count in enumerate(self._levels):
+            if count:
+                break
+        else:
+            self._tick = tick
+            return
+        span = 1 << (WHEEL_BITS * level)
+        self._tick = max(self._tick, min(tick, (self._tick | (span - 1))))
+
+    def advance(self, tick):
+        '''
+            Arguments:  tick (the current tick)
+            Returns:    a list of the (key, due) pairs which fell due
+        '''
+        fired = []
+        while self._tick < tick:
+            self._skip(tick)
+            if self._tick >= tick:
+                break
+            self._tick += 1
+            now = self._tick
+            for level in range(1, WHEEL_LEVELS):
+                if now & ((1 << (WHEEL_BITS * level)) - 1):
+                    break
+                slot  = (now >> (WHEEL_BITS * level)) & self._mask
+                moved = self._slots[level][slot]
+                self._slots[level][slot] = []
+                self._levels[level] -= len(moved)
+                for key, due in moved:
+                    self._place(key, due)
+
+            slot = now & self._mask
+            due  = self._slots[0][slot]
+            self._slots[0][slot] = []
+            self._levels[0] -= len(due)
+            for entry in due:
+                if entry[1] <= now:
+                    fired.append(entry)
+                else:
+                    # a key clamped to the wheel's reach goes round again
+                    self._place(*entry)
+        return fired
+
+
+class Stripe():
+    '''
+        One lock's share of the tokens: token -> expiry time, token -> the
+            user it was issued to (for those issued to one), and a wheel of
+            when each is to be forgotten.
+    '''
+
+    def __init__(self, tick):
+        self.lock   = threading.Lock()
+        self.tokens = {}
+        self.users  = {}
+        self.wheel  = TimingWheel(tick)
+
+
+class TokenStore():
+    '''
+        Anti-CSRF tokens, a drop-in for anticsrf.token_clerk.
+
+        Tokens are spread by hash over STRIPES dicts, each with its own lock,
+            so registering and checking tokens from many threads rarely
+            contend. Each stripe's timing wheel drops a token EXPIRED_GRACE
+            after it expires; sweep() does that and a thread started by
+            start() calls it every TICK, so memory holds only the tokens of
+            the last expire_after + EXPIRED_GRACE however long the server
+            runs.
+    '''
+
+    def __init__(self, keysize=42, keyfunc=anticsrf.random_key,
+                 expire_after=EXPIRE_AFTER, grace=EXPIRED_GRACE,
+                 stripes=STRIPES, clock=anticsrf.microtime):
+        self.keysize      = keysize
+        self.keyfunc      = keyfunc
+        self.expire_after = expire_after
+        self.grace        = grace
+        self._clock       = clock
+        self._mask        = stripes - 1
+        tick = clock() // TICK
+        self._stripes = [Stripe(tick) for _ in range(stripes)]
+        self._stop    = threading.Event()
+        self._thread  = None
+
+    def _stripe(self, token):
+        return self._stripes[hash(token) & self._mask]
+
+    def register_new(self, user=None):
+        '''
+            Arguments:  user (a string naming whom the token is for, like
+                        the Google account's "sub", or None)
+            Returns:    {"tok": a new token, "iat": now, "exp": when it
+                        expires}, times in microseconds
+            Throws:     no
+        '''
+        now   = self._clock()
+        exp   = now + self.expire_after
+        token = self.keyfunc(self.keysize)
+        stripe = self._stripe(token)
+        with stripe.lock:
+            stripe.tokens[token] = exp
+            if user:
+                stripe.users[token] = user
+            stripe.wheel.add(token, (exp + self.grace) // TICK + 1)
+        return {"tok": token, "iat": now, "exp": exp}
+
+    def is_valid(self, token):
+        '''
+            Arguments:  token (a string)
+            Returns:    {"reg": whether it is registered and current,
+                         "old": whether it was registered but has expired,
+                         "exp": its expiry time, or 0 if unknown,
+                         "user": whom it was issued to, or None}; pass it to
+                        bound_to
+            Throws:     no
+        '''
+        if not isinstance(token, str):
+            return {"reg": False, "old": False, "exp": 0, "user": None}
+        # a single dict lookup is atomic, so checking needs no lock
+        stripe = self._stripe(token)
+        exp    = stripe.tokens.get(token)
+        if exp is None:
+            return {"reg": False, "old": False, "exp": 0, "user": None}
+        current = exp > self._clock()
+        return {"reg": current, "old": not current, "exp": exp,
+                "user": stripe.users.get(token)}
+
+    def bound_to(self, info, user):
+        '''
+            Arguments:  info (from is_valid), user (an account's "sub")
+            Returns:    whether the token was issued to user
+            Throws:     no
+        '''
+        return bool(user) and info.get("user") == user
+
+    def unregister(self, *tokens):
+        '''
+            Effects:    forgets the tokens now; the wheel's entries for them
+                        are skipped when they fall due
+        '''
+        for token in tokens:
+            stripe = self._stripe(token)
+            with stripe.lock:
+                stripe.tokens.pop(token, None)
+                stripe.users.pop(token, None)
+
+    def sweep(self):
+        '''
+            Returns:    how many tokens were forgotten
+            Effects:    drops tokens whose grace has run out
+        '''
+        tick    = self._clock() // TICK
+        dropped = 0
+        live    = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                for token, due in stripe.wheel.advance(tick):
+                    exp = stripe.tokens.get(token)
+                    # unregistered, or registered again with a later expiry
+                    if exp is not None and (exp + self.grace) // TICK < due:
+                        del stripe.tokens[token]
+                        stripe.users.pop(token, None)
+                        dropped += 1
+                live += len(stripe.tokens)
+        metrics.incr("csrf.evicted", dropped)
+        metrics.gauge("csrf.tokens", live)
+        return dropped
+
+    @property
+    def current_tokens(self):
+        '''
+            A dict of every token still held (including expired ones in
+                their grace period) to its expiry time; a copy.
+        '''
+        out = {}
+        for stripe in self._stripes:
+            with stripe.lock:
+                out.update(stripe.tokens)
+        return out
+
+    def __len__(self):
+        return sum(len(stripe.tokens) for stripe in self._stripes)
+
+    def _sweeper(self):
+        while not self._stop.wait(TICK / 10 ** 6):
+            self.sweep()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sweeper, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import json
+import queue
+import threading
+import time
+
+import metrics
+
+# threads that handle requests
+POOL_WORKERS = 32
+
+# accepted connections allowed to wait for a free worker; past this, new
+# connections get a 503 straight away
+POOL_QUEUE = 64
+
+# seconds a rejected client is told to wait before trying again
+RETRY_AFTER = 1
+
+# seconds a kept-alive connection may sit idle between requests; it holds one
+# of the workers meanwhile, so this is far shorter than the threaded and
+# asyncio modes' KEEPALIVE_TIMEOUT
+KEEPALIVE_IDLE = 2
+
+
+def overloaded_response(retry_after=RETRY_AFTER):
+    '''
+        Arguments:  retry_after (an int)
+        Returns:    the bytes of a complete HTTP/1.1 503 response
+        Throws:     no
+
+        Build the load-shedding reply without touching the request at all, so
+            it costs next to nothing to send.
+    '''
+    body = json.dumps({
+        "error": "server is handling too many other requests",
+        "explanation": "try again in {} second(s)".format(retry_after)
+    }).encode("utf-8")
+    head = (
+        "HTTP/1.1 503 Service Unavailable\r\n"
+        "Content-Type: application/json\r\n"
+        "Content-Length: {}\r\n"
+        "Retry-After: {}\r\n"
+        "Connection: close\r\n\r\n"
+    ).format(len(body), retry_after)
+    return head.encode("latin-1") + body
+
+
+class PooledMixIn():
+    '''
+        Mix-in class to handle requests on a fixed pool of threads.
+
+        Connections wait in a bounded queue for a free worker. When the queue
+            is full the connection is answered with a 503 and a Retry-After
+            header and closed, so overload means shed requests rather than an
+            ever-growing number of threads.
+
+        A worker stays with its connection while it is kept alive, so idle
+            ones are dropped after keepalive_idle seconds, and none are kept
+            alive while others wait for a worker (see saturated).
+    '''
+
+    pool_workers   = POOL_WORKERS
+    pool_queue     = POOL_QUEUE
+    retry_after    = RETRY_AFTER
+    keepalive_idle = KEEPALIVE_IDLE
+
+    # let the kernel hold more than socketserver's default of 5 pending
+    # connections, so overload shows up in our queue instead of as resets
+    request_queue_size = 128
+
+    def __init__(self, *args, workers=None, queue_size=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_workers = workers or self.pool_workers
+        self.pool_queue   = queue_size or self.pool_queue
+        self._pending     = queue.Queue(maxsize=self.pool_queue)
+        self._threads     = [
+            threading.Thread(
+                target=self._worker, name="pool-{}".format(i), daemon=True
+            )
+            for i in range(self.pool_workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def saturated(self):
+        '''
+            Returns:    whether connections are waiting for a free worker, in
+                        which case keeping this one alive would hold up theirs
+            Throws:     no
+        '''
+        return not self._pending.empty()
+
+    def process_request(self, request, client_address):
+        try:
+            self._pending.put_nowait(
+                (request, client_address, time.perf_counter())
+            )
+        except queue.Full:
+            metrics.incr("pool.rejected")
+            try:
+                request.sendall(overloaded_response(self.retry_after))
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        metrics.gauge("pool.queue_depth", self._pending.qsize())
+
+    def server_close(self):
+        '''
+            Effects:    closes the listening socket, then waits for the
+                        workers to finish every connection already accepted
+        '''
+        super().server_close()
+        for _ in self._threads:
+            self._pending.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _worker(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            request, client_address, queued_at = item
+            metrics.observe("pool.queue_wait", time.perf_counter() - queued_at)
+            metrics.gauge("pool.queue_depth", self._pending.qsize())
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)